@@ -175,4 +175,69 @@ $$;
 GRANT EXECUTE ON FUNCTION api.get_jwt_settings TO authenticated, anon;
 
 CREATE VIEW api.jwt_settings AS SELECT api.get_jwt_settings() as settings;
-GRANT SELECT ON api.jwt_settings TO authenticated, anon; 
\ No newline at end of file
+GRANT SELECT ON api.jwt_settings TO authenticated, anon; 
+-- Users that already have a provisioned role, used by the middleware to warm its role cache
+CREATE OR REPLACE FUNCTION api.provisioned_users()
+RETURNS TABLE (id TEXT)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = basic_auth
+AS $$
+    SELECT u.id FROM basic_auth.users u
+    WHERE EXISTS (SELECT 1 FROM pg_roles WHERE rolname = u.role);
+$$;
+
+REVOKE EXECUTE ON FUNCTION api.provisioned_users FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.provisioned_users TO authenticator;
+
+
+-- Set-based provisioning for a batch of users, called by the middleware with
+-- micro-batches of first-seen users. Roles that already exist are skipped with
+-- one catalog query. New roles get table access through membership in
+-- authenticated rather than per-table grants, so the cost doesn't grow with the
+-- schema. Returns the roles that were created.
+CREATE OR REPLACE FUNCTION api.create_user_roles(user_ids TEXT[])
+RETURNS SETOF TEXT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = api, basic_auth
+AS $$
+DECLARE
+    new_roles TEXT[];
+    new_role TEXT;
+    role_list TEXT;
+BEGIN
+    SELECT coalesce(array_agg(DISTINCT requested.id), '{}')
+    INTO new_roles
+    FROM unnest(user_ids) AS requested(id)
+    WHERE requested.id <> ''
+      AND NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = requested.id);
+
+    FOREACH new_role IN ARRAY new_roles LOOP
+        BEGIN
+            EXECUTE format('CREATE ROLE %I NOLOGIN', new_role);
+        EXCEPTION WHEN duplicate_object THEN
+            NULL;  -- created by a concurrent batch in the meantime
+        END;
+    END LOOP;
+
+    IF cardinality(new_roles) > 0 THEN
+        SELECT string_agg(quote_ident(r), ', ') INTO role_list FROM unnest(new_roles) AS r;
+        EXECUTE format('GRANT %s TO authenticator', role_list);
+        EXECUTE format('GRANT authenticated TO %s', role_list);
+    END IF;
+
+    INSERT INTO basic_auth.users (id, email, role)
+    SELECT DISTINCT requested.id, requested.id || '@example.com', requested.id
+    FROM unnest(user_ids) AS requested(id)
+    WHERE requested.id <> ''
+    ON CONFLICT (id) DO UPDATE
+    SET role = EXCLUDED.role;
+
+    RETURN QUERY SELECT unnest(new_roles);
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION api.create_user_roles FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.create_user_roles TO authenticator;
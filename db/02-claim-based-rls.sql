@@ -0,0 +1,87 @@
+-- Claim-based RLS: policies on api.test match rows on the JWT's sub claim
+-- instead of current_user, so every user can share the one authenticated role
+-- (middleware ROLE_MODE=shared) and no per-user Postgres roles are needed.
+--
+-- In the default per-user mode the minted token's sub equals its role, so these
+-- policies admit exactly the same rows there too: the migration can be applied
+-- before switching the middleware over. Safe to run more than once.
+--
+--     psql -U postgres -f db/02-claim-based-rls.sql
+
+BEGIN;
+
+-- The user's id from the claims PostgREST sets for each request. Reading it
+-- through (SELECT ...) in the policies lets the planner evaluate it once per
+-- statement rather than once per row.
+CREATE OR REPLACE FUNCTION api.request_user_id()
+RETURNS TEXT
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT nullif(current_setting('request.jwt.claims', true), '')::json->>'sub';
+$$;
+
+GRANT EXECUTE ON FUNCTION api.request_user_id TO authenticated, anon;
+
+-- Every policy filters on user_id
+CREATE INDEX IF NOT EXISTS test_user_id_idx ON api.test (user_id);
+
+DROP POLICY IF EXISTS "Users can only see their own data" ON api.test;
+DROP POLICY IF EXISTS "Users can only insert their own data" ON api.test;
+DROP POLICY IF EXISTS "Users can only update their own data" ON api.test;
+DROP POLICY IF EXISTS "Users can only delete their own data" ON api.test;
+
+CREATE POLICY "Users can only see their own data"
+    ON api.test FOR SELECT
+    USING (user_id = (SELECT api.request_user_id()));
+
+CREATE POLICY "Users can only insert their own data"
+    ON api.test FOR INSERT
+    WITH CHECK (user_id = (SELECT api.request_user_id()));
+
+CREATE POLICY "Users can only update their own data"
+    ON api.test FOR UPDATE
+    USING (user_id = (SELECT api.request_user_id()))
+    WITH CHECK (user_id = (SELECT api.request_user_id()));
+
+CREATE POLICY "Users can only delete their own data"
+    ON api.test FOR DELETE
+    USING (user_id = (SELECT api.request_user_id()));
+
+COMMIT;
+
+-- Once the middleware runs with ROLE_MODE=shared, the per-user roles are dead
+-- weight in pg_authid/pg_auth_members. This drops them in batches (each call is
+-- one transaction) and points basic_auth.users at the shared role. Run as a
+-- superuser until it returns 0:
+--
+--     SELECT basic_auth.drop_user_roles(1000);
+CREATE OR REPLACE FUNCTION basic_auth.drop_user_roles(batch_size INTEGER DEFAULT 1000)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SET search_path = basic_auth
+AS $$
+DECLARE
+    user_role TEXT;
+    dropped INTEGER := 0;
+BEGIN
+    FOR user_role IN
+        SELECT r.rolname
+        FROM basic_auth.users u
+        JOIN pg_roles r ON r.rolname = u.role
+        WHERE r.rolname NOT IN ('authenticator', 'authenticated', 'anon')
+          AND NOT r.rolsuper
+          AND NOT r.rolcanlogin
+        LIMIT batch_size
+    LOOP
+        UPDATE basic_auth.users SET role = 'authenticated', updated_at = NOW() WHERE role = user_role;
+        -- Per-user roles own nothing; this revokes the table grants made by create_user_role
+        EXECUTE format('DROP OWNED BY %I', user_role);
+        EXECUTE format('DROP ROLE %I', user_role);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION basic_auth.drop_user_roles FROM PUBLIC;
@@ -0,0 +1,12 @@
+-- Indexes for api.test at large row counts. Every RLS policy filters on
+-- user_id, and PostgREST pages and orders by id, so one (user_id, id) index
+-- serves both: a user's GET /test is an index range scan over their own rows
+-- no matter how many rows other tenants have. It replaces the single-column
+-- index from 02-claim-based-rls.sql. Safe to run more than once.
+--
+--     psql -U postgres -f db/03-test-indexes.sql
+
+CREATE INDEX IF NOT EXISTS test_user_id_id_idx ON api.test (user_id, id);
+DROP INDEX IF EXISTS api.test_user_id_idx;
+
+ANALYZE api.test;
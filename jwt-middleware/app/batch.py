@@ -0,0 +1,138 @@
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+# ${op.0.id}: a value from the JSON response of the operation with id "op"
+PLACEHOLDER = re.compile(r"\$\{([A-Za-z0-9_-]+)((?:\.[^.}]+)*)\}")
+
+# Request headers an operation may set for PostgREST
+OPERATION_HEADERS = {"accept", "prefer", "range", "range-unit", "accept-profile", "content-profile"}
+
+
+class BatchError(ValueError):
+    """The batch itself is invalid (duplicate ids, unknown references, cycles)"""
+
+
+class UnresolvedReference(Exception):
+    pass
+
+
+class BatchOperation(BaseModel):
+    id: Optional[str] = None
+    method: Literal["GET", "POST", "PUT", "PATCH", "DELETE"] = "GET"
+    path: str
+    query: str = ""
+    body: Any = None
+    headers: Dict[str, str] = Field(default_factory=dict)
+    depends_on: List[str] = Field(default_factory=list)
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+
+def references(value) -> set:
+    """Ids of the operations whose results a path, query, body or header refers to"""
+    if isinstance(value, str):
+        return {match.group(1) for match in PLACEHOLDER.finditer(value)}
+    if isinstance(value, dict):
+        return set().union(*map(references, value.values())) if value else set()
+    if isinstance(value, list):
+        return set().union(*map(references, value)) if value else set()
+    return set()
+
+
+def lookup(results: dict, op_id: str, path: str):
+    value = results[op_id]["body"]
+    for part in filter(None, path.split(".")):
+        try:
+            value = value[int(part)] if isinstance(value, list) else value[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise UnresolvedReference(f"${{{op_id}{path}}} is not in the response of {op_id}")
+    return value
+
+
+def resolve(value, results: dict):
+    """Substitute placeholders; a string that is exactly one placeholder keeps the value's JSON type"""
+    if isinstance(value, str):
+        whole = PLACEHOLDER.fullmatch(value)
+        if whole:
+            return lookup(results, whole.group(1), whole.group(2))
+        return PLACEHOLDER.sub(lambda match: str(lookup(results, match.group(1), match.group(2))), value)
+    if isinstance(value, dict):
+        return {key: resolve(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item, results) for item in value]
+    return value
+
+
+def plan(operations: List[BatchOperation]) -> Dict[str, set]:
+    """Map each operation id to the ids it depends on, rejecting invalid batches"""
+    ids = [op.id or str(index) for index, op in enumerate(operations)]
+    if len(set(ids)) != len(ids):
+        raise BatchError("operation ids must be unique")
+    graph = {}
+    for op_id, op in zip(ids, operations):
+        deps = set(op.depends_on) | references([op.path, op.query, op.body, op.headers])
+        unknown = deps - set(ids)
+        if unknown:
+            raise BatchError(f"operation {op_id} refers to unknown operations: {', '.join(sorted(unknown))}")
+        graph[op_id] = deps
+
+    # Kahn's algorithm: anything left over is on a cycle
+    remaining = {op_id: set(deps) for op_id, deps in graph.items()}
+    ready = [op_id for op_id, deps in remaining.items() if not deps]
+    while ready:
+        done = ready.pop()
+        del remaining[done]
+        for op_id, deps in remaining.items():
+            if done in deps:
+                deps.discard(done)
+                if not deps:
+                    ready.append(op_id)
+    if remaining:
+        raise BatchError(f"dependency cycle between operations: {', '.join(sorted(remaining))}")
+    return graph
+
+
+async def run_batch(operations: List[BatchOperation], send: Callable[[BatchOperation], Awaitable[dict]]) -> List[dict]:
+    """Run operations concurrently, each once the operations it depends on have succeeded
+
+    send(op) gets the operation with its placeholders resolved and returns
+    {"status": ..., "body": ...}. An operation whose dependency failed, or whose
+    placeholders can't be resolved, is not sent and gets status 424.
+    """
+    graph = plan(operations)
+    ids = list(graph)
+    results: Dict[str, dict] = {}
+    tasks: Dict[str, asyncio.Future] = {}
+
+    async def run(op_id: str, op: BatchOperation) -> dict:
+        if graph[op_id]:
+            await asyncio.gather(*(tasks[dep] for dep in graph[op_id]))
+        failed = sorted(dep for dep in graph[op_id] if results[dep]["status"] >= 400)
+        if failed:
+            result = {"status": 424, "error": f"dependency failed: {', '.join(failed)}"}
+        else:
+            try:
+                resolved = op.model_copy(update={
+                    "path": resolve(op.path, results),
+                    "query": resolve(op.query, results),
+                    "body": resolve(op.body, results),
+                    "headers": resolve(op.headers, results),
+                })
+            except UnresolvedReference as e:
+                result = {"status": 424, "error": str(e)}
+            else:
+                try:
+                    result = await send(resolved)
+                except Exception as e:
+                    result = {"status": 502, "error": f"upstream request failed: {e}"}
+        results[op_id] = {"id": op_id, **result}
+        return results[op_id]
+
+    for op_id, op in zip(ids, operations):
+        tasks[op_id] = asyncio.ensure_future(run(op_id, op))
+    return list(await asyncio.gather(*tasks.values()))
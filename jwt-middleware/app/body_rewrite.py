@@ -0,0 +1,107 @@
+import datetime
+import gc
+import json
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Optional
+from uuid import UUID
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional, stdlib json is the fallback
+    orjson = None
+
+
+def loads(body: bytes):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def _default(value):
+    """Encode database values neither encoder handles, such as numeric columns"""
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return str(value)  # NaN and Infinity, as Postgres renders them
+        # A raw fragment keeps numeric's exact digits; older orjson and the stdlib get a float
+        fragment = getattr(orjson, "Fragment", None)
+        return fragment(str(value)) if fragment is not None else float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=_default).encode()
+
+
+# Bodies above this size are rewritten with the cyclic GC paused: parsing a bulk
+# insert allocates one dict per row, which otherwise triggers repeated full
+# collections that cost more than the parse itself.
+GC_PAUSE_THRESHOLD = 64 * 1024
+
+
+# gc.disable() is process-wide, so overlapping pauses (nested, or from other
+# threads) share one count and only the last to end turns the GC back on.
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def gc_paused(pause: bool):
+    global _gc_pauses, _gc_was_enabled
+    if not pause:
+        yield
+        return
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+
+def is_json_content_type(content_type: Optional[str]) -> bool:
+    """PostgREST treats a missing Content-Type as JSON"""
+    if not content_type:
+        return True
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return media_type == "application/json" or media_type.endswith("+json")
+
+
+def stamp_user_id(body: bytes, user_id: str) -> bytes:
+    """Set user_id on a JSON object, or on every object of a JSON array (bulk insert)
+
+    The body is parsed exactly once and any client-supplied user_id is
+    overwritten. Raises ValueError if the body is not valid JSON.
+    """
+    if not body:
+        return body
+    with gc_paused(len(body) > GC_PAUSE_THRESHOLD):
+        data = loads(body)
+        if not stamp_rows(data, user_id):
+            return body
+        return dumps(data)
+
+
+def stamp_rows(data, user_id: str) -> bool:
+    """Set user_id in place on a parsed object or array of objects; False if it is neither"""
+    if isinstance(data, dict):
+        data["user_id"] = user_id
+    elif isinstance(data, list):
+        for row in data:
+            if isinstance(row, dict):
+                row["user_id"] = user_id
+    else:
+        return False
+    return True
@@ -0,0 +1,244 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from single_flight import SingleFlight
+
+
+class SharedResponse:
+    """A buffered upstream response that can be replayed to several clients"""
+
+    __slots__ = ("status", "headers", "body", "expires_at")
+
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = 0.0
+
+    def header(self, name: str) -> Optional[str]:
+        wanted = name.encode("latin-1")
+        for key, value in self.headers:
+            if key.lower() == wanted:
+                return value.decode("latin-1")
+        return None
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.header("etag")
+
+
+class TooLargeToShare(Exception):
+    """A response past the collapser's max_bytes, still open so it can be streamed instead
+
+    Only the caller that started the upstream call gets the response and its
+    chunks (those already read, then the rest); the callers that joined get
+    neither and send their own request.
+    """
+
+    def __init__(self, response=None, head: List[bytes] = (), rest: Optional[AsyncIterator[bytes]] = None):
+        super().__init__("response too large to share")
+        self.response = response
+        self.head = list(head)
+        self.rest = rest
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        for chunk in self.head:
+            yield chunk
+        async for chunk in self.rest:
+            yield chunk
+
+    async def aclose(self):
+        if self.response is not None:
+            await self.response.aclose()
+
+
+async def read_shareable(response, max_bytes: int) -> bytes:
+    """The raw body of a streamed httpx response, or TooLargeToShare once it is known to pass max_bytes"""
+    raw = response.aiter_raw()
+    head, size = [], int(response.headers.get("content-length") or 0)
+    if size <= max_bytes:
+        size = 0
+        async for chunk in raw:
+            head.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                break
+    if size > max_bytes:
+        raise TooLargeToShare(response, head, raw)
+    return b"".join(head)
+
+
+def cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Parse a Cache-Control header into {directive: argument}"""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    strip = lambda tag: tag.strip().removeprefix("W/")
+    return strip(etag) in {strip(tag) for tag in if_none_match.split(",")}
+
+
+class RequestCollapser:
+    """Shares one upstream call between concurrent identical GETs of the same user
+
+    Requests are keyed by the verified user, path, query and the request headers
+    that change PostgREST's response, so responses are never shared across
+    users. Responses are buffered to be shared; send() raises TooLargeToShare
+    past max_bytes, and the request is streamed unshared instead. With
+    cache_ttl > 0, 200 responses are also kept for that long (or
+    less, per the upstream Cache-Control max-age). They are not kept when
+    upstream says no-store or no-cache, or when they're bigger than
+    max_body_bytes. Only safe methods should ever be routed through here;
+    call invalidate() after a write so the user reads it back.
+    """
+
+    KEY_HEADERS = ("accept", "accept-encoding", "accept-profile", "prefer", "range", "range-unit")
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        cache_ttl: float = 0.0,
+        max_entries: int = 10000,
+        max_body_bytes: int = 1024 * 1024,
+        max_bytes: int = 4 * 1024 * 1024,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.enabled = enabled
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._cache: "OrderedDict[tuple, SharedResponse]" = OrderedDict()
+        self._flights = SingleFlight()
+        self._writes = 0
+        self.upstream_calls = 0
+        self.collapsed = 0
+        self.cache_hits = 0
+        self.invalidated = 0
+        self.too_large = 0
+
+    @classmethod
+    def from_env(cls) -> "RequestCollapser":
+        return cls(
+            enabled=os.getenv("COLLAPSE_GETS", "false").lower() in ("1", "true", "yes"),
+            cache_ttl=float(os.getenv("COLLAPSE_CACHE_TTL", "0")),
+            max_entries=int(os.getenv("COLLAPSE_CACHE_MAX_ENTRIES", "10000")),
+            max_body_bytes=int(os.getenv("COLLAPSE_CACHE_MAX_BODY_BYTES", str(1024 * 1024))),
+            max_bytes=int(os.getenv("COLLAPSE_MAX_BYTES", str(4 * 1024 * 1024))),
+        )
+
+    @classmethod
+    def key(cls, user_id: str, role: Optional[str], path: str, query: str, headers: Dict[str, str]) -> tuple:
+        lowered = {name.lower(): value for name, value in headers.items()}
+        return (user_id, role, path, query) + tuple(lowered.get(name) for name in cls.KEY_HEADERS)
+
+    async def fetch(self, key: tuple, send: Callable[[], Awaitable[SharedResponse]], no_cache: bool = False) -> SharedResponse:
+        """A cached or in-flight response for key, or the result of send() shared with concurrent callers"""
+        if not no_cache:
+            cached = self._cached(key)
+            if cached is not None:
+                self.cache_hits += 1
+                return cached
+
+        task, started = self._flights.get_or_start(key, lambda: self._send(key, send))
+        if started:
+            self.upstream_calls += 1
+        else:
+            self.collapsed += 1
+        try:
+            return await SingleFlight.join(task)
+        except TooLargeToShare:
+            if not started:
+                raise TooLargeToShare() from None
+            self.too_large += 1
+            raise
+        except asyncio.CancelledError:
+            if started:
+                task.add_done_callback(self._close_unclaimed)
+            raise
+
+    @staticmethod
+    def _close_unclaimed(task: asyncio.Future):
+        # The caller meant to stream an oversized response went away before it could
+        if not task.cancelled() and isinstance(task.exception(), TooLargeToShare):
+            asyncio.ensure_future(task.exception().aclose())
+
+    async def _send(self, key: tuple, send: Callable[[], Awaitable[SharedResponse]]) -> SharedResponse:
+        writes = self._writes
+        response = await send()
+        ttl = self._ttl(response)
+        # A read that was in flight during a write may predate it, so it isn't kept
+        if ttl > 0 and writes == self._writes:
+            response.expires_at = self.clock() + ttl
+            self._cache[key] = response
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return response
+
+    def _cached(self, key: tuple) -> Optional[SharedResponse]:
+        response = self._cache.get(key)
+        if response is None:
+            return None
+        if response.expires_at <= self.clock():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return response
+
+    def _ttl(self, response: SharedResponse) -> float:
+        if self.cache_ttl <= 0 or response.status != 200 or len(response.body) > self.max_body_bytes:
+            return 0.0
+        directives = cache_control(response.header("cache-control"))
+        if "no-store" in directives or "no-cache" in directives:
+            return 0.0
+        try:
+            return min(self.cache_ttl, float(directives["max-age"]))
+        except (KeyError, TypeError, ValueError):
+            return self.cache_ttl
+
+    def invalidate(self, user_id: str, path: str) -> int:
+        """Drop the user's cached and in-flight reads of path after a write to it
+
+        An RPC can write to any table, so a path under rpc/ drops all of the
+        user's reads. Returns the number of cached responses dropped.
+        """
+        self._writes += 1
+        stale = lambda key: key[0] == user_id and (key[2] == path or path.startswith("rpc/"))
+        for key in filter(stale, self._flights):
+            self._flights.forget(key)
+        dropped = [key for key in self._cache if stale(key)]
+        for key in dropped:
+            del self._cache[key]
+        self.invalidated += len(dropped)
+        return len(dropped)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "cache_ttl": self.cache_ttl,
+            "cached": len(self._cache),
+            "in_flight": len(self._flights),
+            "upstream_calls": self.upstream_calls,
+            "collapsed": self.collapsed,
+            "cache_hits": self.cache_hits,
+            "invalidated": self.invalidated,
+            "too_large": self.too_large,
+        }
@@ -0,0 +1,258 @@
+import logging
+import os
+import time
+import zlib
+from typing import Callable, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # optional: br is only offered when it's installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional: zstd is only offered when it's installed
+    zstandard = None
+
+from conditional import header
+
+logger = logging.getLogger(__name__)
+
+
+class _Gzip:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _Zstd:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+AVAILABLE = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    """JSON (PostgREST's default, including vnd.pgrst.* and +json), NDJSON, CSV and text"""
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    return media_type.startswith("text/") or "json" in media_type or media_type.endswith(("csv", "xml"))
+
+
+def parse_accept_encoding(value: Optional[str]) -> dict:
+    """Parse "gzip;q=0.8, br, *;q=0" into {"gzip": 0.8, "br": 1.0, "*": 0.0}"""
+    weights = {}
+    for part in (value or "").split(","):
+        coding, *params = [piece.strip() for piece in part.split(";")]
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params:
+            name, _, number = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(number)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    return weights
+
+
+class Compression:
+    """Settings and counters for negotiated response compression
+
+    encodings is the server's preference order; a client's q-values win, and
+    ties go to the earlier encoding. Levels default to fast settings suited to
+    compressing each response as it streams (gzip 5, brotli 4, zstd 3) rather
+    than the maximum ratio. Bodies smaller than min_bytes are sent as they are.
+    With flush set, every body chunk of a streamed response is flushed to the
+    client as soon as it is compressed, so rows aren't held back waiting for
+    the compressor's window to fill.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        min_bytes: int = 1024,
+        encodings: Tuple[str, ...] = ("zstd", "br", "gzip"),
+        gzip_level: int = 5,
+        brotli_quality: int = 4,
+        zstd_level: int = 3,
+        flush: bool = True,
+    ):
+        missing = [encoding for encoding in encodings if not AVAILABLE.get(encoding)]
+        if missing:
+            logger.info("Compression encodings not available (module not installed or unknown): %s", ", ".join(missing))
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.encodings = tuple(encoding for encoding in encodings if AVAILABLE.get(encoding))
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+        self.flush = flush
+        self.compressed = {encoding: 0 for encoding in self.encodings}
+        self.skipped_small = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    @classmethod
+    def from_env(cls) -> "Compression":
+        return cls(
+            enabled=os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes"),
+            min_bytes=int(os.getenv("COMPRESSION_MIN_BYTES", "1024")),
+            encodings=tuple(e.strip() for e in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if e.strip()),
+            gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "5")),
+            brotli_quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")),
+            zstd_level=int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3")),
+            flush=os.getenv("COMPRESSION_FLUSH", "true").lower() in ("1", "true", "yes"),
+        )
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        """The encoding to use for a client's Accept-Encoding, or None for identity"""
+        weights = parse_accept_encoding(accept_encoding)
+        best, best_weight = None, 0.0
+        for encoding in self.encodings:
+            weight = weights.get(encoding, weights.get("*", 0.0))
+            if weight > best_weight:
+                best, best_weight = encoding, weight
+        return best
+
+    def compressor(self, encoding: str):
+        if encoding == "gzip":
+            return _Gzip(self.gzip_level)
+        if encoding == "br":
+            return _Brotli(self.brotli_quality)
+        return _Zstd(self.zstd_level)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "encodings": list(self.encodings),
+            "min_bytes": self.min_bytes,
+            "compressed": dict(self.compressed),
+            "compressed_total": sum(self.compressed.values()),
+            "skipped_small": self.skipped_small,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else None,
+            "seconds": round(self.seconds, 6),
+        }
+
+
+def vary_accept_encoding(headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    vary = header(headers, b"vary")
+    if vary is not None and "accept-encoding" in vary.lower():
+        return headers
+    if vary is None:
+        return headers + [(b"vary", b"Accept-Encoding")]
+    return [(k, v + b", Accept-Encoding" if k.lower() == b"vary" else v) for k, v in headers]
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware compressing response bodies with the client's preferred encoding
+
+    Takes a callable returning the Compression settings so they can be swapped
+    at runtime. Only 200/201 responses with a compressible content type and no
+    Content-Encoding are touched, and not when Cache-Control says
+    no-transform. Compressed responses lose Content-Length, gain Vary:
+    Accept-Encoding and have a strong ETag made weak, since the bytes differ
+    per encoding.
+    """
+
+    def __init__(self, app, compression: Callable[[], Compression]):
+        self.app = app
+        self.compression = compression
+
+    async def __call__(self, scope, receive, send):
+        compression = self.compression()
+        if scope["type"] != "http" or scope["method"] == "HEAD" or not compression.enabled:
+            return await self.app(scope, receive, send)
+
+        encoding = compression.negotiate(header(scope["headers"], b"accept-encoding"))
+        mode = "pass"
+        start = None
+        compressor = None
+
+        async def send_wrapper(message):
+            nonlocal mode, start, compressor
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                if (
+                    message["status"] not in (200, 201)
+                    or header(headers, b"content-encoding") is not None
+                    or not is_compressible(header(headers, b"content-type"))
+                    or "no-transform" in (header(headers, b"cache-control") or "").lower()
+                ):
+                    mode = "pass"
+                    return await send(message)
+                headers = vary_accept_encoding(headers)
+                length = header(headers, b"content-length")
+                if encoding is None or length is not None and int(length) < compression.min_bytes:
+                    compression.skipped_small += encoding is not None
+                    mode = "pass"
+                    return await send({**message, "headers": headers})
+                mode, start = "compress", {**message, "headers": headers}
+                return
+
+            if message["type"] != "http.response.body" or mode == "pass":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                if not more_body and len(body) < compression.min_bytes:
+                    compression.skipped_small += 1
+                    mode = "pass"
+                    await send(start)
+                    return await send(message)
+                compressor = compression.compressor(encoding)
+                headers = [(k, v) for k, v in start["headers"] if k.lower() != b"content-length"]
+                headers = [(k, b"W/" + v if k.lower() == b"etag" and not v.startswith(b"W/") else v) for k, v in headers]
+                await send({**start, "headers": headers + [(b"content-encoding", encoding.encode())]})
+                compression.compressed[encoding] += 1
+
+            started = time.perf_counter()
+            out = compressor.compress(body)
+            if not more_body:
+                out += compressor.finish()
+            elif compression.flush:
+                out += compressor.flush()
+            compression.seconds += time.perf_counter() - started
+            compression.bytes_in += len(body)
+            compression.bytes_out += len(out)
+            if out or not more_body:
+                await send({"type": "http.response.body", "body": out, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,137 @@
+import hashlib
+import os
+from typing import Callable, List, Optional, Tuple
+
+from collapse import cache_control, etag_matches
+
+# Headers a 304 keeps (RFC 9110 15.4.5); the rest describe a body that isn't sent
+NOT_MODIFIED_HEADERS = {b"etag", b"cache-control", b"vary", b"content-location", b"date", b"expires"}
+
+
+def header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[str]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+def body_etag(body: bytes) -> str:
+    """A weak ETag for a response body: the same rows re-serialized may differ in bytes, not in meaning"""
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def not_modified(headers: List[Tuple[bytes, bytes]], etag: str) -> dict:
+    kept = [(k, v) for k, v in headers if k.lower() in NOT_MODIFIED_HEADERS and k.lower() != b"etag"]
+    return {"type": "http.response.start", "status": 304, "headers": kept + [(b"etag", etag.encode("latin-1"))]}
+
+
+class Conditional:
+    """Settings and counters for ETags and 304s on GET responses
+
+    An upstream ETag is passed through and checked against If-None-Match.
+    Without one, a 200 GET response with a Content-Length of at most max_bytes
+    is buffered and given a weak ETag from its body. Larger responses, and
+    streamed ones without a Content-Length, go through untouched, so their
+    first bytes are never held back.
+    """
+
+    def __init__(self, enabled: bool = True, max_bytes: int = 256 * 1024):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.generated = 0
+        self.passed_through = 0
+        self.not_modified = 0
+        self.too_large = 0
+        self.streamed = 0
+
+    @classmethod
+    def from_env(cls) -> "Conditional":
+        return cls(
+            enabled=os.getenv("ETAG_ENABLED", "true").lower() in ("1", "true", "yes"),
+            max_bytes=int(os.getenv("ETAG_MAX_BYTES", str(256 * 1024))),
+        )
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "max_bytes": self.max_bytes,
+            "generated": self.generated,
+            "passed_through": self.passed_through,
+            "not_modified": self.not_modified,
+            "too_large": self.too_large,
+            "streamed": self.streamed,
+        }
+
+
+class ConditionalMiddleware:
+    """Pure ASGI middleware answering GET and HEAD with 304 when If-None-Match matches the response's ETag
+
+    Takes a callable returning the Conditional settings so they can be swapped
+    at runtime. HEAD responses have no body to hash, so only an upstream ETag
+    is checked for them.
+    """
+
+    def __init__(self, app, conditional: Callable[[], Conditional]):
+        self.app = app
+        self.conditional = conditional
+
+    async def __call__(self, scope, receive, send):
+        conditional = self.conditional()
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD") or not conditional.enabled:
+            return await self.app(scope, receive, send)
+
+        if_none_match = header(scope["headers"], b"if-none-match")
+        mode = "pass"
+        start = None
+        buffered = []
+
+        async def send_wrapper(message):
+            nonlocal mode, start
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                if message["status"] != 200 or "no-store" in cache_control(header(headers, b"cache-control")):
+                    mode = "pass"
+                    return await send(message)
+                etag = header(headers, b"etag")
+                if etag is not None:
+                    conditional.passed_through += 1
+                    if etag_matches(if_none_match, etag):
+                        conditional.not_modified += 1
+                        mode = "drop"
+                        return await send(not_modified(headers, etag))
+                    mode = "pass"
+                    return await send(message)
+                length = header(headers, b"content-length")
+                if scope["method"] == "HEAD" or length is None or int(length) > conditional.max_bytes:
+                    if scope["method"] != "HEAD":
+                        if length is None:
+                            conditional.streamed += 1
+                        else:
+                            conditional.too_large += 1
+                    mode = "pass"
+                    return await send(message)
+                mode, start = "buffer", message
+                return
+
+            if message["type"] != "http.response.body" or mode == "pass":
+                return await send(message)
+            if mode == "drop":
+                return  # The client already has it
+            buffered.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return  # At most Content-Length, so at most max_bytes
+
+            body = b"".join(buffered)
+            etag = body_etag(body)
+            conditional.generated += 1
+            headers = start.get("headers", [])
+            if etag_matches(if_none_match, etag):
+                conditional.not_modified += 1
+                await send(not_modified(headers, etag))
+                return await send({"type": "http.response.body", "body": b""})
+            await send({**start, "headers": headers + [(b"etag", etag.encode("latin-1"))]})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+        if mode == "drop":
+            await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+
+from jose import jwk, jwt
+
+logger = logging.getLogger(__name__)
+
+MODES = ("inline", "thread", "process")
+
+
+class CryptoPoolSaturated(Exception):
+    pass
+
+
+# Keys constructed inside process-pool workers, keyed by their public numbers
+_worker_keys = {}
+
+
+def _verify_with_jwk(token: str, key_data: dict, algorithms: list, audience: str) -> dict:
+    cache_key = (key_data.get("kty"), key_data.get("n"), key_data.get("e"), key_data.get("x"), key_data.get("y"))
+    key = _worker_keys.get(cache_key)
+    if key is None:
+        key = _worker_keys[cache_key] = jwk.construct(key_data, algorithm=algorithms[0])
+    return jwt.decode(token, key, algorithms=algorithms, audience=audience)
+
+
+class CryptoExecutor:
+    """Runs JWT verify/sign inline, on a thread pool, or on a process pool
+
+    Offloaded calls are bounded by max_pending; beyond that callers get
+    CryptoPoolSaturated straight away instead of queueing behind the pool.
+    """
+
+    def __init__(self, mode: str = "inline", workers: Optional[int] = None, max_pending: int = 256, retry_after: int = 1):
+        if mode not in MODES:
+            raise ValueError(f"Unknown crypto execution mode {mode!r}, expected one of {MODES}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+        self._key_data = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_env(cls) -> "CryptoExecutor":
+        workers = os.getenv("CRYPTO_WORKERS")
+        return cls(
+            mode=os.getenv("CRYPTO_EXECUTION", "inline").lower(),
+            workers=int(workers) if workers else None,
+            max_pending=int(os.getenv("CRYPTO_MAX_PENDING", "256")),
+            retry_after=int(os.getenv("CRYPTO_RETRY_AFTER", "1")),
+        )
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jwt-crypto")
+            logger.info(f"Started {self.mode} crypto pool with {self.workers} workers")
+        return self._executor
+
+    async def _run(self, fn, *args, **kwargs):
+        if self.mode == "inline":
+            return fn(*args, **kwargs)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise CryptoPoolSaturated(f"{self.pending} crypto operations already pending")
+        self.pending += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args, **kwargs))
+            self.completed += 1
+            return result
+        finally:
+            self.pending -= 1
+
+    async def verify(self, token: str, key, algorithms: list, audience: str) -> dict:
+        if self.mode == "process":
+            # Key objects don't pickle, so workers rebuild (and cache) them from the JWK
+            key_data = self._key_data.get(key)
+            if key_data is None:
+                key_data = self._key_data[key] = key.to_dict()
+            return await self._run(_verify_with_jwk, token, key_data, algorithms, audience)
+        return await self._run(jwt.decode, token, key, algorithms=algorithms, audience=audience)
+
+    async def sign(self, payload: dict, secret: str, algorithm: str = "HS256") -> str:
+        return await self._run(jwt.encode, payload, secret, algorithm=algorithm)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers if self.mode != "inline" else 0,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
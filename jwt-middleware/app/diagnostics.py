@@ -0,0 +1,82 @@
+import asyncio
+import math
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List
+
+# The CRUD steps of one /runtest pass, in order
+STEPS = ("insert", "fetch", "update", "delete", "verify_deletion")
+
+
+def summarize(samples: List[float]) -> dict:
+    """Count, mean and nearest-rank percentiles of latencies in ms"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    rank = lambda q: ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(rank(0.50), 3),
+        "p90": round(rank(0.90), 3),
+        "p99": round(rank(0.99), 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+class StepTimings:
+    """Per-step latencies of one pass; the steps list matches the /runtest response"""
+
+    def __init__(self):
+        self.steps: List[dict] = []
+
+    @contextmanager
+    def step(self, operation: str):
+        record = {"operation": operation}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["ms"] = round((time.perf_counter() - started) * 1000, 3)
+            self.steps.append(record)
+
+
+async def run_passes(
+    passes: Iterable[dict],
+    run_pass: Callable[[dict], Awaitable[dict]],
+    concurrency: int,
+) -> AsyncIterator[dict]:
+    """Run run_pass() for every pass with at most `concurrency` in flight, yielding results as they finish"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(spec: dict) -> dict:
+        async with semaphore:
+            return await run_pass(spec)
+
+    tasks = [asyncio.ensure_future(bounded(spec)) for spec in passes]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # The client went away mid-stream: don't leave passes running
+        for task in tasks:
+            task.cancel()
+
+
+def summary(results: List[dict], elapsed: float) -> dict:
+    """Aggregate per-step and whole-pass latencies over finished passes"""
+    per_step: Dict[str, List[float]] = {step: [] for step in STEPS}
+    totals = []
+    for result in results:
+        for step in result["steps"]:
+            per_step.setdefault(step["operation"], []).append(step["ms"])
+        if result.get("status") != "error":
+            totals.append(sum(step["ms"] for step in result["steps"]))
+    return {
+        "passes": len(results),
+        "failed": sum(1 for result in results if result.get("status") == "error"),
+        "elapsed_ms": round(elapsed * 1000, 3),
+        "passes_per_second": round(len(results) / elapsed, 2) if elapsed > 0 else 0.0,
+        "steps": {step: summarize(samples) for step, samples in per_step.items()},
+        "pass_ms": summarize(totals),
+    }
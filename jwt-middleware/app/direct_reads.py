@@ -0,0 +1,363 @@
+import asyncio
+import json
+import logging
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+try:
+    import asyncpg
+except ImportError:  # optional: without a driver every read goes through PostgREST
+    asyncpg = None
+
+from body_rewrite import dumps
+from protection import UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+# Tables that may be read directly, with the Postgres type of each column that may be filtered or ordered on
+DEFAULT_TABLES = {"test": {"id": "integer", "data": "text", "user_id": "text"}}
+
+# PostgREST filter operators served directly; anything else is left to PostgREST
+COMPARISONS = {"eq": "=", "neq": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+PATTERNS = {"like": "LIKE", "ilike": "ILIKE"}
+IS_VALUES = {"null": "NULL", "true": "TRUE", "false": "FALSE"}
+
+# Request headers that change what PostgREST returns (counts, ranges, other schemas or formats)
+UNSUPPORTED_HEADERS = ("range", "prefer", "accept-profile")
+JSON_MEDIA_TYPES = {"", "*/*", "application/*", "application/json"}
+
+# The same statement PostgREST runs before each request, parameterized so it is prepared once per connection
+SET_REQUEST = "SELECT set_config('role', $1, true), set_config('request.jwt.claims', $2, true)"
+
+# How PostgREST maps SQLSTATEs (exact codes, then classes) to HTTP statuses; everything else is a 400
+SQLSTATE_STATUS = {
+    "42501": 403, "42P01": 404, "42883": 404, "23503": 409, "23505": 409, "25006": 405,
+    "08": 503, "53": 503, "09": 500, "25": 500, "2D": 500, "38": 500, "39": 500, "3B": 500, "40": 500,
+    "54": 500, "55": 500, "57": 500, "58": 500, "F0": 500, "HV": 500, "P0": 500, "XX": 500,
+    "0L": 403, "0P": 403, "28": 403, "P0001": 400,
+}
+
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def error_status(sqlstate: str) -> int:
+    return SQLSTATE_STATUS.get(sqlstate) or SQLSTATE_STATUS.get(sqlstate[:2]) or 400
+
+
+class DirectRead:
+    """A parsed read: the parameterized SQL, its arguments and the offset for Content-Range"""
+
+    __slots__ = ("sql", "args", "offset")
+
+    def __init__(self, sql: str, args: list, offset: int):
+        self.sql = sql
+        self.args = args
+        self.offset = offset
+
+
+class DirectResult:
+    """A response built from a direct read; chunks must be iterated or closed to release the connection"""
+
+    __slots__ = ("status", "headers", "chunks")
+
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], chunks: AsyncIterator[bytes]):
+        self.status = status
+        self.headers = headers
+        self.chunks = chunks
+
+    async def aclose(self):
+        await self.chunks.aclose()
+
+
+async def single_chunk(body: bytes) -> AsyncIterator[bytes]:
+    yield body
+
+
+class DirectReads:
+    """Serves simple PostgREST reads straight from Postgres over an asyncpg pool
+
+    plan() accepts GETs on whitelisted tables using only select (plain
+    columns), order, limit, offset and eq/neq/gt/gte/lt/lte/like/ilike/in/is
+    filters on whitelisted columns; every other request returns None and is
+    forwarded to PostgREST. Each read runs in its own read-only transaction
+    that first sets the role and request.jwt.claims from the minted token,
+    exactly as PostgREST does, so the same grants and RLS policies apply.
+    Filter values, limit and offset are bound as parameters, so one query
+    shape is one prepared statement in each connection's statement cache.
+    Rows come back in asyncpg's binary format and are written out as JSON in
+    batches of batch_rows; results longer than one batch are streamed from a
+    cursor. With count_streamed, those are counted first in the same snapshot
+    so they get a Content-Range too.
+    """
+
+    def __init__(
+        self,
+        dsn: Optional[str],
+        tables: Optional[Dict[str, Dict[str, str]]] = None,
+        schema: str = "api",
+        min_size: int = 1,
+        max_size: int = 10,
+        statement_cache_size: int = 256,
+        batch_rows: int = 500,
+        acquire_timeout: float = 5.0,
+        max_plans: int = 1024,
+        count_streamed: bool = True,
+        enabled: bool = True,
+    ):
+        if enabled and asyncpg is None:
+            logger.warning("DIRECT_READS is enabled but asyncpg is not installed; reads go through PostgREST")
+            enabled = False
+        if enabled and not dsn:
+            logger.warning("DIRECT_READS is enabled but DIRECT_READ_DSN is not set; reads go through PostgREST")
+            enabled = False
+        self.dsn = dsn
+        self.tables = DEFAULT_TABLES if tables is None else tables
+        self.schema = schema
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.batch_rows = batch_rows
+        self.acquire_timeout = acquire_timeout
+        self.max_plans = max_plans
+        self.count_streamed = count_streamed
+        self.enabled = enabled
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+        # SQL per query shape, so repeat shapes skip building the statement text
+        self._plans: Dict[tuple, str] = {}
+        self.reads = 0
+        self.fallbacks = 0
+        self.errors = 0
+        self.streamed = 0
+        self.plan_hits = 0
+
+    @classmethod
+    def from_env(cls) -> "DirectReads":
+        tables = os.getenv("DIRECT_READ_TABLES")
+        return cls(
+            dsn=os.getenv("DIRECT_READ_DSN"),
+            tables=json.loads(tables) if tables else None,
+            schema=os.getenv("DIRECT_READ_SCHEMA", "api"),
+            min_size=int(os.getenv("DIRECT_READ_POOL_MIN", "1")),
+            max_size=int(os.getenv("DIRECT_READ_POOL_MAX", "10")),
+            statement_cache_size=int(os.getenv("DIRECT_READ_STATEMENT_CACHE", "256")),
+            batch_rows=int(os.getenv("DIRECT_READ_BATCH_ROWS", "500")),
+            acquire_timeout=float(os.getenv("DIRECT_READ_ACQUIRE_TIMEOUT", "5")),
+            count_streamed=os.getenv("DIRECT_READ_COUNT_STREAMED", "true").lower() in ("1", "true", "yes"),
+            enabled=os.getenv("DIRECT_READS", "false").lower() in ("1", "true", "yes"),
+        )
+
+    def plan(self, path: str, query: str, headers) -> Optional[DirectRead]:
+        """The direct read for a GET, or None when PostgREST has to serve it"""
+        read = self._plan(path.strip("/"), query, headers)
+        if read is None:
+            self.fallbacks += 1
+        return read
+
+    def _plan(self, table: str, query: str, headers) -> Optional[DirectRead]:
+        columns = self.tables.get(table)
+        if columns is None or any(headers.get(name) for name in UNSUPPORTED_HEADERS):
+            return None
+        # PostgREST answers in the first listed format it supports
+        accept = (headers.get("accept") or "").split(",", 1)[0]
+        if accept.split(";", 1)[0].strip().lower() not in JSON_MEDIA_TYPES:
+            return None
+
+        select, order, limit, offset = None, (), None, None
+        filters, args = [], []
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name == "select":
+                select = tuple(column.strip() for column in value.split(","))
+                if select != ("*",) and not all(column in columns for column in select):
+                    return None
+            elif name == "order":
+                order = tuple(tuple(term.split(".")) for term in value.split(","))
+                if not all(self._order_term(term, columns) for term in order):
+                    return None
+            elif name in ("limit", "offset"):
+                if not value.isdigit():
+                    return None
+                limit, offset = (int(value), offset) if name == "limit" else (limit, int(value))
+            elif name in columns:
+                operator, _, operand = value.partition(".")
+                arg = self._filter_arg(operator, operand)
+                if arg is None:
+                    return None
+                filters.append((name, operator, operand if operator == "is" else None))
+                if operator != "is":
+                    args.append(arg)
+            else:
+                return None  # or/and, not., unknown columns, embedding, ...
+
+        shape = (table, select, order, tuple(filters))
+        sql = self._plans.get(shape)
+        if sql is None:
+            sql = self._build(table, columns, select, order, filters)
+            if len(self._plans) >= self.max_plans:
+                self._plans.clear()
+            self._plans[shape] = sql
+        else:
+            self.plan_hits += 1
+        return DirectRead(sql, args + [limit, offset], offset or 0)
+
+    @staticmethod
+    def _order_term(term: tuple, columns: dict) -> bool:
+        if term[0] not in columns or len(term) > 3:
+            return False
+        modifiers = term[1:]
+        if modifiers and modifiers[0] in ("asc", "desc"):
+            modifiers = modifiers[1:]
+        return modifiers in ((), ("nullsfirst",), ("nullslast",))
+
+    @staticmethod
+    def _filter_arg(operator: str, operand: str):
+        if operator in COMPARISONS:
+            return operand
+        if operator in PATTERNS:
+            return operand.replace("*", "%")
+        if operator == "in":
+            if not (operand.startswith("(") and operand.endswith(")")) or '"' in operand:
+                return None
+            return [item.strip() for item in operand[1:-1].split(",")] if operand != "()" else []
+        if operator == "is" and operand in IS_VALUES:
+            return operand
+        return None
+
+    def _build(self, table: str, columns: dict, select, order, filters) -> str:
+        target = "*" if select in (None, ("*",)) else ", ".join(quote_ident(column) for column in select)
+        conditions, n = [], 0
+        for column, operator, is_value in filters:
+            ident, cast = quote_ident(column), columns[column]
+            if operator == "is":
+                conditions.append(f"{ident} IS {IS_VALUES[is_value]}")
+                continue
+            n += 1
+            if operator in COMPARISONS:
+                conditions.append(f"{ident} {COMPARISONS[operator]} ${n}::text::{cast}")
+            elif operator in PATTERNS:
+                conditions.append(f"{ident} {PATTERNS[operator]} ${n}::text")
+            else:
+                conditions.append(f"{ident} = ANY(${n}::text[]::{cast}[])")
+        sql = f"SELECT {target} FROM {quote_ident(self.schema)}.{quote_ident(table)}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if order:
+            terms = []
+            for term in order:
+                clause = quote_ident(term[0])
+                for modifier in term[1:]:
+                    clause += {"asc": " ASC", "desc": " DESC", "nullsfirst": " NULLS FIRST", "nullslast": " NULLS LAST"}[modifier]
+                terms.append(clause)
+            sql += " ORDER BY " + ", ".join(terms)
+        return sql + f" LIMIT ${n + 1}::bigint OFFSET ${n + 2}::bigint"
+
+    async def start(self):
+        """Open the pool (also run on first use); doubles as the warm-up step"""
+        if self.pool is None:
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        statement_cache_size=self.statement_cache_size,
+                    )
+        return self.pool
+
+    async def aclose(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def execute(self, read: DirectRead, role: str, claims: dict) -> DirectResult:
+        """Run a read as role with the token's claims; raises UpstreamOverloaded when no connection is free"""
+        pool = await self.start()
+        try:
+            conn = await pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamOverloaded(f"No database connection free within {self.acquire_timeout:g}s", retry_after=1)
+
+        # Repeatable read, so a count of a streamed result sees the same rows as its cursor
+        transaction = conn.transaction(isolation="repeatable_read", readonly=True)
+        try:
+            await transaction.start()
+            await conn.execute(SET_REQUEST, role, json.dumps(claims))
+            cursor = await conn.cursor(read.sql, *read.args)
+            rows = await cursor.fetch(self.batch_rows)
+            count = len(rows)
+            if count == self.batch_rows:
+                # Streamed: the count for Content-Range costs a second run of the query
+                count = None
+                if self.count_streamed:
+                    count = await conn.fetchval(f"SELECT count(*) FROM ({read.sql}) AS streamed", *read.args)
+        except asyncpg.PostgresError as e:
+            await self._release(conn, transaction)
+            self.errors += 1
+            return self._error(e)
+        except BaseException:
+            await self._release(conn, transaction)
+            raise
+
+        self.reads += 1
+        headers = [(b"content-type", b"application/json; charset=utf-8")]
+        if count is not None:
+            content_range = f"{read.offset}-{read.offset + count - 1}/*" if count else "*/*"
+            headers.append((b"content-range", content_range.encode()))
+        if len(rows) < self.batch_rows:
+            await self._release(conn, transaction)
+            return DirectResult(200, headers, single_chunk(b"[" + self._encode(rows) + b"]"))
+        self.streamed += 1
+        return DirectResult(200, headers, self._stream(conn, transaction, cursor, rows))
+
+    async def _stream(self, conn, transaction, cursor, rows) -> AsyncIterator[bytes]:
+        try:
+            yield b"[" + self._encode(rows)
+            while True:
+                rows = await cursor.fetch(self.batch_rows)
+                if not rows:
+                    break
+                yield b"," + self._encode(rows)
+            yield b"]"
+        finally:
+            await self._release(conn, transaction)
+
+    async def _release(self, conn, transaction):
+        try:
+            if not conn.is_closed():
+                await transaction.rollback()  # Read-only: nothing to commit
+        except Exception as e:
+            logger.warning("Ending direct read transaction failed: %s", e)
+        finally:
+            await self.pool.release(conn)
+
+    @staticmethod
+    def _encode(rows) -> bytes:
+        return b",".join([dumps(dict(row)) for row in rows])
+
+    @staticmethod
+    def _error(e) -> DirectResult:
+        """The PostgREST-shaped error response for a database error"""
+        body = dumps({
+            "code": e.sqlstate,
+            "details": getattr(e, "detail", None),
+            "hint": getattr(e, "hint", None),
+            "message": getattr(e, "message", str(e)),
+        })
+        return DirectResult(error_status(e.sqlstate), [(b"content-type", b"application/json; charset=utf-8")], single_chunk(body))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "reads": self.reads,
+            "streamed": self.streamed,
+            "fallbacks": self.fallbacks,
+            "errors": self.errors,
+            "plans": len(self._plans),
+            "plan_hits": self.plan_hits,
+            "pool_size": self.pool.get_size() if self.pool is not None else 0,
+            "pool_idle": self.pool.get_idle_size() if self.pool is not None else 0,
+            "tables": sorted(self.tables),
+        }
@@ -0,0 +1,131 @@
+import asyncio
+import csv
+import io
+import json
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from body_rewrite import dumps
+
+# Export formats and the media type each is served as (Starlette adds the charset to text/csv)
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Query parameters of GET /export itself; everything else is a PostgREST filter passed through
+EXPORT_PARAMS = {"table", "format", "cursor", "chunk", "select"}
+# Paging is the export's job, so clients may not set these
+RESERVED_PARAMS = {"order", "limit", "offset"}
+
+
+class ExportError(ValueError):
+    """The export request itself is invalid"""
+
+
+class ExportUpstreamError(Exception):
+    """PostgREST answered a page with something other than 200"""
+
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f"PostgREST returned {status} for an export page")
+        self.status = status
+        self.body = body
+
+
+def parse_export_tables(value: str) -> Dict[str, str]:
+    """Parse "test=id,orders=order_id" into {"test": "id", "orders": "order_id"}: table to keyset column"""
+    tables = {}
+    for item in value.split(","):
+        if item.strip():
+            table, key = item.split("=", 1)
+            tables[table.strip()] = key.strip()
+    return tables
+
+
+def page_params(filters: list, select: Optional[str], key: str, after: Optional[str], chunk: int) -> list:
+    """Query parameters for the page of chunk rows after key value after (from the start when None)"""
+    params = list(filters)
+    if select:
+        params.append(("select", select))
+    if after is not None:
+        params.append((key, f"gt.{after}"))
+    params += [("order", f"{key}.asc"), ("limit", str(chunk))]
+    return params
+
+
+def export_select(select: Optional[str], key: str) -> Optional[str]:
+    """The select to export, with the key column added so every row carries its cursor"""
+    if not select or select.strip() == "*":
+        return None
+    columns = [column.strip() for column in select.split(",")]
+    if any(not column.isidentifier() for column in columns):
+        raise ExportError("select may only list plain columns")
+    return ",".join(columns if key in columns else [key] + columns)
+
+
+async def keyset_pages(
+    fetch_page: Callable[[Optional[str]], Awaitable[List[dict]]],
+    key: str,
+    chunk: int,
+    first: List[dict],
+) -> AsyncIterator[List[dict]]:
+    """Yield pages until a short one, fetching the next page while the current one is being sent
+
+    At most two pages are held at a time. Closing the iterator cancels the
+    page in flight.
+    """
+    page, following = first, None
+    try:
+        while page:
+            following = asyncio.ensure_future(fetch_page(str(page[-1][key]))) if len(page) == chunk else None
+            yield page
+            if following is None:
+                return
+            page, following = await following, None
+    finally:
+        if following is not None:
+            following.cancel()
+
+
+def ndjson_lines(rows: List[dict]) -> bytes:
+    return b"".join([dumps(row) + b"\n" for row in rows])
+
+
+class CsvEncoder:
+    """Encodes pages of rows as CSV, with a header row from the select or the first row's columns"""
+
+    def __init__(self, columns: Optional[List[str]] = None):
+        self.columns = columns
+        self._header_sent = False
+
+    def header(self) -> bytes:
+        if self._header_sent or self.columns is None:
+            return b""
+        self._header_sent = True
+        return self._encode([self.columns])
+
+    def __call__(self, rows: List[dict]) -> bytes:
+        if self.columns is None:
+            self.columns = list(rows[0])
+        return self.header() + self._encode([[self._cell(row.get(column)) for column in self.columns] for row in rows])
+
+    @staticmethod
+    def _cell(value):
+        if value is None:
+            return ""
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, separators=(",", ":"))
+        return value
+
+    @staticmethod
+    def _encode(lines: list) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(lines)
+        return buffer.getvalue().encode()
+
+
+async def encode_pages(pages: AsyncIterator[List[dict]], encode: Callable[[List[dict]], bytes], prefix: bytes = b"") -> AsyncIterator[bytes]:
+    """One chunk per page; the pages iterator is closed when the client goes away"""
+    try:
+        if prefix:
+            yield prefix
+        async for page in pages:
+            yield encode(page)
+    finally:
+        await pages.aclose()
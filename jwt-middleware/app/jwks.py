@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, Optional
+
+import httpx
+from jose import jwk, jwt
+
+from shared_cache import SharedCache
+
+logger = logging.getLogger(__name__)
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class UnknownKeyError(Exception):
+    pass
+
+
+class JWKSManager:
+    """Key set indexed by kid, refreshed in the background and on unknown kids
+
+    Known keys are served from memory without ever awaiting a fetch. A token
+    with an unknown kid triggers one on-demand refetch (shared by concurrent
+    callers and rate-limited by min_refetch_interval) to pick up rotated keys.
+    With a shared cache, the key set one worker fetched is loaded by the others
+    instead of each of them asking Authentik.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        client: Callable[[], httpx.AsyncClient],
+        refresh_interval: float = 300.0,
+        min_refetch_interval: float = 10.0,
+        max_refresh_interval: float = 3600.0,
+        default_algorithm: str = "RS256",
+        clock: Callable[[], float] = time.monotonic,
+        shared: Optional[SharedCache] = None,
+    ):
+        self.url = url
+        self.shared = shared
+        self._client = client
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.max_refresh_interval = max_refresh_interval
+        self.default_algorithm = default_algorithm
+        self.clock = clock
+        self.keys: Dict[str, object] = {}
+        self.etag: Optional[str] = None
+        self._document: Optional[dict] = None
+        self.next_refresh = 0.0
+        self.last_fetch: Optional[float] = None
+        self._fetching: Optional[asyncio.Future] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.fetches = 0
+        self.not_modified = 0
+        self.fetch_errors = 0
+        self.unknown_kid_refetches = 0
+        self.rate_limited = 0
+        self.shared_loads = 0
+
+    @classmethod
+    def from_env(cls, url: str, client: Callable[[], httpx.AsyncClient], shared: Optional[SharedCache] = None) -> "JWKSManager":
+        return cls(
+            url,
+            client,
+            refresh_interval=float(os.getenv("JWKS_REFRESH_INTERVAL", "300")),
+            min_refetch_interval=float(os.getenv("JWKS_MIN_REFETCH_INTERVAL", "10")),
+            shared=shared,
+        )
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.keys)
+
+    def load(self, jwks: dict):
+        """Replace the key set, constructing every signing key once"""
+        keys = {}
+        for key in jwks.get("keys", []):
+            if key.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[key.get("kid", "")] = jwk.construct(key, algorithm=key.get("alg", self.default_algorithm))
+            except Exception as e:
+                logger.error(f"Skipping unusable JWK {key.get('kid')}: {str(e)}")
+        if not keys:
+            raise ValueError("No keys found in JWKS")
+        self.keys = keys
+
+    async def get_key(self, kid: Optional[str]):
+        """Return the key for kid, fetching the key set only if kid is unknown"""
+        key = self._lookup(kid)
+        if key is not None:
+            return key
+
+        if self.keys:
+            # Unknown kid with a warm key set: maybe a rotation, but don't let bad tokens hammer Authentik
+            if self.last_fetch is not None and self.clock() - self.last_fetch < self.min_refetch_interval:
+                self.rate_limited += 1
+                raise UnknownKeyError(f"Unknown signing key: {kid}")
+            self.unknown_kid_refetches += 1
+        await self.refresh(from_origin=bool(self.keys))
+
+        key = self._lookup(kid)
+        if key is None:
+            raise UnknownKeyError(f"Unknown signing key: {kid}")
+        return key
+
+    async def get_key_for_token(self, token: str):
+        return await self.get_key(jwt.get_unverified_header(token).get("kid"))
+
+    def _lookup(self, kid: Optional[str]):
+        if kid is None and len(self.keys) == 1:
+            return next(iter(self.keys.values()))
+        return self.keys.get(kid)
+
+    async def refresh(self, from_origin: bool = False):
+        """Fetch the key set; concurrent callers share a single request
+
+        Unless from_origin is set, a key set in the shared cache is used as is.
+        """
+        if self._fetching is None:
+            self._fetching = asyncio.ensure_future(self._fetch(from_origin))
+            self._fetching.add_done_callback(self._fetch_done)
+        await asyncio.shield(self._fetching)
+
+    def _fetch_done(self, task: asyncio.Future):
+        self._fetching = None
+        if not task.cancelled() and task.exception() is not None:
+            self.fetch_errors += 1
+
+    async def _fetch(self, from_origin: bool = False):
+        if self.shared is not None and await self._load_shared(from_origin):
+            return
+        headers = {"If-None-Match": self.etag} if self.etag and self.keys else {}
+        self.last_fetch = self.clock()
+        self.fetches += 1
+        response = await self._client().get(self.url, headers=headers)
+        if response.status_code == 304:
+            self.not_modified += 1
+        elif response.status_code == 200:
+            self._document = response.json()
+            self.load(self._document)
+            self.etag = response.headers.get("etag")
+            logger.info(f"Loaded JWKS with key ids: {list(self.keys)}")
+        else:
+            logger.error(f"Failed to fetch JWKS: {response.status_code}")
+            raise RuntimeError(f"Failed to fetch JWKS: {response.status_code}")
+        delay = self._refresh_delay(response.headers.get("cache-control"))
+        self.next_refresh = self.clock() + delay
+        if self.shared is not None and self._document is not None:
+            document = {"jwks": self._document, "etag": self.etag, "expires_at": time.time() + delay}
+            await self.shared.set("jwks", self.url, json.dumps(document).encode(), delay)
+
+    async def _load_shared(self, from_origin: bool) -> bool:
+        """Use the shared key set if it's new to us, or still fresh and a refetch wasn't asked for"""
+        data = await self.shared.get("jwks", self.url)
+        if data is None:
+            return False
+        document = json.loads(data)
+        if self.keys and document["etag"] == self.etag:
+            if from_origin:
+                return False
+        else:
+            self.load(document["jwks"])
+            self._document = document["jwks"]
+            self.etag = document["etag"]
+            self.shared_loads += 1
+        self.next_refresh = self.clock() + max(document["expires_at"] - time.time(), self.min_refetch_interval)
+        return True
+
+    def _refresh_delay(self, cache_control: Optional[str]) -> float:
+        match = _MAX_AGE.search(cache_control or "")
+        delay = float(match.group(1)) if match else self.refresh_interval
+        return min(max(delay, self.min_refetch_interval), self.max_refresh_interval)
+
+    async def start(self):
+        """Warm the key set and keep it fresh in the background"""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error(f"Initial JWKS fetch failed: {str(e)}")
+        finally:
+            # Also when the caller gave up waiting (a warm-up timeout cancels us here)
+            if self._refresh_task is None:
+                self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+    async def _refresh_loop(self):
+        while True:
+            delay = self.next_refresh - self.clock() if self.keys else self.min_refetch_interval
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Background JWKS refresh failed: {str(e)}")
+                self.next_refresh = self.clock() + self.min_refetch_interval
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "kids": list(self.keys),
+            "etag": self.etag,
+            "seconds_until_refresh": round(max(self.next_refresh - self.clock(), 0), 1),
+            "background_refresh": self._refresh_task is not None,
+            "fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "fetch_errors": self.fetch_errors,
+            "unknown_kid_refetches": self.unknown_kid_refetches,
+            "rate_limited": self.rate_limited,
+            "shared_loads": self.shared_loads,
+        }
@@ -0,0 +1,134 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime, UTC
+
+# Whether the current request was picked for detailed debug logging
+debug_sampled = contextvars.ContextVar("debug_sampled", default=False)
+
+SENSITIVE_HEADERS = {"authorization", "cookie", "set-cookie", "proxy-authorization", "apikey", "x-api-key"}
+SENSITIVE_KEYS = {"token", "access_token", "refresh_token", "id_token", "secret", "jwt_secret", "password"}
+_JWT = re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]*")
+
+access_logger = logging.getLogger("jwt_middleware.access")
+
+# Fraction of requests (0..1) that log debug details such as headers and payloads
+DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+
+
+def _env_level(name: str, default: str) -> int:
+    value = os.getenv(name, default).upper()
+    level = logging.getLevelName(value)
+    return level if isinstance(level, int) else logging.getLevelName(default)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; dict messages are merged in as fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, UTC).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Configure levels and formats from LOG_LEVEL, HTTPX_LOG_LEVEL, LOG_FORMAT and ACCESS_LOG"""
+    handler = logging.StreamHandler()  # This outputs to stdout/stderr for Docker logs
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(_env_level("LOG_LEVEL", "INFO"))
+
+    logging.getLogger("httpx").setLevel(_env_level("HTTPX_LOG_LEVEL", "WARNING"))
+    logging.getLogger("httpcore").setLevel(_env_level("HTTPX_LOG_LEVEL", "WARNING"))
+
+    access_handler = logging.StreamHandler()
+    access_handler.setFormatter(JsonFormatter())
+    access_logger.handlers = [access_handler]
+    access_logger.propagate = False
+    enabled = os.getenv("ACCESS_LOG", "true").lower() in ("1", "true", "yes")
+    access_logger.setLevel(logging.INFO if enabled else logging.CRITICAL + 1)
+
+
+def redact(value: str) -> str:
+    return _JWT.sub("[REDACTED]", value)
+
+
+def redact_headers(headers) -> dict:
+    return {
+        name: "[REDACTED]" if name.lower() in SENSITIVE_HEADERS else redact(value)
+        for name, value in headers.items()
+    }
+
+
+def redact_claims(claims: dict) -> dict:
+    return {key: "[REDACTED]" if key.lower() in SENSITIVE_KEYS else value for key, value in claims.items()}
+
+
+def debug_details(logger: logging.Logger, msg: str, *args):
+    """Log at DEBUG only for sampled requests; args may be callables, evaluated lazily"""
+    if debug_sampled.get() and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *(arg() if callable(arg) else arg for arg in args))
+
+
+class AccessLogMiddleware:
+    """Pure ASGI middleware emitting one structured JSON access line per HTTP request
+
+    It also decides, once per request, whether debug details are sampled
+    (DEBUG_SAMPLE_RATE unless a rate is given).
+    """
+
+    def __init__(self, app, sample_rate: float = None):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        rate = DEBUG_SAMPLE_RATE if self.sample_rate is None else self.sample_rate
+        sampled = rate >= 1.0 or (rate > 0 and random.random() < rate)
+        token = debug_sampled.set(sampled)
+        started = time.perf_counter()
+        status = 500
+        sent_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            debug_sampled.reset(token)
+            if access_logger.isEnabledFor(logging.INFO):
+                state = scope.get("state") or {}
+                access_logger.info({
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+                    "bytes": sent_bytes,
+                    "user": state.get("user_id"),
+                    "upstream_status": state.get("upstream_status"),
+                })
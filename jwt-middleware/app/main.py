@@ -1,30 +1,142 @@
 from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from jose import jwt, jwk
-from jose.utils import base64url_decode
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from jose import JWTError, jwt
+from jose.utils import base64url_decode, base64url_encode
+from contextlib import asynccontextmanager
+import asyncio
+import hmac
 import httpx
 import os
-from typing import Optional
+import time
+from typing import AsyncIterator, Optional
 import json
 from datetime import datetime, UTC
 import logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()  # This outputs to stdout/stderr for Docker logs
-    ]
+from batch import OPERATION_HEADERS, BatchError, BatchOperation, BatchRequest, run_batch
+from body_rewrite import dumps as dump_json, is_json_content_type, loads as load_json, stamp_rows, stamp_user_id
+from collapse import RequestCollapser, SharedResponse, TooLargeToShare, cache_control, etag_matches, read_shareable
+from compression import Compression, CompressionMiddleware
+from conditional import Conditional, ConditionalMiddleware
+from crypto_pool import CryptoExecutor, CryptoPoolSaturated
+from diagnostics import StepTimings, run_passes, summary
+from direct_reads import DirectReads, DirectResult
+from export import (
+    EXPORT_PARAMS, FORMATS as EXPORT_FORMATS, RESERVED_PARAMS as EXPORT_RESERVED_PARAMS, CsvEncoder, ExportError,
+    ExportUpstreamError, encode_pages, export_select, keyset_pages, ndjson_lines, page_params, parse_export_tables,
 )
+from jwks import JWKSManager
+from logs import AccessLogMiddleware, configure_logging, debug_details, redact_claims, redact_headers
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics, MetricsMiddleware
+from profiling import Profiling, ProfilingError, ProfilingMiddleware
+from protection import UpstreamGuard, UpstreamUnavailable
+from proxy_core import HOP_BY_HOP_HEADERS, ProxyCoreMiddleware, ProxyRequest, forwarded_headers, send_chunks, send_response, send_streamed
+from roles import RoleBatcher, RoleCache
+from shared_cache import shared_cache_from_env
+from token_cache import MintedTokenCache, TokenCache, TokenEntry
+from upstream import UpstreamClients
+from warmup import Warmup
+
+# Configure logging (LOG_LEVEL, HTTPX_LOG_LEVEL, LOG_FORMAT, ACCESS_LOG)
+configure_logging()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
-# Add debug logging for httpx
-logging.getLogger("httpx").setLevel(logging.DEBUG)
+# Configuration
+POSTGREST_URL = os.getenv("POSTGREST_URL", "http://postgrest:3000")
+POSTGREST_JWT_SECRET = os.getenv("PGRST_JWT_SECRET", "reallyreallyreallyreallyverysafesecret")
+AUTHENTIK_URL = os.getenv("AUTHENTIK_URL", "https://authentik.tekonline.com.au")
+JWKS_URL = f"{AUTHENTIK_URL}/application/o/localparts/jwks/"
+# Stream PostgREST responses through unchanged instead of re-serializing them as JSON
+PROXY_STREAMING = os.getenv("PROXY_STREAMING", "true").lower() in ("1", "true", "yes")
+# asgi: forward through ProxyCoreMiddleware, ahead of FastAPI's router; fastapi: the catch-all route
+PROXY_CORE = os.getenv("PROXY_CORE", "asgi").lower()
+# per_user: every Authentik sub gets its own Postgres role (provisioned on first sight)
+# shared: minted tokens carry SHARED_ROLE and RLS matches rows on the sub claim (db/02-claim-based-rls.sql)
+ROLE_MODE = os.getenv("ROLE_MODE", "per_user").lower()
+SHARED_ROLE = os.getenv("SHARED_ROLE", "authenticated")
+# Upper bound on users x iterations for one POST /runtest
+RUNTEST_MAX_PASSES = int(os.getenv("RUNTEST_MAX_PASSES", "1000"))
+# Upper bound on the operations accepted by one POST /batch
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "100"))
+# Tables GET /export may walk, each with the unique column it pages on
+EXPORT_TABLES = parse_export_tables(os.getenv("EXPORT_TABLES", "test=id"))
+# Rows per upstream page of an export, and the most a client may ask for with ?chunk=
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_MAX_CHUNK_ROWS = int(os.getenv("EXPORT_MAX_CHUNK_ROWS", "50000"))
+
+# Pooled upstream clients shared by every request for the lifetime of the app
+upstream = UpstreamClients.from_env(POSTGREST_URL)
+
+# Concurrency limit, bounded queue, deadlines and circuit breaker for forwarded requests (POSTGREST_CONCURRENCY)
+upstream_guard = UpstreamGuard.from_env()
+
+# Whitelisted GETs served straight from Postgres over asyncpg instead of through PostgREST (DIRECT_READS)
+direct_reads = DirectReads.from_env()
+
+# Cross-process tier for token, role and JWKS state when running several workers (CACHE_BACKEND)
+shared_cache = shared_cache_from_env()
+
+# Authentik signing keys indexed by kid, refreshed in the background
+jwks_manager = JWKSManager.from_env(JWKS_URL, lambda: upstream.jwks.client, shared_cache)
+
+# Where RS256 verification and HS256 signing run: inline, thread pool or process pool
+crypto = CryptoExecutor.from_env()
+
+# Per-stage timings and counters served at /metrics (METRICS_ENABLED=false turns them off)
+metrics = Metrics.from_env()
+
+# Negotiated gzip/br/zstd response compression (COMPRESSION_ENABLED, COMPRESSION_MIN_BYTES)
+compression = Compression.from_env()
+
+# ETags (passed through or generated from small bodies) and 304s for GETs (ETAG_ENABLED, ETAG_MAX_BYTES)
+conditional = Conditional.from_env()
+
+# Sampled request profiles, whole-process profiles, loop lag and tracemalloc behind X-Profiling-Token (PROFILING_ENABLED)
+profiling = Profiling.from_env()
 
-app = FastAPI()
+# Shared secret for POST /debug/roles/invalidate, sent as X-Admin-Token; unset, the endpoint answers 404
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or None
+
+ROLE_CACHE_WARMUP = os.getenv("ROLE_CACHE_WARMUP", "false").lower() in ("1", "true", "yes")
+
+# Background JWKS, connection pool, role and crypto warm-up that /ready waits for (WARMUP_ENABLED)
+warmup = Warmup.from_env()
+# How long /ready waits for PostgREST before reporting it unreachable
+READY_UPSTREAM_TIMEOUT = float(os.getenv("READY_UPSTREAM_TIMEOUT", "2"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    profiling.start()
+    if warmup.enabled:
+        warmup.start(warmup_steps())
+    else:
+        await jwks_manager.start()
+        if ROLE_CACHE_WARMUP and ROLE_MODE != "shared":
+            await warm_role_cache()
+    yield
+    profiling.stop()
+    await warmup.stop()
+    await jwks_manager.stop()
+    await upstream.aclose()
+    await direct_reads.aclose()
+    crypto.shutdown()
+    if shared_cache is not None:
+        await shared_cache.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# Innermost middleware: forwards everything FastAPI doesn't serve, after CORS, logging and metrics
+app.add_middleware(
+    ProxyCoreMiddleware,
+    forward=lambda request, send: forward_request(request, send),
+    local=lambda: LOCAL_PATHS if PROXY_CORE == "asgi" else None,
+)
+
+# ETags are computed on the identity body, then the body is compressed; the access log sees bytes on the wire
+app.add_middleware(ConditionalMiddleware, conditional=lambda: conditional)
+app.add_middleware(CompressionMiddleware, compression=lambda: compression)
 
 # CORS middleware configuration
 app.add_middleware(
@@ -35,92 +147,165 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuration
-POSTGREST_URL = os.getenv("POSTGREST_URL", "http://postgrest:3000")
-POSTGREST_JWT_SECRET = os.getenv("PGRST_JWT_SECRET", "reallyreallyreallyreallyverysafesecret")
-AUTHENTIK_URL = os.getenv("AUTHENTIK_URL", "https://authentik.tekonline.com.au")
-JWKS_URL = f"{AUTHENTIK_URL}/application/o/localparts/jwks/"
+# One structured access line per request; also picks which requests log debug details
+app.add_middleware(AccessLogMiddleware)
+app.add_middleware(MetricsMiddleware, metrics=lambda: metrics)
+# Outermost, so a sampled request's profile covers every middleware as well as the handler
+app.add_middleware(ProfilingMiddleware, profiling=lambda: profiling)
 
-# Cache the public key to avoid frequent JWKS requests
-public_key_cache = None
+# Cache verified Authentik tokens so repeat requests skip RS256 verification and re-signing
+token_cache = TokenCache.from_env(shared_cache)
 
-def get_public_key(jwks_data):
-    """Convert JWKS data to a public key for JWT validation"""
-    keys = jwks_data.get('keys', [])
-    if not keys:
-        raise ValueError("No keys found in JWKS")
-    
-    key = keys[0]  # Use the first key
-    return jwk.construct(key)
-
-async def get_authentik_public_key():
-    global public_key_cache
-    if public_key_cache is None:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(JWKS_URL)
-            if response.status_code != 200:
-                logger.error(f"Failed to fetch JWKS: {response.status_code}")
-                raise HTTPException(status_code=500, detail="Failed to fetch JWKS")
-            
-            jwks = response.json()
-            # Get the first key from the JWKS
-            key = jwks['keys'][0]
-            public_key_cache = jwt.PyJWK(key)
-            logger.info("Successfully fetched and cached Authentik public key")
-    return public_key_cache
+# Concurrent identical GETs of one user share an upstream call, optionally micro-cached (COLLAPSE_GETS)
+collapser = RequestCollapser.from_env()
+
+# One signed PostgREST token per user, re-minted in the background shortly before it expires
+minted_tokens = MintedTokenCache.from_env()
+
+# Users whose database role is known to exist, so create_user_role runs once per user
+role_cache = RoleCache.from_env(shared_cache)
+
+def register_collectors(metrics: Metrics) -> Metrics:
+    """Read cache, pool and crypto stats when /metrics is scraped"""
+    metrics.collect("token_cache", lambda: token_cache.stats(), counters=("hits", "misses", "evictions", "expirations", "shared_hits"))
+    metrics.collect("minted_tokens", lambda: minted_tokens.stats(), counters=("hits", "mints", "refreshes", "coalesced", "failures"))
+    metrics.collect("role_cache", lambda: role_cache.stats(), counters=("hits", "provisions", "coalesced", "failures", "shared_hits"))
+    metrics.collect("jwks", lambda: jwks_manager.stats(), counters=("fetches", "not_modified", "fetch_errors", "unknown_kid_refetches", "rate_limited", "shared_loads"))
+    metrics.collect("role_batch", lambda: role_batcher.stats(), counters=("batches", "batched_users", "failed_batches"))
+    metrics.collect("collapse", lambda: collapser.stats(), counters=("upstream_calls", "collapsed", "cache_hits", "invalidated", "too_large"))
+    metrics.collect("crypto", lambda: crypto.stats(), counters=("completed", "rejected"))
+    metrics.collect("warmup", lambda: warmup.stats())
+    metrics.collect("postgrest_guard", lambda: upstream_guard.stats(), counters=("admitted", "queued", "rejected", "queue_timeouts", "decreases", "deadline_exceeded"))
+    metrics.collect("postgrest_circuit", lambda: upstream_guard.breaker.stats(), counters=("opens", "rejected"))
+    metrics.collect("compression", lambda: compression.stats(), counters=("compressed_total", "skipped_small", "bytes_in", "bytes_out", "seconds"))
+    for encoding in compression.encodings:
+        metrics.collect(
+            "compression_encoding",
+            lambda encoding=encoding: {"responses": compression.compressed.get(encoding, 0)},
+            counters=("responses",),
+            labels={"encoding": encoding}
+        )
+    metrics.collect("etag", lambda: conditional.stats(), counters=("generated", "passed_through", "not_modified", "too_large"))
+    metrics.collect("profiling", lambda: profiling.stats(), counters=("sampled_requests", "samples", "sampler_seconds"))
+    metrics.collect("event_loop", lambda: profiling.monitor.stats(), counters=("checks", "slow_callbacks"))
+    metrics.collect("direct_reads", lambda: direct_reads.stats(), counters=("reads", "streamed", "fallbacks", "errors", "plan_hits"))
+    if shared_cache is not None:
+        metrics.collect("shared_cache", lambda: shared_cache.stats(), counters=("hits", "misses", "writes", "errors"))
+    for name in ("postgrest", "jwks"):
+        metrics.collect(
+            "upstream",
+            lambda name=name: getattr(upstream, name).stats(),
+            counters=("requests_total", "connections_opened"),
+            labels={"upstream": name}
+        )
+    return metrics
+
+register_collectors(metrics)
+
+async def verify_token(token: str) -> TokenEntry:
+    """Validate an Authentik token and mint its PostgREST token, reusing cached results"""
+    cached = await token_cache.fetch(token)
+    if cached is not None and not minted_tokens.enabled:
+        return cached
 
-async def transform_token(token: str) -> str:
-    global public_key_cache
     try:
-        # Get the public key from Authentik's JWKS
-        if not public_key_cache:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(JWKS_URL)
-                jwks = response.json()
-                public_key_cache = get_public_key(jwks)
-                logger.info("Successfully fetched and cached JWKS")
+        if cached is not None:
+            # Hand out the user's current minted token, which may have been refreshed since
+            new_token, payload = await minted_token_for(cached.claims)
+            if new_token == cached.token:
+                return cached
+            return await token_cache.store(token, cached.claims, new_token, payload) or TokenEntry(cached.claims, new_token, payload, payload["exp"])
+
+        # Get the signing key for this token's kid from Authentik's JWKS
+        with metrics.time("jwks_key"):
+            public_key = await jwks_manager.get_key_for_token(token)
 
         # Validate the Authentik token
         try:
-            decoded = jwt.decode(
-                token,
-                public_key_cache,
-                algorithms=["RS256"],
-                audience="localparts"
-            )
-            logger.info(f"Successfully validated Authentik token for user: {decoded.get('sub')}")
+            with metrics.time("verify"):
+                decoded = await crypto.verify(
+                    token,
+                    public_key,
+                    algorithms=["RS256"],
+                    audience="localparts"
+                )
+            logger.debug("Validated Authentik token for user: %s", decoded.get("sub"))
+        except CryptoPoolSaturated:
+            raise
         except Exception as e:
-            logger.error(f"Failed to validate Authentik token: {str(e)}")
+            logger.warning("Failed to validate Authentik token: %s", e)
             raise HTTPException(status_code=401, detail="Invalid Authentik token")
 
-        # Create a new token for PostgREST with required claims
-        payload = {
-            "role": decoded.get("sub"),  # Use the user's ID as the role
-            "sub": decoded.get("sub"),  # Keep the original subject
-            "email": decoded.get("email"),
-            "iat": int(datetime.now(UTC).timestamp()),
-            "exp": int(datetime.now(UTC).timestamp() + 3600),
-            "aud": "localparts"
-        }
-        
-        logger.info(f"Created PostgREST JWT payload: {json.dumps(payload, indent=2)}")
-        
-        # Sign with PostgREST secret
-        token = jwt.encode(
+        new_token, payload = await minted_token_for(decoded)
+        return await token_cache.store(token, decoded, new_token, payload) or TokenEntry(decoded, new_token, payload, payload["exp"])
+    except CryptoPoolSaturated as e:
+        logger.warning("Rejecting request, crypto pool saturated: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy, retry later",
+            headers={"Retry-After": str(crypto.retry_after)}
+        )
+    except Exception as e:
+        logger.warning("Error during token transformation: %s", e)
+        raise HTTPException(status_code=401, detail=f"Token transformation failed: {str(e)}")
+
+async def minted_token_for(decoded: dict) -> tuple:
+    """The user's PostgREST (token, payload), signed once per user and reused until near expiry"""
+    role = SHARED_ROLE if ROLE_MODE == "shared" else decoded.get("sub")  # Per-user mode: the user's ID is the role
+    return await minted_tokens.get((role, decoded.get("sub"), decoded.get("email")), lambda: mint_token(decoded, role))
+
+async def mint_token(decoded: dict, role: str) -> tuple:
+    """Create and sign a new PostgREST token with the required claims"""
+    payload = {
+        "role": role,
+        "sub": decoded.get("sub"),  # Keep the original subject
+        "email": decoded.get("email"),
+        "iat": int(datetime.now(UTC).timestamp()),
+        "exp": int(datetime.now(UTC).timestamp() + 3600),
+        "aud": "localparts"
+    }
+    
+    debug_details(logger, "Created PostgREST JWT payload: %s", lambda: json.dumps(redact_claims(payload)))
+    
+    # Sign with PostgREST secret
+    with metrics.time("sign"):
+        new_token = await crypto.sign(
             payload,
             POSTGREST_JWT_SECRET,
             algorithm="HS256"
         )
-        logger.info("Successfully created PostgREST JWT token")
-        return token
-    except Exception as e:
-        logger.error(f"Error during token transformation: {str(e)}")
-        raise HTTPException(status_code=401, detail=f"Token transformation failed: {str(e)}")
+    logger.debug("Created PostgREST JWT token")
+    return new_token, payload
+
+async def transform_token(token: str) -> str:
+    return (await verify_token(token)).token
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    """200 once the warm-up has finished, signing keys are loaded and PostgREST answers; 503 until then"""
+    checks = {
+        "warmup": warmup.done or not warmup.enabled,
+        "jwks": jwks_manager.ready,
+        "postgrest": await postgrest_reachable(),
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "not ready", "checks": checks, "warmup": warmup.stats()},
+        status_code=200 if ready else 503,
+    )
+
+async def postgrest_reachable() -> bool:
+    try:
+        response = await upstream.postgrest.client.head(f"{POSTGREST_URL}/", timeout=READY_UPSTREAM_TIMEOUT)
+        return response.status_code < 500
+    except httpx.HTTPError as e:
+        logger.warning(f"PostgREST readiness probe failed: {str(e)}")
+        return False
+
 @app.get("/debug/settings")
 async def debug_settings():
     return {
@@ -131,6 +316,44 @@ async def debug_settings():
         }
     }
 
+@app.get("/debug/pool")
+async def debug_pool():
+    return upstream.stats()
+
+@app.get("/debug/crypto")
+async def debug_crypto():
+    return crypto.stats()
+
+@app.get("/debug/jwks")
+async def debug_jwks():
+    return jwks_manager.stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/debug/collapse")
+async def debug_collapse():
+    return collapser.stats()
+
+@app.get("/debug/upstream-guard")
+async def debug_upstream_guard():
+    return upstream_guard.stats()
+
+@app.get("/debug/compression")
+async def debug_compression():
+    return {"compression": compression.stats(), "etag": conditional.stats()}
+
+@app.get("/debug/direct-reads")
+async def debug_direct_reads():
+    return direct_reads.stats()
+
+@app.get("/debug/token-cache")
+async def debug_token_cache():
+    return {**token_cache.stats(), "minted": minted_tokens.stats()}
+
 @app.get("/debug/jwt")
 async def debug_jwt(authorization: Optional[str] = Header(None)):
     response_data = {
@@ -182,35 +405,67 @@ async def debug_jwt(authorization: Optional[str] = Header(None)):
 
 @app.get("/test-connection")
 async def test_connection():
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{POSTGREST_URL}/")
-            logger.info(f"Test connection response: {response.status_code}")
-            return {"status": "success", "response": response.json()}
-        except Exception as e:
-            logger.error(f"Test connection error: {str(e)}")
-            return {"status": "error", "message": str(e)}
+    try:
+        response = await upstream.postgrest.client.get(f"{POSTGREST_URL}/")
+        logger.info(f"Test connection response: {response.status_code}")
+        return {"status": "success", "response": response.json()}
+    except Exception as e:
+        logger.error(f"Test connection error: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+def create_authenticator_token() -> str:
+    """Create a JWT token for the authenticator role"""
+    return jwt.encode(
+        {
+            "role": "authenticator",
+            "iat": int(datetime.now(UTC).timestamp()),
+            "exp": int(datetime.now(UTC).timestamp() + 3600),
+            "aud": "localparts"
+        },
+        POSTGREST_JWT_SECRET,
+        algorithm="HS256"
+    )
 
 async def ensure_user_role_exists(user_id: str):
-    """Ensure the user's role exists in the database"""
-    async with httpx.AsyncClient() as client:
-        try:
-            # Create a JWT token for the authenticator role
-            authenticator_token = jwt.encode(
-                {
-                    "role": "authenticator",
-                    "iat": int(datetime.now(UTC).timestamp()),
-                    "exp": int(datetime.now(UTC).timestamp() + 3600),
-                    "aud": "localparts"
-                },
-                POSTGREST_JWT_SECRET,
-                algorithm="HS256"
-            )
-            
-            logger.info(f"Attempting to create role for user: {user_id}")
-            logger.info(f"Using authenticator token: {authenticator_token}")
-            
-            # Call the create_user_role function
+    """Ensure the user's role exists in the database, provisioning it at most once per user"""
+    if ROLE_MODE == "shared":
+        return  # Everyone runs as SHARED_ROLE, which always exists
+    with metrics.time("role_check"):
+        await role_cache.ensure(user_id, role_batcher.provision if role_batcher.enabled else create_user_role)
+
+async def create_user_roles(user_ids: list):
+    """Create the roles of a batch of users with one call to api.create_user_roles"""
+    with metrics.time("create_user_roles"):
+        response = await upstream.postgrest.client.post(
+            f"{POSTGREST_URL}/rpc/create_user_roles",
+            headers={
+                "Authorization": f"Bearer {create_authenticator_token()}",
+                "Content-Type": "application/json"
+            },
+            json={"user_ids": user_ids}
+        )
+    if response.status_code == 404:
+        # Database predates api.create_user_roles: provision one by one
+        logger.warning("api.create_user_roles not found, provisioning %d roles individually", len(user_ids))
+        await asyncio.gather(*(create_user_role(user_id) for user_id in user_ids))
+        return
+    if response.status_code not in [200, 204]:
+        raise Exception(f"Failed to create user roles: {response.text}")
+    logger.info("Provisioned %d roles, %d new", len(user_ids), len(response.json()) if response.content else 0)
+
+# Coalesces concurrent first-seen users into one create_user_roles call (ROLE_BATCH_SIZE=1 disables)
+role_batcher = RoleBatcher.from_env(lambda user_ids: create_user_roles(user_ids))
+
+async def create_user_role(user_id: str):
+    """Create the user's role in the database"""
+    client = upstream.postgrest.client
+    try:
+        authenticator_token = create_authenticator_token()
+        
+        logger.info("Attempting to create role for user: %s", user_id)
+        
+        # Call the create_user_role function
+        with metrics.time("create_user_role"):
             response = await client.post(
                 f"{POSTGREST_URL}/rpc/create_user_role",
                 headers={
@@ -220,223 +475,796 @@ async def ensure_user_role_exists(user_id: str):
                 },
                 json={"user_id": user_id}
             )
-            
-            logger.info(f"Response status: {response.status_code}")
-            logger.info(f"Response headers: {response.headers}")
-            logger.info(f"Response body: {response.text}")
-            
-            # Accept both 200 and 204 as success
-            if response.status_code not in [200, 204]:
-                logger.error(f"Failed to create user role: {response.text}")
-                raise Exception(f"Failed to create user role: {response.text}")
-            logger.info(f"Successfully ensured role exists for user: {user_id}")
-        except Exception as e:
-            logger.error(f"Error ensuring user role exists: {str(e)}")
-            raise
+        
+        debug_details(
+            logger, "create_user_role response %s headers=%s body=%s",
+            response.status_code, lambda: redact_headers(response.headers), lambda: response.text
+        )
+        
+        # Accept both 200 and 204 as success
+        if response.status_code not in [200, 204]:
+            logger.error(f"Failed to create user role: {response.text}")
+            raise Exception(f"Failed to create user role: {response.text}")
+        logger.info("Successfully ensured role exists for user: %s", user_id)
+    except Exception as e:
+        logger.error(f"Error ensuring user role exists: {str(e)}")
+        raise
+
+async def warm_role_cache():
+    """Preload the role cache with users already provisioned in basic_auth.users"""
+    try:
+        response = await upstream.postgrest.client.get(
+            f"{POSTGREST_URL}/rpc/provisioned_users",
+            headers={"Authorization": f"Bearer {create_authenticator_token()}"}
+        )
+        if response.status_code != 200:
+            logger.error(f"Failed to load provisioned users: {response.status_code} {response.text}")
+            return
+        user_ids = [row["id"] for row in response.json()]
+        role_cache.mark_known(user_ids)
+        logger.info(f"Warmed role cache with {len(user_ids)} provisioned users")
+    except Exception as e:
+        logger.error(f"Error warming role cache: {str(e)}")
+
+def warmup_steps() -> dict:
+    steps = {"jwks": warm_jwks, "postgrest_pool": warm_connections, "crypto": warm_crypto}
+    if ROLE_CACHE_WARMUP and ROLE_MODE != "shared":
+        steps["roles"] = warm_role_cache
+    if direct_reads.enabled:
+        steps["direct_reads"] = direct_reads.start
+    return steps
+
+async def warm_jwks():
+    """Fetch and construct the signing keys, then keep them fresh in the background"""
+    await jwks_manager.start()
+    if not jwks_manager.ready:
+        raise RuntimeError("No signing keys loaded")
+
+async def warm_connections():
+    """Open WARMUP_CONNECTIONS keep-alive connections to PostgREST ahead of the first requests"""
+    client = upstream.postgrest.client
+    await asyncio.gather(*(client.head(f"{POSTGREST_URL}/") for _ in range(warmup.connections)))
+
+async def warm_crypto():
+    """Run the sign and verify paths once per crypto worker, paying for key setup and pool start-up now"""
+    if not jwks_manager.ready:
+        await jwks_manager.refresh()  # Shares the fetch warm_jwks already has in flight
+    key = next(iter(jwks_manager.keys.values()))
+    now = int(time.time())
+    token = await crypto.sign({"role": "warmup", "aud": "localparts", "iat": now, "exp": now + 60}, POSTGREST_JWT_SECRET)
+    # The same claims under an RS256 header: verification runs through to the signature check and stops there
+    probe = base64url_encode(json.dumps({"alg": "RS256", "typ": "JWT"}).encode()).decode() + token[token.index("."):]
+
+    async def verify_once():
+        try:
+            await crypto.verify(probe, key, algorithms=["RS256"], audience="localparts")
+        except JWTError:
+            pass
+
+    await asyncio.gather(*(verify_once() for _ in range(crypto.workers if crypto.mode != "inline" else 1)))
+
+@app.get("/debug/warmup")
+async def debug_warmup():
+    return warmup.stats()
+
+@app.get("/debug/roles")
+async def debug_roles():
+    return {"mode": ROLE_MODE, **role_cache.stats(), "batching": role_batcher.stats()}
+
+def authorize_admin(token: Optional[str]):
+    """404 unless ADMIN_TOKEN is set, so the endpoint isn't advertised; 401 unless token matches it"""
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not token or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Missing or wrong X-Admin-Token")
+
+@app.post("/debug/roles/invalidate")
+async def invalidate_roles(user_id: Optional[str] = None, x_admin_token: Optional[str] = Header(None)):
+    """Forget cached roles for one user (or all users when user_id is omitted)"""
+    authorize_admin(x_admin_token)
+    return {"invalidated": await role_cache.forget(user_id)}
+
+def profiling_call(call):
+    """Run a profiling operation, turning ProfilingError into its HTTP status"""
+    try:
+        return call()
+    except ProfilingError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail)
+
+def authorize_profiling(token: Optional[str]):
+    profiling_call(lambda: profiling.authorize(token))
+
+@app.get("/debug/profiling")
+async def debug_profiling(x_profiling_token: Optional[str] = Header(None)):
+    authorize_profiling(x_profiling_token)
+    return {
+        **profiling.stats(),
+        "event_loop": {**profiling.monitor.stats(), "slow_callbacks_recent": list(profiling.monitor.reports)},
+        "tracemalloc": profiling.tracemalloc_stats(),
+    }
+
+@app.get("/debug/profiling/requests")
+async def debug_profiling_requests(limit: int = 20, x_profiling_token: Optional[str] = Header(None)):
+    """The sampled requests kept and the functions they spent most samples in"""
+    authorize_profiling(x_profiling_token)
+    return profiling.sampled(limit)
+
+@app.get("/debug/profiling/requests/profile")
+async def debug_profiling_request_profile(
+    id: Optional[int] = None,
+    format: str = "speedscope",
+    x_profiling_token: Optional[str] = Header(None),
+):
+    """One sampled request's profile by id, or every sampled request merged when id is omitted"""
+    authorize_profiling(x_profiling_token)
+    profile = profiling_call(lambda: profiling.request_profile(id))
+    name = f"request-{id}" if id is not None else "requests"
+    if format == "collapsed":
+        return Response(profile.collapsed(), media_type="text/plain", headers={"Content-Disposition": f'attachment; filename="{name}.collapsed.txt"'})
+    if format != "speedscope":
+        raise HTTPException(status_code=400, detail="format must be speedscope or collapsed")
+    return Response(
+        dump_json(profile.speedscope(profiling.sampler.interval)),
+        media_type="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{name}.speedscope.json"'},
+    )
+
+@app.post("/debug/profiling/start")
+async def start_profiling(seconds: float = 30, mode: str = "sampling", x_profiling_token: Optional[str] = Header(None)):
+    """Profile the whole process for `seconds` with the stack sampler (mode=sampling) or cProfile (mode=cprofile)"""
+    authorize_profiling(x_profiling_token)
+    return profiling_call(lambda: profiling.start_process(seconds, mode))
+
+@app.post("/debug/profiling/stop")
+async def stop_profiling(x_profiling_token: Optional[str] = Header(None)):
+    authorize_profiling(x_profiling_token)
+    return profiling_call(profiling.stop_process)
+
+@app.get("/debug/profiling/profile")
+async def download_profile(format: Optional[str] = None, x_profiling_token: Optional[str] = Header(None)):
+    """The last whole-process profile: speedscope or collapsed for sampling, pstats or text for cprofile"""
+    authorize_profiling(x_profiling_token)
+    body, media_type, filename = profiling_call(lambda: profiling.process_profile(format))
+    return Response(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/debug/profiling/tracemalloc/start")
+async def start_tracemalloc(frames: int = 10, x_profiling_token: Optional[str] = Header(None)):
+    authorize_profiling(x_profiling_token)
+    return profiling.tracemalloc_start(frames)
+
+@app.post("/debug/profiling/tracemalloc/snapshot")
+async def tracemalloc_snapshot(group_by: str = "lineno", limit: int = 20, x_profiling_token: Optional[str] = Header(None)):
+    """Take a snapshot and list its largest allocation sites; group_by is lineno, filename or traceback"""
+    authorize_profiling(x_profiling_token)
+    return profiling_call(lambda: profiling.snapshot(group_by, limit))
+
+@app.get("/debug/profiling/tracemalloc/diff")
+async def tracemalloc_diff(
+    base: int,
+    target: Optional[int] = None,
+    group_by: str = "lineno",
+    limit: int = 20,
+    x_profiling_token: Optional[str] = Header(None),
+):
+    """What grew between snapshot base and snapshot target, or a new snapshot when target is omitted"""
+    authorize_profiling(x_profiling_token)
+    return profiling_call(lambda: profiling.diff(base, target, group_by, limit))
+
+@app.post("/debug/profiling/tracemalloc/stop")
+async def stop_tracemalloc(x_profiling_token: Optional[str] = Header(None)):
+    authorize_profiling(x_profiling_token)
+    return profiling.tracemalloc_stop()
 
 @app.post("/runtest")
-async def run_test(authorization: Optional[str] = Header(None)):
+async def run_test(
+    authorization: Optional[str] = Header(None),
+    users: int = 0,
+    iterations: int = 1,
+    concurrency: int = 4,
+    stream: bool = False,
+    responses: bool = True
+):
+    """CRUD round-trips through PostgREST with per-step timings
+
+    By default one pass for the caller and one for test_user_123. With users=N,
+    N synthetic users (runtest-user-<i>) are provisioned through
+    ensure_user_role_exists instead. Every user runs `iterations` passes, at most
+    `concurrency` at a time. With stream=true each pass is sent as an NDJSON line
+    when it finishes, followed by the summary.
+    """
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="No valid authorization header")
+    if users < 0 or iterations < 1 or concurrency < 1:
+        raise HTTPException(status_code=400, detail="users must be >= 0, iterations and concurrency >= 1")
+    if max(users, 2) * iterations > RUNTEST_MAX_PASSES:
+        raise HTTPException(status_code=400, detail=f"At most {RUNTEST_MAX_PASSES} passes per run")
     
     token = authorization.split(" ")[1]
-    transformed_token = await transform_token(token)
     
-    # Decode the transformed token to get the user_id and role
-    decoded = jwt.decode(
-        transformed_token,
-        POSTGREST_JWT_SECRET,
-        algorithms=["HS256"],
-        audience="localparts"
-    )
+    # The minted payload carries the user_id and role
+    decoded = (await verify_token(token)).payload
     user_id = decoded.get("sub")
     role = decoded.get("role", "authenticated")  # Default to "authenticated" if not present
     
     # Ensure the user's role exists
     await ensure_user_role_exists(user_id)
     
-    async with httpx.AsyncClient() as client:
-        results = {
-            "status": "success",
-            "passes": [],
-            "jwt_info": {
-                "original_user_id": user_id,
-                "original_role": role
-            }
-        }
-        
-        # Define the test users
+    # Define the test users
+    if users:
+        test_users = [
+            {"user_id": f"runtest-user-{i}", "description": f"Synthetic User {i}"}
+            for i in range(users)
+        ]
+        for test_user in test_users:
+            test_user["role"] = SHARED_ROLE if ROLE_MODE == "shared" else test_user["user_id"]
+        await asyncio.gather(*(ensure_user_role_exists(test_user["user_id"]) for test_user in test_users))
+    else:
         test_users = [
             {"user_id": user_id, "role": role, "description": "Original User"},
             {"user_id": "test_user_123", "role": "test_user", "description": "Test User"}
         ]
+    passes = [{**test_user, "iteration": i} for i in range(iterations) for test_user in test_users]
+    jwt_info = {
+        "original_user_id": user_id,
+        "original_role": role
+    }
+    run = run_passes(passes, lambda test_user: run_test_pass(test_user, responses), concurrency)
+    started = time.perf_counter()
+    
+    if stream:
+        async def ndjson():
+            finished = []
+            async for pass_results in run:
+                finished.append(pass_results)
+                yield json.dumps({"event": "pass", **pass_results}) + "\n"
+            totals = summary(finished, time.perf_counter() - started)
+            yield json.dumps({"event": "summary", "status": run_status(totals), "jwt_info": jwt_info, **totals}) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    
+    finished = [pass_results async for pass_results in run]
+    # Passes in request order, as before
+    order = {test_user["user_id"]: i for i, test_user in enumerate(test_users)}
+    finished.sort(key=lambda pass_results: (pass_results["iteration"], order[pass_results["user_id"]]))
+    totals = summary(finished, time.perf_counter() - started)
+    # Any failed pass makes the whole run fail, so scripts timing it notice
+    return JSONResponse(
+        status_code=200 if totals["failed"] == 0 else 502,
+        content={
+            "status": run_status(totals),
+            "passes": finished,
+            "jwt_info": jwt_info,
+            "summary": totals
+        }
+    )
+
+def run_status(totals: dict) -> str:
+    return "success" if totals["failed"] == 0 else "failed"
+
+async def run_test_pass(test_user: dict, include_responses: bool = True) -> dict:
+    """Insert, fetch, update, delete and verify one record as test_user, timing each step"""
+    client = upstream.postgrest.client
+    # Create a new token for this test user
+    test_token_payload = {
+        "sub": test_user["user_id"],
+        "role": test_user["role"],
+        "aud": "localparts"
+    }
+    test_token = jwt.encode(
+        test_token_payload,
+        POSTGREST_JWT_SECRET,
+        algorithm="HS256"
+    )
+    
+    headers = {
+        "Authorization": f"Bearer {test_token}",
+        "X-User-Role": test_user["role"],
+        "X-JWT-Aud": "localparts",
+        "Prefer": "return=representation"
+    }
+    
+    pass_results = {
+        "user_id": test_user["user_id"],
+        "role": test_user["role"],
+        "description": test_user["description"],
+        "iteration": test_user.get("iteration", 0),
+    }
+    timings = StepTimings()
+    pass_results["steps"] = timings.steps
+    
+    def record(step: dict, response: httpx.Response):
+        step["status"] = response.status_code
+        if include_responses:
+            step["response"] = response.json() if response.content else None
+        # A failed step fails the pass, so errors can't pass for fast round-trips
+        if not response.is_success:
+            pass_results["failed_step"] = step["operation"]
+            raise Exception(f"{step['operation']} failed with {response.status_code}: {response.text}")
+    
+    try:
+        # Step 1: Insert a test record, stamped with the test user's id as the proxy does
+        row = {"data": f"Test data from {test_user['description']}"}
+        stamp_rows(row, test_user["user_id"])
+        with timings.step("insert") as step:
+            insert_response = await client.post(
+                f"{POSTGREST_URL}/test",
+                headers=headers,
+                json=row
+            )
+        record(step, insert_response)
         
-        for test_user in test_users:
-            # Create a new token for this test user
-            test_token_payload = {
-                "sub": test_user["user_id"],
-                "role": test_user["role"],
-                "aud": "localparts"
-            }
-            test_token = jwt.encode(
-                test_token_payload,
-                POSTGREST_JWT_SECRET,
-                algorithm="HS256"
+        # Get the inserted record's ID
+        inserted_id = insert_response.json()[0]["id"]
+        
+        # Step 2: Fetch all records
+        with timings.step("fetch") as step:
+            fetch_response = await client.get(
+                f"{POSTGREST_URL}/test",
+                headers=headers
             )
-            
-            headers = {
-                "Authorization": f"Bearer {test_token}",
-                "X-User-Role": test_user["role"],
-                "X-JWT-Aud": "localparts",
-                "Prefer": "return=representation"
-            }
-            
-            pass_results = {
-                "user_id": test_user["user_id"],
-                "role": test_user["role"],
-                "description": test_user["description"],
-                "steps": []
-            }
-            
-            try:
-                # Step 1: Insert a test record
-                insert_response = await client.post(
-                    f"{POSTGREST_URL}/test",
-                    headers=headers,
-                    json={
-                        "data": f"Test data from {test_user['description']}"
-                    }
-                )
-                pass_results["steps"].append({
-                    "operation": "insert",
-                    "status": insert_response.status_code,
-                    "response": insert_response.json() if insert_response.content else None
-                })
-                
-                if insert_response.status_code != 201:
-                    raise Exception(f"Insert failed: {insert_response.text}")
-                
-                # Get the inserted record's ID
-                inserted_id = insert_response.json()[0]["id"]
-                
-                # Step 2: Fetch all records
-                fetch_response = await client.get(
-                    f"{POSTGREST_URL}/test",
-                    headers=headers
-                )
-                pass_results["steps"].append({
-                    "operation": "fetch",
-                    "status": fetch_response.status_code,
-                    "response": fetch_response.json() if fetch_response.content else None
-                })
-                
-                # Step 3: Update the record
-                update_response = await client.patch(
-                    f"{POSTGREST_URL}/test?id=eq.{inserted_id}",
-                    headers=headers,
-                    json={"data": f"Updated test data from {test_user['description']}"}
-                )
-                pass_results["steps"].append({
-                    "operation": "update",
-                    "status": update_response.status_code,
-                    "response": update_response.json() if update_response.content else None
-                })
-                
-                # Step 4: Delete the record
-                delete_response = await client.delete(
-                    f"{POSTGREST_URL}/test?id=eq.{inserted_id}",
-                    headers=headers
-                )
-                pass_results["steps"].append({
-                    "operation": "delete",
-                    "status": delete_response.status_code,
-                    "response": delete_response.json() if delete_response.content else None
-                })
-                
-                # Step 5: Verify deletion
-                verify_response = await client.get(
-                    f"{POSTGREST_URL}/test?id=eq.{inserted_id}",
-                    headers=headers
-                )
-                pass_results["steps"].append({
-                    "operation": "verify_deletion",
-                    "status": verify_response.status_code,
-                    "response": verify_response.json() if verify_response.content else None
-                })
-                
-            except Exception as e:
-                pass_results["status"] = "error"
-                pass_results["error"] = str(e)
-                logger.error(f"Test failed for user {test_user['user_id']}: {str(e)}")
-            
-            results["passes"].append(pass_results)
+        record(step, fetch_response)
+        
+        # Step 3: Update the record
+        with timings.step("update") as step:
+            update_response = await client.patch(
+                f"{POSTGREST_URL}/test?id=eq.{inserted_id}",
+                headers=headers,
+                json={"data": f"Updated test data from {test_user['description']}"}
+            )
+        record(step, update_response)
         
-        return results
+        # Step 4: Delete the record
+        with timings.step("delete") as step:
+            delete_response = await client.delete(
+                f"{POSTGREST_URL}/test?id=eq.{inserted_id}",
+                headers=headers
+            )
+        record(step, delete_response)
+        
+        # Step 5: Verify deletion
+        with timings.step("verify_deletion") as step:
+            verify_response = await client.get(
+                f"{POSTGREST_URL}/test?id=eq.{inserted_id}",
+                headers=headers
+            )
+        record(step, verify_response)
+        
+    except Exception as e:
+        pass_results["status"] = "error"
+        pass_results["error"] = str(e)
+        logger.error(f"Test failed for user {test_user['user_id']}: {str(e)}")
+    
+    return pass_results
+
+@app.post("/batch")
+async def batch(batch_request: BatchRequest, request: Request, authorization: Optional[str] = Header(None)):
+    """Run several PostgREST operations for one user, authenticating once"""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="No valid authorization header")
+    if len(batch_request.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_OPERATIONS} operations per batch")
+
+    with metrics.time("transform_token"):
+        verified = await verify_token(authorization.split(" ")[1])
+    user_id = verified.payload.get("sub")
+    request.state.user_id = user_id
+    await ensure_user_role_exists(user_id)
+
+    try:
+        results = await run_batch(batch_request.operations, lambda op: send_operation(op, verified.token, user_id))
+    except BatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"results": results}
+
+async def send_operation(op: BatchOperation, token: str, user_id: str) -> dict:
+    """Send one batch operation to PostgREST as the user, returning its status and parsed body"""
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "X-User-Role": "authenticated",
+        "X-JWT-Aud": "localparts",
+        "prefer": "return=representation",
+        **{k.lower(): v for k, v in op.headers.items() if k.lower() in OPERATION_HEADERS}
+    }
+    content = None
+    if op.body is not None:
+        body = op.body
+        if op.method == "POST":
+            stamp_rows(body, user_id)
+        content = dump_json(body)
+        headers["Content-Type"] = "application/json"
+
+    url = f"{POSTGREST_URL}/{op.path.lstrip('/')}"
+    if op.query:
+        url = f"{url}?{op.query}"
+    client = upstream.postgrest.client
+    try:
+        with metrics.time("postgrest"):
+            response = await upstream_guard.send(op.path, lambda: client.request(op.method, url, headers=headers, content=content))
+    except UpstreamUnavailable as e:
+        return {"status": e.status, "error": str(e)}
+    metrics.count_upstream(op.method, response.status_code)
+    forget_collapsed(op.method, user_id, op.path.lstrip("/"), response.status_code)
+
+    body = None
+    if response.content:
+        body = response.json() if is_json_content_type(response.headers.get("content-type")) else response.text
+    return {"status": response.status_code, "body": body}
+
+@app.get("/export")
+async def export(
+    request: Request,
+    table: str,
+    format: str = "ndjson",
+    cursor: Optional[str] = None,
+    chunk: Optional[int] = None,
+    select: Optional[str] = None,
+    authorization: Optional[str] = Header(None),
+):
+    """Stream all of a table the user can see as NDJSON or CSV, paging PostgREST on the table's key
+
+    Other query parameters are PostgREST filters. Every row includes the key
+    column (named in X-Export-Key); passing the last key received as cursor
+    resumes an interrupted export after that row.
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="No valid authorization header")
+    key = EXPORT_TABLES.get(table)
+    if key is None:
+        raise HTTPException(status_code=404, detail=f"{table} is not exportable")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    chunk = EXPORT_CHUNK_ROWS if chunk is None else chunk
+    if not 0 < chunk <= EXPORT_MAX_CHUNK_ROWS:
+        raise HTTPException(status_code=400, detail=f"chunk must be between 1 and {EXPORT_MAX_CHUNK_ROWS}")
+    filters = [(name, value) for name, value in request.query_params.multi_items() if name not in EXPORT_PARAMS]
+    if any(name in EXPORT_RESERVED_PARAMS for name, _ in filters):
+        raise HTTPException(status_code=400, detail="Exports are ordered and paged by key; order, limit and offset are not allowed")
+    try:
+        select = export_select(select, key)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    token = authorization.split(" ")[1]
+    with metrics.time("transform_token"):
+        verified = await verify_token(token)
+    request.state.user_id = verified.payload.get("sub")
+    await ensure_user_role_exists(verified.payload.get("sub"))
+
+    async def fetch_page(after: Optional[str]) -> list:
+        # Re-read the minted token per page (a cache hit), so a long export outlives one token
+        minted = (await verify_token(token)).token
+        return await fetch_export_page(table, page_params(filters, select, key, after, chunk), minted)
+
+    try:
+        first = await fetch_page(cursor)
+    except ExportUpstreamError as e:
+        return Response(content=e.body, status_code=e.status, media_type="application/json")
+    except UpstreamUnavailable as e:
+        raise unavailable_error(e, "GET", f"export/{table}")
+
+    encode = ndjson_lines if format == "ndjson" else CsvEncoder(select.split(",") if select else None)
+    prefix = encode.header() if format == "csv" else b""
+    return StreamingResponse(
+        encode_pages(keyset_pages(fetch_page, key, chunk, first), encode, prefix),
+        media_type=EXPORT_FORMATS[format],
+        headers={"X-Export-Key": key, "Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+async def fetch_export_page(table: str, params: list, token: str) -> list:
+    """GET one page of an export from PostgREST as the user"""
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/json",
+        "X-User-Role": "authenticated",
+        "X-JWT-Aud": "localparts",
+    }
+    client = upstream.postgrest.client
+    with metrics.time("postgrest"):
+        response = await upstream_guard.send(table, lambda: client.get(f"{POSTGREST_URL}/{table}", params=params, headers=headers))
+    metrics.count_upstream("GET", response.status_code)
+    if response.status_code != 200:
+        raise ExportUpstreamError(response.status_code, response.content)
+    return load_json(response.content)
+
+def request_content(request: Request):
+    """Stream the request body upstream, or send none when the client didn't send one"""
+    if "content-length" in request.headers or "transfer-encoding" in request.headers:
+        return request.stream()
+    return None
+
+def streaming_response(response: httpx.Response, chunks: Optional[AsyncIterator[bytes]] = None) -> StreamingResponse:
+    """Pipe an upstream response to the client chunk by chunk, keeping its headers"""
+    streaming = StreamingResponse(
+        chunks if chunks is not None else response.aiter_raw(),
+        status_code=response.status_code,
+        background=BackgroundTask(response.aclose)
+    )
+    streaming.raw_headers = [
+        (name, value) for name, value in response.headers.raw
+        if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS
+    ]
+    return streaming
+
+# Conditional headers are answered locally, so one client's 304 is never handed to another
+CONDITIONAL_HEADERS = {"if-none-match", "if-modified-since"}
+
+async def fetch_shared(client: httpx.AsyncClient, path: str, url: str, headers: dict) -> SharedResponse:
+    """GET from PostgREST and buffer the raw response so it can be replayed to several clients
+
+    Past COLLAPSE_MAX_BYTES this raises TooLargeToShare with the response left
+    open, and the caller that started the call streams it on.
+    """
+    upstream_request = client.build_request(
+        method="GET",
+        url=url,
+        headers={k: v for k, v in headers.items() if k.lower() not in CONDITIONAL_HEADERS}
+    )
+    with metrics.time("postgrest"):
+        response = await upstream_guard.send(path, lambda: client.send(upstream_request, stream=True))
+        try:
+            body = await read_shareable(response, collapser.max_bytes)
+        except TooLargeToShare:
+            raise
+        except BaseException:
+            await response.aclose()
+            raise
+        await response.aclose()
+    metrics.count_upstream("GET", response.status_code)
+    return SharedResponse(
+        response.status_code,
+        [
+            (name, value) for name, value in response.headers.raw
+            if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS and name.lower() != b"content-length"
+        ],
+        body
+    )
+
+def replay_response(shared: SharedResponse, if_none_match: Optional[str]) -> Response:
+    """A client response for a shared upstream response, or 304 when the client's ETag matches"""
+    if shared.status == 200 and etag_matches(if_none_match, shared.etag):
+        response = Response(status_code=304)
+        response.raw_headers = [(k, v) for k, v in shared.headers if k.lower() in (b"etag", b"cache-control")]
+        return response
+    response = Response(content=shared.body, status_code=shared.status)
+    response.raw_headers = shared.headers + [(b"content-length", str(len(shared.body)).encode())]
+    return response
+
+async def fetch_collapsed(verified: TokenEntry, path: str, query: str, url: str, headers: dict) -> SharedResponse:
+    """GET through the collapser, sharing the upstream call with concurrent identical requests of the user"""
+    key = collapser.key(verified.payload.get("sub"), verified.payload.get("role"), path, query, headers)
+    no_cache = bool({"no-cache", "no-store"} & cache_control(headers.get("cache-control")).keys())
+    return await collapser.fetch(key, lambda: fetch_shared(upstream.postgrest.client, path, url, headers), no_cache)
+
+def forget_collapsed(method: str, user_id: Optional[str], path: str, status: int):
+    """Drop the user's collapsed reads of path once a write to it went through, so the next GET sees it"""
+    if collapser.enabled and user_id is not None and method not in ("GET", "HEAD", "OPTIONS") and status < 400:
+        collapser.invalidate(user_id, path)
+
+async def authorize_upstream(method: str, headers: dict, state: dict, read_body) -> tuple:
+    """Swap the Authentik token for the user's PostgREST token and add the upstream headers
+
+    Also provisions the user's role and stamps user_id on every row of a JSON
+    POST. Returns (verified, body): verified is None for requests without a
+    token, and body is None unless it was rewritten.
+    """
+    if "authorization" not in headers:
+        return None, None
+    token = headers["authorization"].split(" ")[1]
+    with metrics.time("transform_token"):
+        verified = await verify_token(token)
+    headers["authorization"] = f"Bearer {verified.token}"
+
+    # The minted payload carries the user_id
+    user_id = verified.payload.get("sub")
+    state["user_id"] = user_id
 
-# This should be the last route
-@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+    # Ensure the user's role exists
+    await ensure_user_role_exists(user_id)
+
+    # Add required headers for PostgREST
+    headers.update({
+        "X-User-Role": "authenticated",
+        "X-JWT-Aud": "localparts",
+        "Prefer": "return=representation"
+    })
+
+    # For POST requests, ensure user_id is included in the body (every row for bulk inserts)
+    body = None
+    if method == "POST" and is_json_content_type(headers.get("content-type")):
+        try:
+            raw = await read_body()
+            with metrics.time("body_rewrite"):
+                body = stamp_user_id(raw, user_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Request body is not valid JSON")
+        headers["content-length"] = str(len(body))
+
+    debug_details(logger, "Token transformed and headers updated")
+    return verified, body
+
+def upstream_url(path: str, query: str) -> str:
+    """The PostgREST URL for a request, keeping the query string (filters, select, order, ...)"""
+    url = f"{POSTGREST_URL}/{path}"
+    return f"{url}?{query}" if query else url
+
+async def fetch_direct(method: str, path: str, query: str, headers, verified: Optional[TokenEntry]) -> Optional[DirectResult]:
+    """Run an authenticated GET straight against Postgres, or return None when PostgREST has to serve it"""
+    if not direct_reads.enabled or method != "GET" or verified is None:
+        return None
+    read = direct_reads.plan(path, query, headers)
+    if read is None:
+        return None
+    with metrics.time("direct_read"):
+        result = await direct_reads.execute(read, verified.payload["role"], verified.payload)
+    debug_details(logger, "Direct read status: %s", result.status)
+    return result
+
+def unavailable_error(e: UpstreamUnavailable, method: str, path: str) -> HTTPException:
+    logger.warning("Not forwarding %s /%s: %s", method, path, e)
+    return HTTPException(
+        status_code=e.status,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)} if e.retry_after else None
+    )
+
+async def forward_request(request: ProxyRequest, send):
+    """Forward a request to PostgREST on the pure-ASGI core (PROXY_CORE=asgi)
+
+    Same behaviour as proxy(), but errors are written straight to the client
+    instead of going through FastAPI's exception handlers.
+    """
+    path = request.path
+    try:
+        debug_details(logger, "Received %s request for path: %s", request.method, path)
+        headers = forwarded_headers(request.headers.items())
+        debug_details(logger, "Request headers: %s", lambda: json.dumps(redact_headers(headers)))
+        verified, body = await authorize_upstream(request.method, headers, request.state, request.body)
+
+        direct = await fetch_direct(request.method, path, request.query, request.headers, verified)
+        if direct is not None:
+            request.state["upstream_status"] = direct.status
+        else:
+            url = upstream_url(path, request.query)
+            debug_details(logger, "Sending request to: %s", url)
+            unshared = None
+            if collapser.enabled and request.method == "GET" and verified is not None:
+                try:
+                    shared = await fetch_collapsed(verified, path, request.query, url, headers)
+                except TooLargeToShare as e:
+                    # Ours to stream on; without a response another request started it, so send our own
+                    unshared = e if e.response is not None else None
+                else:
+                    request.state["upstream_status"] = shared.status
+                    debug_details(logger, "PostgREST response status: %s (shared)", shared.status)
+                    reply = replay_response(shared, request.headers.get("if-none-match"))
+                    return await reply(request.scope, request.receive, send)
+
+            client = upstream.postgrest.client
+            if unshared is not None:
+                response = unshared.response
+            elif PROXY_STREAMING:
+                content = body if body is not None else request.stream() if request.has_body else None
+                upstream_request = client.build_request(method=request.method, url=url, headers=headers, content=content)
+                with metrics.time("postgrest"):
+                    response = await upstream_guard.send(path, lambda: client.send(upstream_request, stream=True))
+            else:
+                content = body if body is not None else await request.body()
+                with metrics.time("postgrest"):
+                    response = await upstream_guard.send(path, lambda: client.request(
+                        method=request.method, url=url, headers=headers, content=content
+                    ))
+            metrics.count_upstream(request.method, response.status_code)
+            request.state["upstream_status"] = response.status_code
+            forget_collapsed(request.method, verified and verified.payload.get("sub"), path, response.status_code)
+            debug_details(logger, "PostgREST response status: %s", response.status_code)
+    except UpstreamUnavailable as e:
+        error = unavailable_error(e, request.method, path)
+    except HTTPException as e:
+        error = e
+    except Exception as e:
+        logger.error("Error in proxy: %s", e, exc_info=True)
+        error = HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+    else:
+        if direct is not None:
+            return await send_chunks(request.receive, send, direct.status, direct.headers, direct.chunks, direct.aclose)
+        if unshared is not None:
+            return await send_streamed(request.receive, send, response, unshared.chunks())
+        if PROXY_STREAMING:
+            return await send_streamed(request.receive, send, response)
+        return await send_response(
+            send, response.status_code,
+            dump_json(response.json()) if response.content else b"null",
+            [(b"content-type", b"application/json")]
+        )
+
+    await send_response(
+        send, error.status_code,
+        dump_json({"detail": error.detail}),
+        [(b"content-type", b"application/json")] + [(k.lower().encode(), v.encode()) for k, v in (error.headers or {}).items()]
+    )
+
+# This should be the last route; it forwards only with PROXY_CORE=fastapi
+@app.api_route("/{path:path}", methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
 async def proxy(path: str, request: Request):
     # Skip proxy for our specific endpoints
-    if path in ["health", "debug/settings", "debug/jwt", "test-connection", "runtest"]:
+    if f"/{path}" in LOCAL_PATHS:
         raise HTTPException(status_code=404, detail="Not found")
         
     try:
-        logger.info(f"Received {request.method} request for path: {path}")
+        debug_details(logger, "Received %s request for path: %s", request.method, path)
         
-        # Get headers but exclude host
-        headers = {k: v for k, v in request.headers.items() if k.lower() != 'host'}
-        logger.info(f"Request headers: {json.dumps(headers, indent=2)}")
+        # Get headers but exclude host and hop-by-hop headers
+        headers = forwarded_headers(request.headers.items())
+        debug_details(logger, "Request headers: %s", lambda: json.dumps(redact_headers(headers)))
         
         # Transform token if present
-        if "authorization" in headers:
-            token = headers["authorization"].split(" ")[1]
-            new_token = await transform_token(token)
-            headers["authorization"] = f"Bearer {new_token}"
-            
-            # Decode the transformed token to get the user_id
-            decoded = jwt.decode(
-                new_token,
-                POSTGREST_JWT_SECRET,
-                algorithms=["HS256"],
-                audience="localparts"
-            )
-            user_id = decoded.get("sub")
-            
-            # Ensure the user's role exists
-            await ensure_user_role_exists(user_id)
-            
-            # Add required headers for PostgREST
-            headers.update({
-                "X-User-Role": "authenticated",
-                "X-JWT-Aud": "localparts",
-                "Prefer": "return=representation"
-            })
-            
-            # For POST requests, ensure user_id is included in the body
-            if request.method == "POST":
-                body = await request.json()
-                if isinstance(body, dict):
-                    body["user_id"] = user_id
-                    request._body = json.dumps(body).encode()
-                    headers["content-length"] = str(len(request._body))
-            
-            logger.info("Token transformed and headers updated successfully")
+        verified, body = await authorize_upstream(request.method, headers, request.scope.setdefault("state", {}), request.body)
+        if body is not None:
+            request._body = body
+
+        direct = await fetch_direct(request.method, path, request.url.query, request.headers, verified)
+        if direct is not None:
+            request.state.upstream_status = direct.status
+            streaming = StreamingResponse(direct.chunks, status_code=direct.status, background=BackgroundTask(direct.aclose))
+            streaming.raw_headers = direct.headers
+            return streaming
 
         # Make request to PostgREST
-        async with httpx.AsyncClient() as client:
-            logger.info(f"Sending request to: {POSTGREST_URL}/{path}")
-            response = await client.request(
+        url = upstream_url(path, request.url.query)
+        debug_details(logger, "Sending request to: %s", url)
+        client = upstream.postgrest.client
+        if collapser.enabled and request.method == "GET" and verified is not None:
+            try:
+                shared = await fetch_collapsed(verified, path, request.url.query, url, headers)
+            except TooLargeToShare as e:
+                # Ours to stream on; without a response another request started it, so send our own
+                if e.response is not None:
+                    metrics.count_upstream(request.method, e.response.status_code)
+                    request.state.upstream_status = e.response.status_code
+                    return streaming_response(e.response, e.chunks())
+            else:
+                request.state.upstream_status = shared.status
+                debug_details(logger, "PostgREST response status: %s (shared)", shared.status)
+                return replay_response(shared, request.headers.get("if-none-match"))
+
+        if PROXY_STREAMING:
+            upstream_request = client.build_request(
                 method=request.method,
-                url=f"{POSTGREST_URL}/{path}",
+                url=url,
                 headers=headers,
-                content=await request.body()
+                content=request_content(request)
             )
-            logger.info(f"PostgREST response status: {response.status_code}")
+            with metrics.time("postgrest"):
+                response = await upstream_guard.send(path, lambda: client.send(upstream_request, stream=True))
+            metrics.count_upstream(request.method, response.status_code)
+            request.state.upstream_status = response.status_code
+            forget_collapsed(request.method, verified and verified.payload.get("sub"), path, response.status_code)
+            debug_details(logger, "PostgREST response status: %s", response.status_code)
+            return streaming_response(response)
+
+        content = await request.body()
+        with metrics.time("postgrest"):
+            response = await upstream_guard.send(path, lambda: client.request(
+                method=request.method,
+                url=url,
+                headers=headers,
+                content=content
+            ))
+        metrics.count_upstream(request.method, response.status_code)
+        request.state.upstream_status = response.status_code
+        forget_collapsed(request.method, verified and verified.payload.get("sub"), path, response.status_code)
+        debug_details(logger, "PostgREST response status: %s", response.status_code)
             
         return JSONResponse(
             content=response.json() if response.content else None,
             status_code=response.status_code
         )
+    except UpstreamUnavailable as e:
+        raise unavailable_error(e, request.method, path)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in proxy: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}") 
\ No newline at end of file
+        logger.error("Error in proxy: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+# Paths FastAPI serves itself; every other path is forwarded to PostgREST
+LOCAL_PATHS = frozenset(route.path for route in app.routes if route.path != "/{path:path}")
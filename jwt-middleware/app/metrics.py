@@ -0,0 +1,213 @@
+import os
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Iterable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; covers cache hits (tens of µs) up to slow upstream calls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.labelnames + ("le",), labels + (_number(bound),)), cumulative
+            label_text = _labels(self.labelnames, labels)
+            yield f"{self.name}_sum", label_text, total
+            yield f"{self.name}_count", label_text, cumulative
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.started, *self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """In-process Prometheus metrics for the proxy pipeline
+
+    Stage timings, upstream status codes and in-flight requests are recorded
+    as they happen. Stats from the caches and pools are read through
+    collectors when /metrics is scraped, so they cost nothing per request.
+    When disabled, timers and counters are no-ops.
+    """
+
+    def __init__(self, enabled: bool = True, namespace: str = "jwt_middleware", buckets: tuple = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.stage_seconds = Histogram(f"{namespace}_stage_seconds", "Time spent in each stage of the proxy pipeline", ("stage",), buckets)
+        self.request_seconds = Histogram(f"{namespace}_request_seconds", "Time to serve a request, including streaming the response", ("method",), buckets)
+        self.requests = Counter(f"{namespace}_requests_total", "Requests served, by method and status", ("method", "status"))
+        self.upstream_responses = Counter(f"{namespace}_upstream_responses_total", "PostgREST responses, by method and status", ("method", "status"))
+        self.in_flight = Gauge(f"{namespace}_requests_in_flight", "Requests currently being served")
+        self._collectors = []
+
+    @classmethod
+    def from_env(cls) -> "Metrics":
+        return cls(enabled=os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes"))
+
+    def time(self, stage: str):
+        """Context manager recording the duration of one pipeline stage"""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self.stage_seconds, (stage,))
+
+    def count_upstream(self, method: str, status: int):
+        if self.enabled:
+            self.upstream_responses.inc(method, status)
+
+    def collect(self, subsystem: str, stats: Callable[[], dict], counters: tuple = (), labels: dict = None):
+        """Expose the numeric entries of a stats() dict, read at scrape time
+
+        Keys listed in counters are exposed as <namespace>_<subsystem>_<key>_total
+        counters, everything else as gauges. Booleans become 0/1.
+        """
+        self._collectors.append((subsystem, stats, frozenset(counters), labels or {}))
+
+    def _collected(self):
+        for subsystem, stats, counters, labels in self._collectors:
+            label_text = _labels(labels.keys(), labels.values())
+            for key, value in stats().items():
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.namespace}_{subsystem}_{key}"
+                if key in counters:
+                    yield name if name.endswith("_total") else f"{name}_total", "counter", label_text, value
+                else:
+                    yield name, "gauge", label_text, value
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.stage_seconds, self.request_seconds, self.requests, self.upstream_responses, self.in_flight):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in metric.samples())
+
+        # Collectors may share metric names (one per upstream), so group samples by family
+        families = {}
+        for name, kind, labels, value in self._collected():
+            families.setdefault(name, (kind, []))[1].append(f"{name}{labels} {_number(value)}")
+        for name, (kind, samples) in families.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware tracking in-flight requests and full request duration
+
+    Takes a callable returning the Metrics instance so it can be swapped at runtime.
+    """
+
+    def __init__(self, app, metrics: Callable[[], Metrics]):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        metrics = self.metrics()
+        if scope["type"] != "http" or not metrics.enabled:
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        metrics.in_flight.inc()
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.in_flight.dec()
+            metrics.request_seconds.observe(perf_counter() - started, scope["method"])
+            metrics.requests.inc(scope["method"], status)
@@ -0,0 +1,594 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from datetime import datetime, UTC
+from typing import Callable, Dict, List, Optional, Tuple
+
+from body_rewrite import dumps
+
+logger = logging.getLogger(__name__)
+
+# Frames kept per sampled stack, counted from the outermost
+MAX_DEPTH = 128
+# Distinct stacks kept in the all-requests profile; samples of further stacks are only counted
+MAX_STACKS = 20000
+# Whole-process profile modes and the download formats each offers (the first is the default)
+MODES = {"sampling": ("speedscope", "collapsed"), "cprofile": ("pstats", "text")}
+# tracemalloc's own bookkeeping and the import system would otherwise top every snapshot
+TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+class ProfilingError(Exception):
+    """A profiling request that can't be served; status is the HTTP status to answer with"""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def frame_name(code) -> Tuple[str, str, int]:
+    return getattr(code, "co_qualname", code.co_name), code.co_filename, code.co_firstlineno
+
+
+class SampledProfile:
+    """Stack samples of the event loop thread, counted per distinct stack of code objects"""
+
+    def __init__(self, name: str, max_stacks: int = MAX_STACKS):
+        self.name = name
+        self.max_stacks = max_stacks
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.dropped = 0
+
+    def add(self, stack: tuple, count: int = 1):
+        self.samples += count
+        if stack in self.stacks or len(self.stacks) < self.max_stacks:
+            self.stacks[stack] += count
+        else:
+            self.dropped += count
+
+    def trim(self, root) -> "SampledProfile":
+        """Drop the frames outside root's code object, so every stack starts at root"""
+        for stack, count in list(self.stacks.items()):
+            if root in stack:
+                del self.stacks[stack]
+                self.stacks[stack[stack.index(root):]] += count
+        return self
+
+    def merge(self, other: "SampledProfile"):
+        for stack, count in other.stacks.items():
+            self.add(stack, count)
+
+    def top(self, limit: int = 10) -> List[dict]:
+        """Functions by inclusive samples (on the stack at all) with their self samples (innermost frame)"""
+        inclusive, own = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            for code in dict.fromkeys(stack):  # Once per stack, outermost first so ties list callers first
+                inclusive[code] += count
+            own[stack[-1]] += count
+        return [
+            {"function": name, "file": f"{filename}:{line}", "samples": samples, "self": own[code]}
+            for code, samples in inclusive.most_common(limit)
+            for name, filename, line in [frame_name(code)]
+        ]
+
+    def collapsed(self) -> str:
+        """One "outer;...;inner count" line per stack, as read by flamegraph.pl and speedscope"""
+        return "".join(
+            ";".join(frame_name(code)[0] for code in stack) + f" {count}\n"
+            for stack, count in self.stacks.most_common()
+        )
+
+    def speedscope(self, interval: float) -> dict:
+        """The profile in speedscope's file format, one weighted sample per distinct stack"""
+        index: Dict[object, int] = {}
+        frames, samples, weights = [], [], []
+        for stack, count in self.stacks.items():
+            for code in stack:
+                if code not in index:
+                    index[code] = len(frames)
+                    name, filename, line = frame_name(code)
+                    frames.append({"name": name, "file": filename, "line": line})
+            samples.append([index[code] for code in stack])
+            weights.append(round(count * interval * 1000, 3))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "jwt-middleware",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled", "name": self.name, "unit": "milliseconds",
+                "startValue": 0, "endValue": round(sum(weights), 3), "samples": samples, "weights": weights,
+            }],
+        }
+
+
+class StackSampler:
+    """A daemon thread sampling the event loop thread's stack every interval, only while something records
+
+    A recorder either gets every sample (a whole-process profile) or only the
+    ones taken while its asyncio task is the one running (a sampled request).
+    With nothing recording the thread waits on an event and costs nothing.
+    Samples are taken when the thread gets the GIL, so a busy loop thread is
+    sampled at most once per sys.getswitchinterval() (5 ms by default).
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.seconds = 0.0
+        self._recorders: Dict[SampledProfile, Optional[asyncio.Task]] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._loop = None
+        self._thread_id = None
+
+    def add(self, recorder: SampledProfile, task: Optional[asyncio.Task] = None):
+        """Start feeding recorder; call from the event loop thread"""
+        with self._lock:
+            self._loop, self._thread_id = asyncio.get_running_loop(), threading.get_ident()
+            self._recorders[recorder] = task
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def remove(self, recorder: SampledProfile):
+        with self._lock:
+            self._recorders.pop(recorder, None)
+
+    def _run(self):
+        while True:
+            if not self._recorders:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            time.sleep(self.interval)
+            started = time.perf_counter()
+            with self._lock:
+                frame = sys._current_frames().get(self._thread_id)
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                # Only a dict lookup, so safe enough to read from this thread
+                running = asyncio.current_task(self._loop)
+                for recorder, task in self._recorders.items():
+                    if stack and (task is None or task is running):
+                        recorder.add(stack)
+            self.samples += 1
+            self.seconds += time.perf_counter() - started
+
+
+class LoopMonitor:
+    """Measures event loop lag and reports what the loop was running when it stalled
+
+    A daemon thread schedules a callback on the loop every interval and times
+    how long it takes to run. When it hasn't run within slow seconds, the
+    thread records the loop thread's stack and running task at that moment:
+    the code that is blocking the loop, caught in the act.
+    """
+
+    def __init__(self, interval: float = 0.1, slow: float = 0.1, keep: int = 20, window: int = 1000):
+        self.interval = interval
+        self.slow = slow
+        self.checks = 0
+        self.slow_callbacks = 0
+        self.max_lag = 0.0
+        self.lags: deque = deque(maxlen=window)
+        self.reports: deque = deque(maxlen=keep)
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop = None
+        self._thread_id = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start watching the running loop; call from the event loop thread"""
+        if self.running:
+            return
+        self._loop, self._thread_id = asyncio.get_running_loop(), threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="loop-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            ran = threading.Event()
+            ran_at = []
+
+            def beat():
+                ran_at.append(time.perf_counter())
+                ran.set()
+
+            scheduled = time.perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(beat)
+            except RuntimeError:
+                return  # The loop is closed
+            if not ran.wait(self.slow):
+                report = self._report()
+                while not ran.wait(self.interval):
+                    if self._stop.is_set():
+                        return
+                report["lag_ms"] = round((ran_at[0] - scheduled) * 1000, 3)
+                self.reports.append(report)
+                self.slow_callbacks += 1
+                logger.warning("Event loop blocked for %.0f ms in %s", report["lag_ms"], report["stack"][-1] if report["stack"] else "?")
+            lag = ran_at[0] - scheduled
+            self.checks += 1
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _report(self) -> dict:
+        frame = sys._current_frames().get(self._thread_id)
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(f"{frame.f_code.co_filename}:{frame.f_lineno} {getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)}")
+            frame = frame.f_back
+        task = asyncio.current_task(self._loop)
+        return {
+            "at": datetime.now(UTC).isoformat(timespec="milliseconds"),
+            "task": task.get_name() if task is not None else None,
+            "coroutine": getattr(task.get_coro(), "__qualname__", None) if task is not None else None,
+            "stack": stack[::-1][-30:],
+        }
+
+    def stats(self) -> dict:
+        ordered = sorted(self.lags)
+        at = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3) if ordered else 0.0
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "slow_ms": self.slow * 1000,
+            "checks": self.checks,
+            "slow_callbacks": self.slow_callbacks,
+            "lag_p50_ms": at(0.50),
+            "lag_p99_ms": at(0.99),
+            "lag_max_ms": round(self.max_lag * 1000, 3),
+        }
+
+
+class ProcessProfile:
+    """A time-boxed whole-process profile: the stack sampler or cProfile on the event loop thread"""
+
+    def __init__(self, mode: str, seconds: float):
+        self.mode = mode
+        self.seconds = seconds
+        self.started = time.time()
+        self.stopped: Optional[float] = None
+        self.sampled = SampledProfile("process") if mode == "sampling" else None
+        self.cprofile = cProfile.Profile() if mode == "cprofile" else None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def running(self) -> bool:
+        return self.stopped is None
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "running": self.running,
+            "seconds": self.seconds,
+            "elapsed": round((self.stopped or time.time()) - self.started, 3),
+            "samples": self.sampled.samples if self.sampled is not None else None,
+        }
+
+
+class Profiling:
+    """Settings and state of the on-demand profiling endpoints
+
+    Off unless PROFILING_ENABLED is set, and then only usable with
+    PROFILING_TOKEN in the X-Profiling-Token header. With sample_every N,
+    every Nth request is profiled by the stack sampler; the last keep of them
+    are kept and all of them are merged into one profile. A whole-process
+    profile runs for at most max_seconds.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        token: Optional[str] = None,
+        sample_every: int = 0,
+        interval: float = 0.005,
+        keep: int = 50,
+        max_seconds: float = 300.0,
+        loop_monitor: bool = True,
+        loop_interval: float = 0.1,
+        slow_callback: float = 0.1,
+        max_snapshots: int = 5,
+    ):
+        if enabled and not token:
+            logger.warning("PROFILING_ENABLED is set without PROFILING_TOKEN; profiling stays off")
+            enabled = False
+        self.enabled = enabled
+        self.token = token
+        self.sample_every = sample_every
+        self.keep = keep
+        self.max_seconds = max_seconds
+        self.loop_monitor = loop_monitor
+        self.max_snapshots = max_snapshots
+        self.sampler = StackSampler(interval)
+        self.monitor = LoopMonitor(loop_interval, slow_callback)
+        self.requests: deque = deque(maxlen=keep)
+        self.aggregate = SampledProfile("sampled requests")
+        self.process: Optional[ProcessProfile] = None
+        self.snapshots: Dict[int, tracemalloc.Snapshot] = {}
+        self.seen = 0
+        self.sampled_requests = 0
+        self._snapshot_ids = 0
+
+    @classmethod
+    def from_env(cls) -> "Profiling":
+        return cls(
+            enabled=os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes"),
+            token=os.getenv("PROFILING_TOKEN") or None,
+            sample_every=int(os.getenv("PROFILING_SAMPLE_EVERY", "0")),
+            interval=float(os.getenv("PROFILING_INTERVAL_MS", "5")) / 1000,
+            keep=int(os.getenv("PROFILING_KEEP_REQUESTS", "50")),
+            max_seconds=float(os.getenv("PROFILING_MAX_SECONDS", "300")),
+            loop_monitor=os.getenv("PROFILING_LOOP_MONITOR", "true").lower() in ("1", "true", "yes"),
+            loop_interval=float(os.getenv("PROFILING_LOOP_INTERVAL_MS", "100")) / 1000,
+            slow_callback=float(os.getenv("PROFILING_SLOW_CALLBACK_MS", "100")) / 1000,
+            max_snapshots=int(os.getenv("PROFILING_MAX_SNAPSHOTS", "5")),
+        )
+
+    def authorize(self, token: Optional[str]):
+        """Raise unless profiling is on and token is the configured one; 404 when off, so it isn't advertised"""
+        if not self.enabled:
+            raise ProfilingError(404, "Not found")
+        if not token or not hmac.compare_digest(token.encode(), self.token.encode()):
+            raise ProfilingError(401, "Missing or wrong X-Profiling-Token")
+
+    def start(self):
+        if self.enabled and self.loop_monitor:
+            self.monitor.start()
+
+    def stop(self):
+        self.monitor.stop()
+        if self.process is not None and self.process.running:
+            self.stop_process()
+
+    # Sampled requests
+
+    def sample_request(self) -> bool:
+        if not self.enabled or self.sample_every <= 0:
+            return False
+        self.seen += 1
+        return self.seen % self.sample_every == 0
+
+    def finish_request(self, profile: SampledProfile, method: str, path: str, status: int, seconds: float):
+        self.sampled_requests += 1
+        self.aggregate.merge(profile)
+        self.requests.append({
+            "id": self.sampled_requests,
+            "method": method,
+            "path": path,
+            "status": status,
+            "ms": round(seconds * 1000, 3),
+            "profile": profile,
+        })
+
+    def request_profile(self, id: Optional[int]) -> SampledProfile:
+        if id is None:
+            return self.aggregate
+        for request in self.requests:
+            if request["id"] == id:
+                return request["profile"]
+        raise ProfilingError(404, f"No sampled request {id}; only the last {self.keep} are kept")
+
+    def sampled(self, limit: int = 10) -> dict:
+        return {
+            "sample_every": self.sample_every,
+            "sampled_requests": self.sampled_requests,
+            "samples": self.aggregate.samples,
+            "top": self.aggregate.top(limit),
+            "requests": [
+                {**{k: v for k, v in request.items() if k != "profile"}, "samples": request["profile"].samples}
+                for request in reversed(self.requests)
+            ],
+        }
+
+    # Whole-process profiles
+
+    def start_process(self, seconds: float, mode: str) -> dict:
+        """Start a profile of the whole process that stops itself after seconds; call from the event loop thread"""
+        if mode not in MODES:
+            raise ProfilingError(400, f"mode must be one of {', '.join(MODES)}")
+        if self.process is not None and self.process.running:
+            raise ProfilingError(409, "A profile is already running")
+        if not 0 < seconds <= self.max_seconds:
+            raise ProfilingError(400, f"seconds must be between 0 and {self.max_seconds:g}")
+        process = ProcessProfile(mode, seconds)
+        if process.sampled is not None:
+            self.sampler.add(process.sampled)
+        else:
+            # Profiles the thread it's enabled on, which is the event loop's
+            process.cprofile.enable()
+        process.timer = asyncio.get_running_loop().call_later(seconds, self.stop_process)
+        self.process = process
+        return process.stats()
+
+    def stop_process(self) -> dict:
+        process = self.process
+        if process is None or not process.running:
+            raise ProfilingError(409, "No profile is running")
+        process.timer.cancel()
+        if process.sampled is not None:
+            self.sampler.remove(process.sampled)
+        else:
+            process.cprofile.disable()
+        process.stopped = time.time()
+        return process.stats()
+
+    def process_profile(self, format: Optional[str]) -> Tuple[bytes, str, str]:
+        """The finished profile as (body, media type, file name)"""
+        process = self.process
+        if process is None:
+            raise ProfilingError(404, "No profile has been taken")
+        if process.running:
+            raise ProfilingError(409, "The profile is still running; stop it or wait")
+        format = format or MODES[process.mode][0]
+        if format not in MODES[process.mode]:
+            raise ProfilingError(400, f"A {process.mode} profile downloads as {' or '.join(MODES[process.mode])}")
+        if format == "speedscope":
+            return dumps(process.sampled.speedscope(self.sampler.interval)), "application/json", "profile.speedscope.json"
+        if format == "collapsed":
+            return process.sampled.collapsed().encode(), "text/plain", "profile.collapsed.txt"
+        process.cprofile.create_stats()
+        if format == "pstats":
+            # The file format pstats.Stats() and snakeviz load
+            return marshal.dumps(process.cprofile.stats), "application/octet-stream", "profile.pstats"
+        text = io.StringIO()
+        pstats.Stats(process.cprofile, stream=text).sort_stats("cumulative").print_stats(50)
+        return text.getvalue().encode(), "text/plain", "profile.txt"
+
+    # tracemalloc
+
+    def tracemalloc_start(self, frames: int) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        return self.tracemalloc_stats()
+
+    def tracemalloc_stop(self) -> dict:
+        tracemalloc.stop()
+        self.snapshots.clear()
+        return self.tracemalloc_stats()
+
+    @staticmethod
+    def check_key_type(key_type: str):
+        if key_type not in ("lineno", "filename", "traceback"):
+            raise ProfilingError(400, "group_by must be lineno, filename or traceback")
+
+    def take_snapshot(self) -> Tuple[int, tracemalloc.Snapshot]:
+        if not tracemalloc.is_tracing():
+            raise ProfilingError(409, "tracemalloc isn't tracing; start it first")
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+        self._snapshot_ids += 1
+        self.snapshots[self._snapshot_ids] = snapshot
+        while len(self.snapshots) > self.max_snapshots:
+            del self.snapshots[min(self.snapshots)]
+        return self._snapshot_ids, snapshot
+
+    def snapshot(self, key_type: str, limit: int) -> dict:
+        self.check_key_type(key_type)
+        id, snapshot = self.take_snapshot()
+        statistics = snapshot.statistics(key_type)
+        return {
+            "id": id,
+            "traced_mb": round(sum(stat.size for stat in statistics) / 2**20, 3),
+            "top": [allocation(stat) for stat in statistics[:limit]],
+        }
+
+    def diff(self, base: int, target: Optional[int], key_type: str, limit: int) -> dict:
+        """Growth from snapshot base to snapshot target (a new snapshot when None), largest first"""
+        self.check_key_type(key_type)
+        if base not in self.snapshots or target is not None and target not in self.snapshots:
+            raise ProfilingError(404, f"Unknown snapshot; kept: {sorted(self.snapshots)}")
+        if target is None:
+            target, _ = self.take_snapshot()
+        statistics = self.snapshots[target].compare_to(self.snapshots[base], key_type)
+        return {
+            "base": base,
+            "target": target,
+            "size_diff_mb": round(sum(stat.size_diff for stat in statistics) / 2**20, 3),
+            "top": [allocation(stat) for stat in statistics[:limit]],
+        }
+
+    def tracemalloc_stats(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "frames": tracemalloc.get_traceback_limit(),
+            "traced_mb": round(current / 2**20, 3),
+            "peak_mb": round(peak / 2**20, 3),
+            "snapshots": sorted(self.snapshots),
+        }
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_every": self.sample_every,
+            "interval_ms": self.sampler.interval * 1000,
+            "sampled_requests": self.sampled_requests,
+            "samples": self.sampler.samples,
+            "sampler_seconds": round(self.sampler.seconds, 6),
+            "process_profile": self.process.stats() if self.process is not None else None,
+            "tracemalloc": tracemalloc.is_tracing(),
+        }
+
+
+def allocation(stat) -> dict:
+    """One tracemalloc Statistic or StatisticDiff as JSON"""
+    frame = stat.traceback[0]
+    entry = {
+        "where": f"{frame.filename}:{frame.lineno}",
+        "size_kb": round(stat.size / 1024, 1),
+        "count": stat.count,
+    }
+    if hasattr(stat, "size_diff"):
+        entry.update(size_diff_kb=round(stat.size_diff / 1024, 1), count_diff=stat.count_diff)
+    if len(stat.traceback) > 1:
+        entry["traceback"] = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+    return entry
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware handing every Nth request to the stack sampler for the length of the request
+
+    Takes a callable returning the Profiling settings so they can be swapped
+    at runtime. Requests that aren't sampled cost one counter check.
+    """
+
+    def __init__(self, app, profiling: Callable[[], Profiling]):
+        self.app = app
+        self.profiling = profiling
+
+    async def __call__(self, scope, receive, send):
+        profiling = self.profiling()
+        if scope["type"] != "http" or not profiling.sample_request():
+            return await self.app(scope, receive, send)
+
+        profile = SampledProfile(f"{scope['method']} {scope['path']}")
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profiling.sampler.add(profile, asyncio.current_task())
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiling.sampler.remove(profile)
+            profile.trim(ProfilingMiddleware.__call__.__code__)
+            profiling.finish_request(profile, scope["method"], scope["path"], status, time.perf_counter() - started)
@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream request that was refused or not answered in time; status is what the client gets"""
+
+    status = 503
+
+    def __init__(self, message: str, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamOverloaded(UpstreamUnavailable):
+    pass
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    status = 504
+
+
+def parse_route_deadlines(value: str) -> Dict[str, float]:
+    """Parse "rpc/=10,test=5" into {"rpc/": 10.0, "test": 5.0}"""
+    deadlines = {}
+    for item in value.split(","):
+        if item.strip():
+            prefix, seconds = item.split("=", 1)
+            deadlines[prefix.strip().lstrip("/")] = float(seconds)
+    return deadlines
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight upstream requests and queues a bounded number of callers
+
+    With adaptive set the limit follows AIMD between min_limit and max_limit:
+    each success under latency_target adds 1/limit (one slot per window of
+    limit requests), and a slow or failed request multiplies it by backoff.
+    Requests sent before the last decrease don't decrease it again, so one
+    slow burst backs off once rather than once per request.
+    """
+
+    def __init__(
+        self,
+        limit: int = 10,
+        max_queue: int = 100,
+        adaptive: bool = False,
+        min_limit: int = 1,
+        max_limit: Optional[int] = None,
+        latency_target: float = 0.5,
+        backoff: float = 0.75,
+        clock=time.monotonic,
+    ):
+        self.limit = float(limit)
+        self.max_queue = max_queue
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.clock = clock
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.decreases = 0
+        self._last_decrease = -math.inf
+        self._waiters = deque()
+
+    async def acquire(self, timeout: float):
+        """Take a slot, waiting up to timeout in the queue; raises UpstreamOverloaded otherwise"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloaded(f"{len(self._waiters)} upstream requests already queued")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # Handed a slot just as we gave up: pass it on
+            else:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.queue_timeouts += 1
+                raise UpstreamOverloaded(f"No upstream slot free within {timeout:.2f}s")
+            raise
+        self.admitted += 1
+
+    def release(self, sent: Optional[float] = None, latency: Optional[float] = None, ok: Optional[bool] = None):
+        """Free a slot; sent, latency and ok feed the adaptive limit when the request got an answer"""
+        self.in_flight -= 1
+        if self.adaptive and ok is not None:
+            self._adjust(sent, latency, ok)
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _adjust(self, sent: float, latency: float, ok: bool):
+        if ok and latency <= self.latency_target:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        elif sent >= self._last_decrease:
+            self.limit = max(float(self.min_limit), self.limit * self.backoff)
+            self._last_decrease = self.clock()
+            self.decreases += 1
+
+    def stats(self) -> dict:
+        return {
+            "adaptive": self.adaptive,
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "queue_timeouts": self.queue_timeouts,
+            "decreases": self.decreases,
+        }
+
+
+class CircuitBreaker:
+    """Stops sending upstream after failure_threshold consecutive failures
+
+    The circuit then stays open for reset_timeout seconds, answering every
+    request with CircuitOpen. After that it is half-open: one trial request
+    goes through, and its success closes the circuit while a failure reopens it.
+    Requests sent before the circuit opened don't count once it has: only the
+    trial decides. A failure_threshold of 0 disables the breaker.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._trial = False
+
+    def allow(self) -> bool:
+        """Raise CircuitOpen unless a request may be sent now; True when it is the half-open trial"""
+        if self.state == self.OPEN:
+            remaining = self.reset_timeout - (self.clock() - self.opened_at)
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpen("Upstream circuit is open", retry_after=math.ceil(remaining))
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._trial:
+                self.rejected += 1
+                raise CircuitOpen("Upstream circuit is half-open, trial request in flight", retry_after=1)
+            self._trial = True
+            return True
+        return False
+
+    def record(self, ok: Optional[bool], trial: bool = False):
+        """Count a request's outcome, trial as allow() returned it; None means it ended without an answer"""
+        if trial:
+            self._trial = False
+        if ok is None:
+            return
+        if self.state != self.CLOSED and not trial:
+            return
+        if ok:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                logger.info("Upstream circuit closed")
+                self.state = self.CLOSED
+            return
+        self.failures += 1
+        if self.failure_threshold and (trial or self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            logger.warning(f"Upstream circuit opened after {self.failures} consecutive failures")
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+            self.opens += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "open": self.state != self.CLOSED,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+        }
+
+
+class UpstreamGuard:
+    """Concurrency limit, bounded queue, per-route deadlines and circuit breaker around upstream calls
+
+    A route's deadline covers the queue wait and the wait for response headers.
+    A streamed body is bounded by the client's read timeout instead, but its
+    slot is only freed once the body has been read, since the upstream
+    connection stays busy until then. 5xx responses, timeouts and transport
+    errors count as failures.
+    """
+
+    def __init__(
+        self,
+        limiter: ConcurrencyLimiter,
+        breaker: CircuitBreaker,
+        deadline: float = 30.0,
+        route_deadlines: Optional[Dict[str, float]] = None,
+        queue_timeout: float = 5.0,
+        retry_after: int = 1,
+        enabled: bool = True,
+    ):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.deadline = deadline
+        # Longest prefix first, so the most specific route wins
+        self.route_deadlines = dict(sorted((route_deadlines or {}).items(), key=lambda item: -len(item[0])))
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.enabled = enabled
+        self.deadline_exceeded = 0
+
+    @classmethod
+    def from_env(cls, prefix: str = "POSTGREST") -> "UpstreamGuard":
+        setting = lambda key, default: os.getenv(f"{prefix}_{key}", default)
+        limit = int(setting("CONCURRENCY", "10"))
+        return cls(
+            ConcurrencyLimiter(
+                limit=limit,
+                max_queue=int(setting("QUEUE_SIZE", "100")),
+                adaptive=setting("CONCURRENCY_ADAPTIVE", "false").lower() in ("1", "true", "yes"),
+                min_limit=int(setting("CONCURRENCY_MIN", "1")),
+                max_limit=int(setting("CONCURRENCY_MAX", str(limit))),
+                latency_target=float(setting("LATENCY_TARGET", "0.5")),
+            ),
+            CircuitBreaker(
+                failure_threshold=int(setting("BREAKER_FAILURES", "5")),
+                reset_timeout=float(setting("BREAKER_RESET", "10")),
+            ),
+            deadline=float(setting("DEADLINE", "30")),
+            route_deadlines=parse_route_deadlines(setting("ROUTE_DEADLINES", "")),
+            queue_timeout=float(setting("QUEUE_TIMEOUT", "5")),
+            retry_after=int(setting("RETRY_AFTER", "1")),
+            enabled=limit > 0,
+        )
+
+    def deadline_for(self, path: str) -> float:
+        path = path.lstrip("/")
+        for prefix, deadline in self.route_deadlines.items():
+            if path.startswith(prefix):
+                return deadline
+        return self.deadline
+
+    async def send(self, path: str, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """Send a request through the guard, raising UpstreamUnavailable when it is refused or too slow"""
+        if not self.enabled:
+            return await send()
+        deadline = self.deadline_for(path)
+        started = self.limiter.clock()
+        trial = self.breaker.allow()
+        try:
+            await self.limiter.acquire(min(self.queue_timeout, deadline))
+        except UpstreamOverloaded as e:
+            self.breaker.record(None, trial)
+            e.retry_after = self.retry_after
+            raise
+        except BaseException:
+            self.breaker.record(None, trial)
+            raise
+
+        sent = self.limiter.clock()
+        try:
+            response = await asyncio.wait_for(send(), deadline - (sent - started))
+        except asyncio.TimeoutError:
+            self._finish(sent, trial, False)
+            self.deadline_exceeded += 1
+            raise DeadlineExceeded(f"Upstream did not answer within {deadline:g}s")
+        except httpx.TransportError:
+            self._finish(sent, trial, False)
+            raise
+        except BaseException:
+            self._finish(sent, trial, None)
+            raise
+
+        ok = response.status_code < 500
+        latency = self.limiter.clock() - sent
+        if response.is_closed:
+            self._finish(sent, trial, ok, latency)
+            return response
+
+        stream = response.stream
+        original_aclose = stream.aclose
+
+        async def aclose():
+            self._finish(sent, trial, ok, latency)
+            await original_aclose()
+
+        stream.aclose = aclose
+        return response
+
+    def _finish(self, sent: float, trial: bool, ok: Optional[bool], latency: Optional[float] = None):
+        if latency is None:
+            latency = self.limiter.clock() - sent
+        self.limiter.release(sent, latency, ok)
+        self.breaker.record(ok, trial)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "deadline": self.deadline,
+            "route_deadlines": self.route_deadlines,
+            "deadline_exceeded": self.deadline_exceeded,
+            **self.limiter.stats(),
+            "circuit": self.breaker.stats(),
+        }
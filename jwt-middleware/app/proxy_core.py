@@ -0,0 +1,128 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional, Tuple
+
+import httpx
+
+# Connection-specific headers that must not be forwarded by a proxy
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade"
+}
+
+
+def forwarded_headers(headers: Iterable[Tuple[str, str]]) -> dict:
+    """Request headers to send upstream: everything but host and hop-by-hop headers"""
+    return {k: v for k, v in headers if k.lower() != "host" and k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+class ProxyRequest:
+    """The parts of an ASGI HTTP scope the forwarding path uses, with headers decoded once"""
+
+    __slots__ = ("scope", "receive", "method", "path", "query", "headers", "_body")
+
+    def __init__(self, scope: dict, receive: Callable[[], Awaitable[dict]]):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"].lstrip("/")
+        self.query = scope["query_string"].decode("latin-1")
+        # ASGI servers lower-case header names
+        self.headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        self._body: Optional[bytes] = None
+
+    @property
+    def state(self) -> dict:
+        """Per-request state shared with the access log, the same dict Starlette's request.state uses"""
+        return self.scope.setdefault("state", {})
+
+    @property
+    def has_body(self) -> bool:
+        return "content-length" in self.headers or "transfer-encoding" in self.headers
+
+    async def body(self) -> bytes:
+        if self._body is None:
+            self._body = b"".join([chunk async for chunk in self.stream()])
+        return self._body
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        if self._body is not None:
+            yield self._body
+            return
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            if chunk:
+                yield chunk
+            if not message.get("more_body", False):
+                return
+
+
+async def send_response(send, status: int, body: bytes = b"", headers: Optional[list] = None):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": (headers or []) + [(b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_streamed(receive, send, response: httpx.Response, chunks: Optional[AsyncIterator[bytes]] = None):
+    """Pipe an upstream response to the client chunk by chunk, keeping its headers
+
+    chunks replaces response.aiter_raw() when part of the body was already read.
+    """
+    await send_chunks(
+        receive, send, response.status_code,
+        [(name, value) for name, value in response.headers.raw if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS],
+        chunks if chunks is not None else response.aiter_raw(),
+        response.aclose,
+    )
+
+
+async def send_chunks(receive, send, status: int, headers: list, chunks: AsyncIterator[bytes], aclose: Callable[[], Awaitable[None]]):
+    """Send a response body as it is produced, then call aclose
+
+    Stops reading chunks as soon as the client disconnects.
+    """
+    disconnected = False
+
+    async def watch_disconnect():
+        nonlocal disconnected
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected = True
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        async for chunk in chunks:
+            if disconnected:
+                return
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        await aclose()
+
+
+class ProxyCoreMiddleware:
+    """Pure ASGI middleware forwarding every HTTP request FastAPI doesn't serve itself
+
+    Added innermost, so forwarded requests still pass the CORS, access log and
+    metrics middleware but skip FastAPI's router, dependency injection and
+    exception handlers. local() returns the paths FastAPI serves, or None to
+    hand every request to FastAPI.
+    """
+
+    def __init__(self, app, forward: Callable[[ProxyRequest, Callable], Awaitable[None]], local: Callable[[], Optional[frozenset]]):
+        self.app = app
+        self.forward = forward
+        self.local = local
+
+    async def __call__(self, scope, receive, send):
+        local = self.local() if scope["type"] == "http" else None
+        if local is None or scope["path"] in local:
+            return await self.app(scope, receive, send)
+        await self.forward(ProxyRequest(scope, receive), send)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from shared_cache import SharedCache
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class RoleCache:
+    """Known-provisioned user roles with TTL, plus single-flight provisioning per user
+
+    With a shared cache, a role provisioned by any worker is known to all of them.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 3600.0,
+        max_entries: int = 100000,
+        clock: Callable[[], float] = time.monotonic,
+        shared: Optional[SharedCache] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.shared = shared
+        self._known: "OrderedDict[str, float]" = OrderedDict()
+        self._flights = SingleFlight(on_error=self._failed)
+        self.hits = 0
+        self.provisions = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.shared_hits = 0
+
+    @classmethod
+    def from_env(cls, shared: Optional[SharedCache] = None) -> "RoleCache":
+        return cls(
+            ttl=float(os.getenv("ROLE_CACHE_TTL", "3600")),
+            max_entries=int(os.getenv("ROLE_CACHE_MAX_ENTRIES", "100000")),
+            shared=shared,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def is_known(self, user_id: str) -> bool:
+        expires_at = self._known.get(user_id)
+        if expires_at is None:
+            return False
+        if expires_at <= self.clock():
+            del self._known[user_id]
+            return False
+        return True
+
+    def mark_known(self, user_ids: Iterable[str]):
+        if not self.enabled:
+            return
+        expires_at = self.clock() + self.ttl
+        for user_id in user_ids:
+            self._known[user_id] = expires_at
+            self._known.move_to_end(user_id)
+        while len(self._known) > self.max_entries:
+            self._known.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None) -> int:
+        """Forget one user (or every user) so the next request provisions again"""
+        if user_id is None:
+            count = len(self._known)
+            self._known.clear()
+            return count
+        return 1 if self._known.pop(user_id, None) is not None else 0
+
+    async def forget(self, user_id: Optional[str] = None) -> int:
+        """invalidate() in this process and in the shared cache"""
+        count = self.invalidate(user_id)
+        if self.shared is not None:
+            count = max(count, await self.shared.delete("role", user_id))
+        return count
+
+    async def ensure(self, user_id: str, provision: Callable[[str], Awaitable[None]]):
+        """Run provision(user_id) unless the role is known; concurrent callers share one call"""
+        if self.is_known(user_id):
+            self.hits += 1
+            return
+
+        task, started = self._flights.get_or_start(user_id, lambda: self._provision(user_id, provision))
+        self.coalesced += not started
+        await SingleFlight.join(task)
+
+    async def _provision(self, user_id: str, provision: Callable[[str], Awaitable[None]]):
+        if self.shared is not None and self.enabled and await self.shared.get("role", user_id) is not None:
+            self.shared_hits += 1
+        else:
+            self.provisions += 1
+            await provision(user_id)
+            if self.shared is not None and self.enabled:
+                await self.shared.set("role", user_id, b"1", self.ttl)
+        self.mark_known([user_id])
+
+    def _failed(self, user_id: str, error: BaseException):
+        self.failures += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "known_roles": len(self._known),
+            "in_flight": len(self._flights),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "provisions": self.provisions,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "shared_hits": self.shared_hits,
+        }
+
+
+class RoleBatcher:
+    """Coalesces first-seen users into micro-batches for one bulk provisioning call
+
+    A batch is sent when it reaches max_batch users or window seconds after its
+    first user arrived, whichever comes first. A failed batch fails every user
+    in it, so each of them is retried on their next request.
+    """
+
+    def __init__(
+        self,
+        provision_many: Callable[[list], Awaitable[None]],
+        max_batch: int = 100,
+        window: float = 0.005,
+    ):
+        self._provision_many = provision_many
+        self.max_batch = max_batch
+        self.window = window
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running = set()
+        self.batches = 0
+        self.batched_users = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+
+    @classmethod
+    def from_env(cls, provision_many: Callable[[list], Awaitable[None]]) -> "RoleBatcher":
+        return cls(
+            provision_many,
+            max_batch=int(os.getenv("ROLE_BATCH_SIZE", "100")),
+            window=float(os.getenv("ROLE_BATCH_WINDOW_MS", "5")) / 1000,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch > 1
+
+    async def provision(self, user_id: str):
+        """Provision user_id as part of the next batch"""
+        future = self._pending.get(user_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._pending[user_id] = loop.create_future()
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush)
+        await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _send(self, batch: Dict[str, asyncio.Future]):
+        self.batches += 1
+        self.batched_users += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            await self._provision_many(list(batch))
+        except Exception as e:
+            self.failed_batches += 1
+            logger.error("Failed to provision a batch of %d roles: %s", len(batch), e)
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in batch.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "max_batch": self.max_batch,
+            "window_ms": self.window * 1000,
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "batched_users": self.batched_users,
+            "largest_batch": self.largest_batch,
+            "failed_batches": self.failed_batches,
+            "mean_batch": round(self.batched_users / self.batches, 1) if self.batches else 0.0,
+        }
@@ -0,0 +1,49 @@
+"""Launch the middleware under uvicorn.
+
+SERVER_MODE=development (the default) runs one process with the reloader.
+SERVER_MODE=production runs WEB_CONCURRENCY worker processes (default: one per
+CPU) without the reloader. With more than one worker, token, role and JWKS
+state goes through a shared cache (CACHE_BACKEND, default sqlite) so workers
+don't each start cold.
+
+    python server.py
+    SERVER_MODE=production WEB_CONCURRENCY=8 python server.py
+"""
+import os
+
+import uvicorn
+
+from shared_cache import SQLiteCache, default_sqlite_path
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    mode = os.getenv("SERVER_MODE", "development").lower()
+
+    if mode != "production":
+        uvicorn.run("main:app", host=host, port=port, reload=True, reload_dirs=[APP_DIR])
+        return
+
+    workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+    if workers > 1:
+        # Workers are started with the environment set here
+        os.environ.setdefault("CACHE_BACKEND", "sqlite")
+    if os.environ.get("CACHE_BACKEND") == "sqlite":
+        os.environ.setdefault("CACHE_SQLITE_PATH", default_sqlite_path())
+        SQLiteCache.reset(os.environ["CACHE_SQLITE_PATH"])
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        app_dir=APP_DIR,
+        log_level=os.getenv("UVICORN_LOG_LEVEL", "info"),
+        access_log=False,  # the middleware writes its own structured access log
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # optional, only needed for CACHE_BACKEND=redis
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("memory", "sqlite", "redis")
+
+T = TypeVar("T")
+
+
+def default_sqlite_path() -> str:
+    # tmpfs keeps the shared store in memory on Linux
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "jwt-middleware-cache.sqlite3")
+
+
+class SharedCache(ABC):
+    """Byte values with a TTL, shared by every worker process
+
+    Namespaces keep token, role and JWKS entries apart. Process-local caches
+    stay in front of this tier, so it's only consulted on a local miss.
+    """
+
+    name = "shared"
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        ...
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: Optional[str] = None) -> int:
+        """Delete one key, or the whole namespace when key is None"""
+
+    async def aclose(self):
+        pass
+
+    def _counted(self, value: Optional[bytes]) -> Optional[bytes]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "errors": self.errors,
+        }
+
+
+class SQLiteCache(SharedCache):
+    """Shared cache in a local SQLite file in WAL mode
+
+    Queries run on one dedicated thread per process, never on the event loop,
+    so a worker holding the write lock can't stall this worker's requests.
+    A query waits at most busy_timeout seconds for the lock; one that still
+    can't get it is logged and treated as a miss (reads) or skipped (writes).
+    """
+
+    name = "sqlite"
+    PURGE_EVERY = 1000  # writes between sweeps of expired rows
+
+    def __init__(self, path: Optional[str] = None, clock=time.time, busy_timeout: float = 0.05):
+        super().__init__()
+        self.path = path or default_sqlite_path()
+        self.clock = clock
+        self.busy_timeout = busy_timeout
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid = None
+
+    @staticmethod
+    def reset(path: str):
+        """Remove a store left over from an earlier run"""
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Only used from the query thread; opened there on first use
+        if self._connection is None:
+            # Tokens and roles live here: create the file private, SQLite gives -wal and -shm the same mode
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            # A store from an earlier run may have been created with the umask
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.chmod(self.path + suffix, 0o600)
+            self._connection = connection
+        return self._connection
+
+    async def _run(self, query: Callable[[sqlite3.Connection], T]) -> T:
+        # Connections and threads must not cross a fork, so start over in each worker process
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-cache")
+            self._connection = None
+            self._pid = os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: query(self.connection))
+
+    async def get(self, namespace: str, key: str) -> Optional[bytes]:
+        now = self.clock()
+        try:
+            row = await self._run(lambda connection: connection.execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (namespace, key, now)
+            ).fetchone())
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Shared cache read failed: %s", e)
+            return None
+        return self._counted(row[0] if row else None)
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        if ttl <= 0:
+            return
+        now = self.clock()
+        purge = (self.writes + 1) % self.PURGE_EVERY == 0
+
+        def write(connection: sqlite3.Connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, value, now + ttl)
+            )
+            if purge:
+                connection.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+        try:
+            await self._run(write)
+            self.writes += 1
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Shared cache write failed: %s", e)
+
+    async def delete(self, namespace: str, key: Optional[str] = None) -> int:
+        if key is None:
+            query, params = "DELETE FROM cache WHERE namespace = ?", (namespace,)
+        else:
+            query, params = "DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        try:
+            return await self._run(lambda connection: connection.execute(query, params).rowcount)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Shared cache delete failed: %s", e)
+            return 0
+
+    async def aclose(self):
+        if self._executor is not None and self._pid == os.getpid():
+            if self._connection is not None:
+                await self._run(lambda connection: connection.close())
+            self._executor.shutdown(wait=False)
+        self._connection = None
+        self._executor = None
+
+    def stats(self) -> dict:
+        return {**super().stats(), "path": self.path}
+
+
+class RedisCache(SharedCache):
+    """Shared cache in Redis, for workers spread over several hosts
+
+    Needs the optional `redis` package unless a compatible client is passed in.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "jwt-middleware:", client=None):
+        super().__init__()
+        if client is None:
+            if redis_asyncio is None:
+                raise RuntimeError("CACHE_BACKEND=redis needs the redis package: pip install redis")
+            client = redis_asyncio.from_url(url)
+        self.url = url
+        self.prefix = prefix
+        self.client = client
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    async def get(self, namespace: str, key: str) -> Optional[bytes]:
+        try:
+            return self._counted(await self.client.get(self._key(namespace, key)))
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Shared cache read failed: %s", e)
+            return None
+
+    async def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        if ttl <= 0:
+            return
+        try:
+            await self.client.set(self._key(namespace, key), value, px=max(int(ttl * 1000), 1))
+            self.writes += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Shared cache write failed: %s", e)
+
+    async def delete(self, namespace: str, key: Optional[str] = None) -> int:
+        try:
+            if key is not None:
+                return await self.client.delete(self._key(namespace, key))
+            keys = [name async for name in self.client.scan_iter(match=self._key(namespace, "*"))]
+            return await self.client.delete(*keys) if keys else 0
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Shared cache delete failed: %s", e)
+            return 0
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "url": self.url}
+
+
+def shared_cache_from_env() -> Optional[SharedCache]:
+    """The configured shared tier, or None when each process only caches locally"""
+    backend = os.getenv("CACHE_BACKEND", "memory").lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CACHE_BACKEND {backend!r}, expected one of {BACKENDS}")
+    if backend == "sqlite":
+        busy_timeout = float(os.getenv("CACHE_SQLITE_BUSY_TIMEOUT_MS", "50")) / 1000
+        return SQLiteCache(os.getenv("CACHE_SQLITE_PATH") or None, busy_timeout=busy_timeout)
+    if backend == "redis":
+        return RedisCache(os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    return None
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class SingleFlight:
+    """At most one call per key in flight; concurrent callers for the key share its result
+
+    on_error(key, exception) is called when a call fails, once, however many
+    callers were waiting on it. The call runs as its own task, so it finishes
+    (and fills whatever cache it feeds) even if every caller goes away.
+    """
+
+    def __init__(self, on_error: Optional[Callable[[Hashable, BaseException], None]] = None):
+        self.on_error = on_error
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    def __iter__(self):
+        return iter(list(self._inflight))
+
+    def start(self, key: Hashable, call: Callable[[], Awaitable]) -> asyncio.Future:
+        """Start call() for key; callers check `key in flights` first"""
+        task = asyncio.ensure_future(call())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._finished(key, t))
+        return task
+
+    def get_or_start(self, key: Hashable, call: Callable[[], Awaitable]) -> Tuple[asyncio.Future, bool]:
+        """The call in flight for key, or a new one from call(); True when this started it"""
+        task = self._inflight.get(key)
+        if task is not None:
+            return task, False
+        return self.start(key, call), True
+
+    def forget(self, key: Hashable):
+        """Let the next caller for key start a new call; the one in flight still finishes for its waiters"""
+        self._inflight.pop(key, None)
+
+    @staticmethod
+    async def join(task: asyncio.Future):
+        # Shield so a cancelled caller doesn't abort the call for the other waiters
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if self.on_error is not None and not task.cancelled() and task.exception() is not None:
+            self.on_error(key, task.exception())
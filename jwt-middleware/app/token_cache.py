@@ -0,0 +1,262 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+
+from shared_cache import SharedCache
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Rough per-entry bookkeeping cost (key digest, tuple, OrderedDict node, dicts)
+_ENTRY_OVERHEAD_BYTES = 600
+
+
+class TokenEntry:
+    """Verified upstream claims plus the PostgREST token minted from them"""
+
+    __slots__ = ("claims", "token", "payload", "expires_at", "size")
+
+    def __init__(self, claims: dict, token: str, payload: dict, expires_at: float):
+        self.claims = claims
+        self.token = token
+        self.payload = payload
+        self.expires_at = expires_at
+        self.size = _ENTRY_OVERHEAD_BYTES + len(token) + len(json.dumps(claims)) + len(json.dumps(payload))
+
+
+class TokenCache:
+    """Bounded LRU + TTL cache of verified tokens, keyed by a SHA-256 of the bearer token
+
+    With a shared cache, entries are written through to it and local misses
+    are looked up there, so a token verified by one worker is reused by all.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: int = 32 * 1024 * 1024,
+        max_ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.time,
+        shared: Optional[SharedCache] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self.shared = shared
+        self._entries: "OrderedDict[bytes, TokenEntry]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.shared_hits = 0
+
+    @classmethod
+    def from_env(cls, shared: Optional[SharedCache] = None) -> "TokenCache":
+        max_ttl = os.getenv("TOKEN_CACHE_MAX_TTL")
+        return cls(
+            max_entries=int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000")),
+            max_bytes=int(os.getenv("TOKEN_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+            max_ttl=float(max_ttl) if max_ttl else None,
+            shared=shared,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[TokenEntry]:
+        if not self.enabled:
+            return None
+        key = self.key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= self.clock():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, token: str, claims: dict, minted_token: str, payload: dict) -> Optional[TokenEntry]:
+        """Cache a verified token until the earlier of the upstream and minted expiries"""
+        if not self.enabled:
+            return None
+        expiries = [payload["exp"]]
+        if claims.get("exp") is not None:
+            expiries.append(claims["exp"])
+        if self.max_ttl is not None:
+            expiries.append(self.clock() + self.max_ttl)
+        return self._insert(self.key(token), TokenEntry(claims, minted_token, payload, min(expiries)))
+
+    def _insert(self, key: bytes, entry: TokenEntry) -> Optional[TokenEntry]:
+        if entry.expires_at <= self.clock() or entry.size > self.max_bytes:
+            return None
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.bytes += entry.size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return entry
+
+    async def fetch(self, token: str) -> Optional[TokenEntry]:
+        """Like get(), falling back to the shared cache on a local miss"""
+        entry = self.get(token)
+        if entry is not None or self.shared is None or not self.enabled:
+            return entry
+        key = self.key(token)
+        data = await self.shared.get("token", key.hex())
+        if data is None:
+            return None
+        record = json.loads(data)
+        entry = self._insert(key, TokenEntry(record["claims"], record["token"], record["payload"], record["expires_at"]))
+        if entry is not None:
+            self.shared_hits += 1
+        return entry
+
+    async def store(self, token: str, claims: dict, minted_token: str, payload: dict) -> Optional[TokenEntry]:
+        """Like put(), also writing the entry through to the shared cache"""
+        entry = self.put(token, claims, minted_token, payload)
+        if entry is not None and self.shared is not None:
+            record = {"claims": claims, "token": minted_token, "payload": payload, "expires_at": entry.expires_at}
+            await self.shared.set("token", self.key(token).hex(), json.dumps(record).encode(), entry.expires_at - self.clock())
+        return entry
+
+    def _remove(self, key: bytes):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "shared_hits": self.shared_hits,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class MintedTokenCache:
+    """PostgREST tokens minted per user, reused until refresh_ahead seconds before they expire
+
+    Keyed by whatever determines the minted claims (role, sub, email), so every
+    upstream token of a user maps to the same signed token. Inside the
+    refresh-ahead window the current token is still handed out while a
+    replacement is minted in the background. With min_remaining seconds or less
+    left, callers wait for a new one. Minting is single-flight per key.
+    """
+
+    def __init__(
+        self,
+        refresh_ahead: float = 300.0,
+        max_entries: int = 100000,
+        min_remaining: float = 5.0,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.refresh_ahead = refresh_ahead
+        self.max_entries = max_entries
+        self.min_remaining = min_remaining
+        self.clock = clock
+        self._entries: "OrderedDict[tuple, Tuple[str, dict]]" = OrderedDict()
+        self._flights = SingleFlight(on_error=self._failed)
+        self.hits = 0
+        self.mints = 0
+        self.refreshes = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    @classmethod
+    def from_env(cls) -> "MintedTokenCache":
+        return cls(
+            refresh_ahead=float(os.getenv("MINTED_TOKEN_REFRESH_AHEAD", "300")),
+            max_entries=int(os.getenv("MINTED_TOKEN_CACHE_MAX_ENTRIES", "100000")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    async def get(self, key: tuple, mint: Callable[[], Awaitable[Tuple[str, dict]]]) -> Tuple[str, dict]:
+        """The cached (token, payload) for key, calling mint() when there is none still usable"""
+        if not self.enabled:
+            self.mints += 1
+            return await mint()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            remaining = entry[1]["exp"] - self.clock()
+            if remaining > self.min_remaining:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if remaining <= self.refresh_ahead and key not in self._flights:
+                    self.refreshes += 1
+                    self._flights.start(key, lambda: self._mint(key, mint))
+                return entry
+
+        task, started = self._flights.get_or_start(key, lambda: self._mint(key, mint))
+        if started:
+            self.mints += 1
+        else:
+            self.coalesced += 1
+        return await SingleFlight.join(task)
+
+    async def _mint(self, key: tuple, mint: Callable[[], Awaitable[Tuple[str, dict]]]) -> Tuple[str, dict]:
+        entry = await mint()
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _failed(self, key: tuple, error: BaseException):
+        # A failed background refresh leaves the current token in place until it runs out
+        self.failures += 1
+        logger.warning("Minting a PostgREST token failed: %s", error)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "in_flight": len(self._flights),
+            "refresh_ahead": self.refresh_ahead,
+            "hits": self.hits,
+            "mints": self.mints,
+            "refreshes": self.refreshes,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+        }
@@ -0,0 +1,235 @@
+import logging
+import os
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport that counts requests, queued requests and new connections for pool stats
+
+    In-flight and queued requests are counted here rather than read from the
+    connection pool, whose request queue is private to httpcore.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests_total = 0
+        self.connections_opened = 0
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # httpcore only emits trace events once the request holds a connection,
+        # so the first event of any kind means it has left the pool queue.
+        queued = True
+
+        async def trace(event_name: str, info: dict):
+            nonlocal queued
+            if queued:
+                queued = False
+                self.waiting -= 1
+            if event_name == "connection.connect_tcp.complete":
+                self.connections_opened += 1
+
+        request.extensions = {**request.extensions, "trace": trace}
+        self.requests_total += 1
+        self.in_flight += 1
+        self.waiting += 1
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        finally:
+            if queued:
+                queued = False
+                self.waiting -= 1
+        # The connection stays checked out until the body has been consumed,
+        # so only drop the in-flight count once the response stream closes.
+        stream = response.stream
+        original_aclose = stream.aclose
+
+        async def aclose():
+            self.in_flight -= 1
+            await original_aclose()
+
+        stream.aclose = aclose
+        return response
+
+    def _connections(self) -> Optional[list]:
+        # Connection counts come from the pool's public connections list, but the
+        # pool itself hangs off a private httpx attribute, so look it up defensively.
+        connections = getattr(getattr(self, "_pool", None), "connections", None)
+        return list(connections) if connections is not None else None
+
+    def stats(self) -> dict:
+        connections = self._connections()
+        if connections is not None:
+            try:
+                idle = sum(1 for c in connections if c.is_idle())
+            except AttributeError:
+                connections = None
+        reused = max(self.requests_total - self.connections_opened, 0)
+        return {
+            "connections": len(connections) if connections is not None else None,
+            "active_connections": len(connections) - idle if connections is not None else None,
+            "idle_connections": idle if connections is not None else None,
+            "waiting_acquisitions": self.waiting,
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "connections_opened": self.connections_opened,
+            "reuse_ratio": round(reused / self.requests_total, 4) if self.requests_total else 0.0,
+        }
+
+
+class UpstreamClient:
+    """Lazily created, pooled httpx.AsyncClient for a single upstream"""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str = "",
+        *,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        write_timeout: float = 30.0,
+        pool_timeout: float = 5.0,
+        http2: bool = False,
+    ):
+        self.name = name
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=write_timeout,
+            pool=pool_timeout,
+        )
+        if http2 and not _http2_available():
+            logger.warning(f"HTTP/2 requested for {name} upstream but 'h2' is not installed; using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+        self._transport: Optional[InstrumentedTransport] = None
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, base_url: str = "", **defaults) -> "UpstreamClient":
+        """Build a client from <PREFIX>_* environment variables, falling back to UPSTREAM_*"""
+        def setting(key: str, parse, default):
+            fallback = parse(f"UPSTREAM_{key}", default)
+            return parse(f"{prefix}_{key}", fallback)
+
+        return cls(
+            name,
+            base_url,
+            max_connections=setting("MAX_CONNECTIONS", _env_int, defaults.get("max_connections", 100)),
+            max_keepalive_connections=setting("MAX_KEEPALIVE", _env_int, defaults.get("max_keepalive_connections", 20)),
+            keepalive_expiry=setting("KEEPALIVE_EXPIRY", _env_float, defaults.get("keepalive_expiry", 30.0)),
+            connect_timeout=setting("CONNECT_TIMEOUT", _env_float, defaults.get("connect_timeout", 5.0)),
+            read_timeout=setting("READ_TIMEOUT", _env_float, defaults.get("read_timeout", 30.0)),
+            write_timeout=setting("WRITE_TIMEOUT", _env_float, defaults.get("write_timeout", 30.0)),
+            pool_timeout=setting("POOL_TIMEOUT", _env_float, defaults.get("pool_timeout", 5.0)),
+            http2=setting("HTTP2", _env_bool, defaults.get("http2", False)),
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._transport = InstrumentedTransport(limits=self.limits, http2=self.http2)
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                transport=self._transport,
+            )
+            logger.info(f"Opened {self.name} upstream pool (http2={self.http2}, limits={self.limits})")
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info(f"Closed {self.name} upstream pool")
+        self._client = None
+
+    def stats(self) -> dict:
+        stats = {
+            "upstream": self.name,
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "open": self._client is not None and not self._client.is_closed,
+        }
+        if self._transport is not None:
+            stats.update(self._transport.stats())
+        return stats
+
+
+class UpstreamClients:
+    """Application-lifespan registry of pooled upstream clients"""
+
+    def __init__(self, postgrest: UpstreamClient, jwks: UpstreamClient):
+        self.postgrest = postgrest
+        self.jwks = jwks
+
+    @classmethod
+    def from_env(cls, postgrest_url: str) -> "UpstreamClients":
+        return cls(
+            # Sized to PostgREST's default db-pool; extra sockets would only queue there
+            postgrest=UpstreamClient.from_env(
+                "postgrest", "POSTGREST", postgrest_url,
+                max_connections=10,
+                max_keepalive_connections=10,
+            ),
+            # JWKS traffic is rare, so a couple of keep-alive connections is plenty
+            jwks=UpstreamClient.from_env(
+                "jwks", "JWKS",
+                max_connections=4,
+                max_keepalive_connections=2,
+                read_timeout=10.0,
+                http2=True,
+            ),
+        )
+
+    def __iter__(self):
+        return iter((self.postgrest, self.jwks))
+
+    async def aclose(self):
+        for upstream in self:
+            await upstream.aclose()
+
+    def stats(self) -> dict:
+        return {upstream.name: upstream.stats() for upstream in self}
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Runs the startup warm-up steps in the background and records how each went
+
+    Steps run concurrently, each bounded by timeout. A failed or timed-out step
+    is logged and recorded but doesn't fail startup: the request path still does
+    the same work lazily, the warm-up only moves it ahead of the first request.
+    """
+
+    def __init__(self, enabled: bool = True, timeout: float = 10.0, connections: int = 4, clock=time.perf_counter):
+        self.enabled = enabled
+        self.timeout = timeout
+        self.connections = connections
+        self.clock = clock
+        self.steps: Dict[str, dict] = {}
+        self.started_at: Optional[float] = None
+        self.elapsed: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls) -> "Warmup":
+        return cls(
+            enabled=os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes"),
+            timeout=float(os.getenv("WARMUP_TIMEOUT", "10")),
+            connections=int(os.getenv("WARMUP_CONNECTIONS", "4")),
+        )
+
+    @property
+    def done(self) -> bool:
+        return self.elapsed is not None
+
+    async def run(self, steps: Dict[str, Callable[[], Awaitable]]):
+        self.started_at = self.clock()
+        await asyncio.gather(*(self._step(name, step) for name, step in steps.items()))
+        self.elapsed = self.clock() - self.started_at
+        logger.info(f"Warm-up finished in {self.elapsed * 1000:.0f} ms: {self.steps}")
+
+    async def _step(self, name: str, step: Callable[[], Awaitable]):
+        started = self.clock()
+        try:
+            await asyncio.wait_for(step(), self.timeout)
+            status = "ok"
+        except asyncio.TimeoutError:
+            status = "timeout"
+            logger.error(f"Warm-up step {name} timed out after {self.timeout}s")
+        except Exception as e:
+            status = "error"
+            logger.error(f"Warm-up step {name} failed: {str(e)}")
+        self.steps[name] = {"status": status, "ms": round((self.clock() - started) * 1000, 3)}
+
+    def start(self, steps: Dict[str, Callable[[], Awaitable]]):
+        """Run the steps without holding up startup, so /health answers straight away"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(steps))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "done": self.done,
+            "elapsed_ms": round(self.elapsed * 1000, 3) if self.done else None,
+            "steps": self.steps,
+        }
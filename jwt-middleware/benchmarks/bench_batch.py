@@ -0,0 +1,122 @@
+"""A 20-operation unit of work as 20 proxied calls vs. one POST /batch.
+
+The work is 5 inserts, a PATCH of each inserted row by its returned id, and 10
+reads. It runs three ways through the in-process proxy:
+
+- sequential: 20 proxied calls, one after another, as run_test does
+- concurrent: 20 proxied calls, the independent ones in parallel
+- batch: one POST /batch
+
+Every client call pays --client-rtt-ms of simulated WAN round-trip. The stub
+PostgREST adds --latency-ms per operation. Reports wall time percentiles per
+unit of work.
+
+    python benchmarks/bench_batch.py --iterations 50 --client-rtt-ms 40
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from loadtest import percentiles
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+from upstream import UpstreamClient
+
+INSERTS = 5
+READS = 10
+
+
+class WANTransport(httpx.AsyncBaseTransport):
+    """Adds a fixed round-trip delay to every request"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, rtt: float):
+        self.transport = transport
+        self.rtt = rtt
+
+    async def handle_async_request(self, request):
+        await asyncio.sleep(self.rtt)
+        return await self.transport.handle_async_request(request)
+
+
+async def sequential(client, headers, iteration):
+    for n in range(INSERTS):
+        response = await client.post("/test", headers=headers, json={"id": iteration * 100 + n, "data": "new"})
+        row_id = response.json()[0]["id"]
+        await client.patch(f"/test?id=eq.{row_id}", headers=headers, json={"data": "updated"})
+    for n in range(READS):
+        await client.get(f"/test?select=id,data&limit={n + 1}", headers=headers)
+
+
+async def concurrent(client, headers, iteration):
+    async def insert_then_update(n):
+        response = await client.post("/test", headers=headers, json={"id": iteration * 100 + n, "data": "new"})
+        row_id = response.json()[0]["id"]
+        await client.patch(f"/test?id=eq.{row_id}", headers=headers, json={"data": "updated"})
+
+    await asyncio.gather(
+        *(insert_then_update(n) for n in range(INSERTS)),
+        *(client.get(f"/test?select=id,data&limit={n + 1}", headers=headers) for n in range(READS)),
+    )
+
+
+async def batched(client, headers, iteration):
+    operations = []
+    for n in range(INSERTS):
+        operations.append({"id": f"insert{n}", "method": "POST", "path": "test", "body": {"id": iteration * 100 + n, "data": "new"}})
+        operations.append({"method": "PATCH", "path": "test", "query": f"id=eq.${{insert{n}.0.id}}", "body": {"data": "updated"}})
+    operations.extend({"path": "test", "query": f"select=id,data&limit={n + 1}"} for n in range(READS))
+    response = await client.post("/batch", headers=headers, json={"operations": operations})
+    assert all(result["status"] < 400 for result in response.json()["results"])
+
+
+async def run(args):
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    main.token_cache = TokenCache()
+    main.minted_tokens = MintedTokenCache()
+    main.role_cache = RoleCache()
+    main.role_batcher = RoleBatcher(main.create_user_roles, max_batch=1)
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='batch-user')}"}
+
+    results = {"operations": 2 * INSERTS + READS, "client_rtt_ms": args.client_rtt_ms, "latency_ms": args.latency_ms}
+    async with StubPostgrest(rows=10, latency_ms=args.latency_ms) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url)
+        transport = WANTransport(httpx.ASGITransport(app=main.app), args.client_rtt_ms / 1000)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.get("/test", headers=headers)  # verify and provision up front
+            for mode, unit in (("sequential", sequential), ("concurrent", concurrent), ("batch", batched)):
+                samples = []
+                stub.requests = 0
+                for iteration in range(args.iterations):
+                    started = time.perf_counter()
+                    await unit(client, headers, iteration)
+                    samples.append((time.perf_counter() - started) * 1000)
+                results[mode] = {
+                    "client_calls": 1 if mode == "batch" else 2 * INSERTS + READS,
+                    "upstream_calls": stub.requests // args.iterations,
+                    "wall_ms": percentiles(samples),
+                }
+        await main.upstream.postgrest.aclose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--client-rtt-ms", type=float, default=40.0, help="simulated client-to-middleware round-trip")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="stub PostgREST latency per call")
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(parser.parse_args()))
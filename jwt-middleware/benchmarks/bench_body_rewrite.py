@@ -0,0 +1,62 @@
+"""Cost of stamping user_id into POST bodies of 1, 1k and 100k rows.
+
+Compares the old json.loads/json.dumps round trip (which only handled single
+objects) with body_rewrite.stamp_user_id using orjson and its stdlib fallback.
+
+    python benchmarks/bench_body_rewrite.py --rows 1 1000 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import body_rewrite
+
+
+def legacy_rewrite(body: bytes, user_id: str) -> bytes:
+    data = json.loads(body)
+    if isinstance(data, dict):
+        data["user_id"] = user_id
+    return json.dumps(data).encode()
+
+
+def stdlib_rewrite(body: bytes, user_id: str) -> bytes:
+    orjson, body_rewrite.orjson = body_rewrite.orjson, None
+    try:
+        return body_rewrite.stamp_user_id(body, user_id)
+    finally:
+        body_rewrite.orjson = orjson
+
+
+def timed(rewrite, body: bytes, min_seconds: float = 0.5) -> float:
+    iterations, elapsed = 0, 0.0
+    started = time.perf_counter()
+    while elapsed < min_seconds:
+        rewrite(body, "bench-user")
+        iterations += 1
+        elapsed = time.perf_counter() - started
+    return elapsed / iterations * 1e6
+
+
+def run(args):
+    results = {"orjson_available": body_rewrite.orjson is not None}
+    for rows in args.rows:
+        data = [{"data": f"row {i}", "amount": i, "tags": ["a", "b"]} for i in range(rows)]
+        body = json.dumps(data[0] if rows == 1 else data).encode()
+        modes = {"legacy_json": legacy_rewrite, "stamp_stdlib": stdlib_rewrite}
+        if body_rewrite.orjson is not None:
+            modes["stamp_orjson"] = body_rewrite.stamp_user_id
+        results[f"{rows}_rows"] = {
+            "body_bytes": len(body),
+            **{f"{mode}_us": round(timed(rewrite, body), 1) for mode, rewrite in modes.items()},
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1, 1000, 100000])
+    run(parser.parse_args())
@@ -0,0 +1,95 @@
+"""Upstream GETs for bursts of duplicate reads, without collapsing, with collapsing, and with the micro-cache.
+
+Simulates dashboard page loads: each of --users users fires --duplicates
+identical GET /test calls at once, over --panels distinct queries. That is
+repeated --loads times. Requests go through the proxy in-process against a
+stub PostgREST with the given latency, and the stub counts the reads that
+reach it.
+
+    python benchmarks/bench_collapse.py --users 20 --panels 4 --duplicates 10 --loads 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from collapse import RequestCollapser
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+from upstream import UpstreamClient
+
+
+async def page_loads(client: httpx.AsyncClient, tokens: list, args) -> list:
+    """Wall time of each page load, in ms"""
+    timings = []
+    for _ in range(args.loads):
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            client.get(f"/test?select=id,data&panel=eq.{panel}", headers={"Authorization": f"Bearer {token}"})
+            for token in tokens
+            for panel in range(args.panels)
+            for _ in range(args.duplicates)
+        ))
+        timings.append(round((time.perf_counter() - started) * 1000, 1))
+    return timings
+
+
+async def run(args):
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    tokens = [issuer.issue(sub=f"user-{i}") for i in range(args.users)]
+    modes = {
+        "off": RequestCollapser(enabled=False),
+        "collapse": RequestCollapser(enabled=True),
+        "collapse_and_cache": RequestCollapser(enabled=True, cache_ttl=args.cache_ttl),
+    }
+
+    requests = args.users * args.panels * args.duplicates * args.loads
+    results = {"requests": requests}
+    async with StubPostgrest(rows=args.rows, latency_ms=args.latency_ms) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url, max_connections=100, max_keepalive_connections=100)
+        main.token_cache = TokenCache()
+        main.minted_tokens = MintedTokenCache()
+        main.role_cache = RoleCache()
+        main.role_batcher = RoleBatcher(main.create_user_roles, max_batch=1)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            for token in tokens:
+                await client.get("/", headers={"Authorization": f"Bearer {token}"})  # verify and provision up front
+            for mode, collapser in modes.items():
+                main.collapser = collapser
+                stub.paths.clear()
+                timings = await page_loads(client, tokens, args)
+                upstream_gets = stub.paths.get("/test", 0)
+                results[mode] = {
+                    "upstream_gets": upstream_gets,
+                    "upstream_reduction": round(1 - upstream_gets / requests, 3),
+                    "page_load_ms": timings,
+                    "collapse": collapser.stats(),
+                }
+        await main.upstream.postgrest.aclose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--panels", type=int, default=4, help="distinct queries per page load")
+    parser.add_argument("--duplicates", type=int, default=10, help="identical calls per query per page load")
+    parser.add_argument("--loads", type=int, default=5, help="page loads per user")
+    parser.add_argument("--rows", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--cache-ttl", type=float, default=1.0, help="micro-cache TTL in seconds for the last mode")
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,97 @@
+"""Bytes on the wire and compression CPU per request, per encoding and payload size, and what a 304 saves.
+
+Runs the middleware under uvicorn in a subprocess, against a stub Authentik
+JWKS issuer and TablePostgrest. For each --rows size, GET /test?limit=N is
+requested --requests times with Accept-Encoding set to each encoding the
+middleware has installed, and once more as identity. The compression CPU
+time comes from the middleware's own counters (GET /debug/compression), so
+it excludes the proxying around it. Last, the request is repeated with the
+ETag from the first response in If-None-Match, which should get a bodyless
+304.
+
+The stub's rows are very alike, so ratios are better than on real data;
+compare the encodings with each other rather than with a real table.
+
+    python benchmarks/bench_compression.py --rows 1 10 100 1000 10000 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import httpx
+
+from compression import AVAILABLE
+from loadtest import percentiles, start_uvicorn
+from stub_authentik import StubIssuer, StubJWKSServer
+from stub_postgrest import TablePostgrest
+
+
+async def measure(client: httpx.AsyncClient, rows: int, encoding: str, requests: int) -> dict:
+    before = (await client.get("/debug/compression")).json()["compression"]
+    latencies, received, encoded_as = [], 0, None
+    for _ in range(requests):
+        started = time.perf_counter()
+        async with client.stream("GET", "/test", params={"limit": str(rows)}, headers={"Accept-Encoding": encoding}) as response:
+            assert response.status_code == 200, await response.aread()
+            body = b"".join([chunk async for chunk in response.aiter_raw()])
+        latencies.append((time.perf_counter() - started) * 1000)
+        received += len(body)
+        encoded_as = response.headers.get("content-encoding", "identity")
+    after = (await client.get("/debug/compression")).json()["compression"]
+    return {
+        "encoded_as": encoded_as,
+        "bytes_per_response": received // requests,
+        "compress_us_per_request": round((after["seconds"] - before["seconds"]) / requests * 1e6, 1),
+        "latency_ms": percentiles(latencies),
+    }
+
+
+async def not_modified(client: httpx.AsyncClient, rows: int) -> dict:
+    first = await client.get("/test", params={"limit": str(rows)}, headers={"Accept-Encoding": "identity"})
+    etag = first.headers.get("etag")
+    if etag is None:
+        return {"etag": None}
+    again = await client.get("/test", params={"limit": str(rows)}, headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+    return {"etag": etag, "status": again.status_code, "bytes": len(again.content), "bytes_saved": len(first.content) - len(again.content)}
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='compression-bench', ttl=86400)}"}
+    encodings = [encoding for encoding in ("zstd", "br", "gzip") if AVAILABLE[encoding]]
+    results = {"requests": args.requests, "encodings": encodings, "sizes": {}}
+    async with StubJWKSServer([issuer]) as jwks_server, TablePostgrest(rows=max(args.rows)) as stub:
+        env = {
+            "POSTGREST_URL": stub.url, "AUTHENTIK_URL": jwks_server.url, "LOG_LEVEL": "WARNING", "ACCESS_LOG": "false",
+            "COMPRESSION_MIN_BYTES": str(args.min_bytes),
+        }
+        process, url = await start_uvicorn(env)
+        try:
+            async with httpx.AsyncClient(base_url=url, headers=headers, timeout=None) as client:
+                await client.get("/test?limit=1")  # verify the token and provision the role up front
+                for rows in args.rows:
+                    size = results["sizes"][str(rows)] = {}
+                    for encoding in ["identity"] + encodings:
+                        size[encoding] = await measure(client, rows, encoding, args.requests)
+                    identity = size["identity"]["bytes_per_response"]
+                    for encoding in encodings:
+                        size[encoding]["ratio"] = round(size[encoding]["bytes_per_response"] / identity, 3)
+                    size["if_none_match"] = await not_modified(client, rows)
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--min-bytes", type=int, default=1024, help="COMPRESSION_MIN_BYTES for the middleware")
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
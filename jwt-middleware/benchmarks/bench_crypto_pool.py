@@ -0,0 +1,97 @@
+"""Proxy latency with JWT crypto inline on the event loop vs. offloaded to a worker pool.
+
+The verified-token cache is disabled so every request pays RS256 verify plus
+HS256 sign. Reports p50/p99 latency and req/s per execution mode at 1, 8 and 64
+concurrent clients against a stub PostgREST.
+
+    python benchmarks/bench_crypto_pool.py --requests 1000 --modes inline thread process
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from crypto_pool import CryptoExecutor
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+from upstream import UpstreamClient
+
+
+def percentile(samples: list, pct: float) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(pct) - 1] if len(samples) > 1 else samples[0]
+
+
+async def drive(client: httpx.AsyncClient, tokens: list, total: int, concurrency: int) -> tuple:
+    remaining = iter(range(total))
+    latencies = []
+    rejected = 0
+
+    async def worker():
+        nonlocal rejected
+        for i in remaining:
+            started = time.perf_counter()
+            response = await client.get("/test", headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"})
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code == 503:
+                rejected += 1
+            else:
+                response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, rejected, time.perf_counter() - started
+
+
+async def run(args):
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    main.token_cache = TokenCache(max_entries=0)
+    main.role_cache = RoleCache()
+    tokens = [issuer.issue(sub=f"user-{i}") for i in range(args.users)]
+    main.role_cache.mark_known(f"user-{i}" for i in range(args.users))
+
+    results = {}
+    async with StubPostgrest(latency_ms=args.latency_ms) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url, max_connections=10, max_keepalive_connections=10)
+        for mode in args.modes:
+            main.crypto = CryptoExecutor(mode, workers=args.workers, max_pending=args.max_pending)
+            results[mode] = {}
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+                await drive(client, tokens, 50, 4)  # warm-up, starts the pool workers
+                for concurrency in args.concurrency:
+                    latencies, rejected, elapsed = await drive(client, tokens, args.requests, concurrency)
+                    results[mode][f"c{concurrency}"] = {
+                        "p50_ms": round(percentile(latencies, 50), 2),
+                        "p99_ms": round(percentile(latencies, 99), 2),
+                        "requests_per_second": round(args.requests / elapsed, 1),
+                        "rejected_503": rejected,
+                    }
+            main.crypto.shutdown()
+        await main.upstream.postgrest.aclose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--modes", nargs="+", choices=["inline", "thread", "process"], default=["inline", "thread", "process"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-pending", type=int, default=256)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,100 @@
+"""Time and middleware RSS to pull a whole table: GET /export vs. offset paging through the proxy.
+
+Runs the middleware under uvicorn in a subprocess, against a stub Authentik
+JWKS issuer and TablePostgrest, a stub table of --rows rows. Each mode reads
+every row once:
+
+- export: GET /export?table=test as NDJSON and as CSV. The middleware pages
+  upstream with id=gt.N&limit=K and streams the rows out.
+- offset: the client pages /test?order=id&limit=K&offset=N through the proxy
+  and parses each page, which is how clients page today.
+
+Postgres reads and discards the rows an offset skips, so each offset page
+costs more than the last. The stub charges --offset-ns-per-row of latency per
+skipped row to model that; the default is roughly an index-ordered skip on a
+warm cache. The middleware's RSS is sampled while each mode runs.
+
+    python benchmarks/bench_export.py --rows 10000000 --chunk 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+from loadtest import RSSSampler, start_uvicorn
+from stub_authentik import StubIssuer, StubJWKSServer
+from stub_postgrest import TablePostgrest
+
+
+async def export(client: httpx.AsyncClient, format: str, chunk: int) -> dict:
+    received, lines = 0, 0
+    params = {"table": "test", "format": format, "chunk": str(chunk)}
+    async with client.stream("GET", "/export", params=params) as response:
+        assert response.status_code == 200, await response.aread()
+        async for piece in response.aiter_raw():
+            received += len(piece)
+            lines += piece.count(b"\n")
+    return {"rows": lines - (format == "csv"), "bytes": received}
+
+
+async def offset_paging(client: httpx.AsyncClient, chunk: int) -> dict:
+    rows, received, offset = 0, 0, 0
+    while True:
+        response = await client.get("/test", params={"order": "id", "limit": str(chunk), "offset": str(offset)})
+        assert response.status_code == 200, response.text
+        page = response.json()
+        rows += len(page)
+        received += len(response.content)
+        offset += chunk
+        if len(page) < chunk:
+            return {"rows": rows, "bytes": received}
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='export-bench', ttl=86400)}"}
+    results = {"rows": args.rows, "chunk": args.chunk, "offset_ns_per_row": args.offset_ns_per_row}
+    async with StubJWKSServer([issuer]) as jwks_server, TablePostgrest(rows=args.rows, offset_ns_per_row=args.offset_ns_per_row) as stub:
+        env = {
+            "POSTGREST_URL": stub.url, "AUTHENTIK_URL": jwks_server.url, "LOG_LEVEL": "WARNING", "ACCESS_LOG": "false",
+            "EXPORT_MAX_CHUNK_ROWS": str(args.chunk),
+        }
+        process, url = await start_uvicorn(env)
+        try:
+            async with httpx.AsyncClient(base_url=url, headers=headers, timeout=None) as client:
+                await client.get("/test?limit=1")  # verify the token and provision the role up front
+                for mode in args.modes:
+                    stub.requests = 0
+                    started = time.perf_counter()
+                    with RSSSampler(process.pid) as rss:
+                        if mode == "offset":
+                            result = await offset_paging(client, args.chunk)
+                        else:
+                            result = await export(client, mode.split("_", 1)[1], args.chunk)
+                    elapsed = time.perf_counter() - started
+                    results[mode] = {
+                        **result,
+                        "seconds": round(elapsed, 2),
+                        "rows_per_second": round(result["rows"] / elapsed),
+                        "upstream_requests": stub.requests,
+                        "rss": rss.stats(),
+                    }
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--chunk", type=int, default=5000, help="rows per page, for both the export and offset paging")
+    parser.add_argument("--offset-ns-per-row", type=float, default=50.0, help="stub latency per row an offset skips")
+    parser.add_argument("--modes", nargs="+", choices=["export_ndjson", "export_csv", "offset"], default=["export_ndjson", "export_csv", "offset"])
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
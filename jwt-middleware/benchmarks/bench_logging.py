@@ -0,0 +1,106 @@
+"""Per-request logging overhead at each log level and debug sample rate.
+
+Requests go through the full proxy (cached token, known role) against a stub
+PostgREST, with log output written to /dev/null so only formatting and
+handler cost is measured. "off" disables logging entirely as the baseline;
+"legacy" approximates the old always-on DEBUG f-string logging.
+
+    python benchmarks/bench_logging.py --requests 2000 --sample-rates 0 0.01 1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import logs
+import main
+from logs import JsonFormatter, access_logger
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+from upstream import UpstreamClient
+
+
+def configure(level: str, devnull):
+    logging.disable(logging.NOTSET)
+    root = logging.getLogger()
+    root.handlers = [logging.StreamHandler(devnull)]
+    access_logger.handlers = [logging.StreamHandler(devnull)]
+    access_logger.handlers[0].setFormatter(JsonFormatter())
+    access_logger.propagate = False
+    access_logger.setLevel(logging.INFO)
+    if level == "off":
+        logging.disable(logging.CRITICAL)
+    else:
+        root.setLevel(logging.DEBUG if level == "legacy" else level)
+        main.logger.setLevel(logging.NOTSET)
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.DEBUG if level == "legacy" else logging.WARNING)
+
+
+async def drive(client: httpx.AsyncClient, token: str, total: int) -> float:
+    headers = {"Authorization": f"Bearer {token}"}
+    started = time.perf_counter()
+    for _ in range(total):
+        response = await client.get("/test", headers=headers)
+        response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def run(args):
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    main.token_cache = TokenCache()
+    main.role_cache = RoleCache()
+    main.role_cache.mark_known(["bench-user"])
+    token = issuer.issue(sub="bench-user")
+
+    runs = [("off", None), ("INFO", None), ("legacy", 1.0)]
+    runs[2:2] = [("DEBUG", rate) for rate in args.sample_rates]
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        async with StubPostgrest(rows=args.rows) as stub:
+            main.POSTGREST_URL = stub.url
+            main.upstream.postgrest = UpstreamClient("postgrest", stub.url, max_connections=10, max_keepalive_connections=10)
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+                configure("off", devnull)
+                await drive(client, token, 200)  # warm-up
+                # Interleave the configurations so drift in the machine hits all of them alike
+                samples = {run: [] for run in runs}
+                for _ in range(args.repeat):
+                    for level, rate in runs:
+                        configure(level, devnull)
+                        logs.DEBUG_SAMPLE_RATE = 1.0 if rate is None else rate
+                        samples[level, rate].append(await drive(client, token, args.requests))
+            for (level, rate), elapsed in samples.items():
+                elapsed = min(elapsed)
+                name = level if rate is None or level == "legacy" else f"{level}@{rate}"
+                results[name] = {
+                    "us_per_request": round(elapsed / args.requests * 1e6, 1),
+                    "requests_per_second": round(args.requests / elapsed, 1),
+                }
+            await main.upstream.postgrest.aclose()
+
+    logging.disable(logging.CRITICAL)
+    baseline = results["off"]["us_per_request"]
+    for result in results.values():
+        result["overhead_us"] = round(result["us_per_request"] - baseline, 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--sample-rates", type=float, nargs="+", default=[0.0, 0.01, 1.0])
+    asyncio.run(run(parser.parse_args()))
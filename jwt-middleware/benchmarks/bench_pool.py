@@ -0,0 +1,99 @@
+"""Compare proxy throughput with the pooled upstream client vs. a fresh client per request.
+
+The middleware app runs in-process behind httpx's ASGI transport and forwards
+to a local stub PostgREST over real TCP. The "fresh-client" mode reproduces the
+old behaviour of opening a new httpx.AsyncClient (and TCP connection) for every
+proxied request; "pooled" uses the lifespan-scoped client from upstream.py.
+
+    python benchmarks/bench_pool.py --requests 2000 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from stub_postgrest import StubPostgrest
+from upstream import UpstreamClient
+
+
+class FreshClientUpstream:
+    """Stand-in for UpstreamClient that hands out a brand new AsyncClient on every access"""
+
+    name = "postgrest"
+
+    def __init__(self):
+        self._clients = []
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        client = httpx.AsyncClient()
+        self._clients.append(client)
+        return client
+
+    async def aclose(self):
+        for client in self._clients:
+            await client.aclose()
+        self._clients = []
+
+    def stats(self) -> dict:
+        return {"clients_created": len(self._clients)}
+
+
+async def drive(client: httpx.AsyncClient, total: int, concurrency: int) -> float:
+    remaining = iter(range(total))
+
+    async def worker():
+        for _ in remaining:
+            response = await client.get("/test")
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def run(args):
+    results = {}
+    async with StubPostgrest(rows=args.rows, latency_ms=args.latency_ms) as stub:
+        main.POSTGREST_URL = stub.url
+        modes = {
+            "fresh-client": FreshClientUpstream(),
+            "pooled": UpstreamClient.from_env(
+                "postgrest", "POSTGREST", stub.url,
+                max_connections=10,
+                max_keepalive_connections=10,
+            ),
+        }
+        for mode, postgrest in modes.items():
+            main.upstream.postgrest = postgrest
+            connections_before = stub.connections
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+                await drive(client, min(100, args.requests), args.concurrency)  # warm-up
+                elapsed = await drive(client, args.requests, args.concurrency)
+            results[mode] = {
+                "requests_per_second": round(args.requests / elapsed, 1),
+                "upstream_connections": stub.connections - connections_before,
+                "pool": postgrest.stats(),
+            }
+            await postgrest.aclose()
+    results["speedup"] = round(results["pooled"]["requests_per_second"] / results["fresh-client"]["requests_per_second"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""Per-request cost of the profiling hooks: off, enabled but idle, sampling 1 in N requests, and whole-process profiles.
+
+Requests go through the full proxy (cached token, known role) against a stub
+PostgREST, in process, one at a time. "off" is the baseline; "idle" has
+profiling enabled with the loop monitor running and no request sampling;
+"every_N" profiles every Nth request with the stack sampler; "process_*"
+runs a whole-process profile with the sampler or cProfile for the whole
+run. Configurations are interleaved in rotating order and the best of
+--repeat runs is kept.
+
+    python benchmarks/bench_profiling.py --requests 2000 --sample-every 100 10 1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from profiling import Profiling
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+from upstream import UpstreamClient
+
+
+async def drive(client: httpx.AsyncClient, token: str, total: int) -> float:
+    headers = {"Authorization": f"Bearer {token}"}
+    started = time.perf_counter()
+    for _ in range(total):
+        response = await client.get("/test", headers=headers)
+        response.raise_for_status()
+    return time.perf_counter() - started
+
+
+def configure(name: str, interval: float) -> Profiling:
+    if name == "off":
+        return Profiling()
+    sample_every = int(name.split("_", 1)[1]) if name.startswith("every_") else 0
+    profiling = Profiling(enabled=True, token="bench", sample_every=sample_every, interval=interval)
+    profiling.start()
+    if name.startswith("process_"):
+        profiling.start_process(profiling.max_seconds, name.split("_", 1)[1])
+    return profiling
+
+
+async def run(args):
+    logging.disable(logging.CRITICAL)
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    main.token_cache = TokenCache()
+    main.role_cache = RoleCache()
+    main.role_cache.mark_known(["bench-user"])
+    token = issuer.issue(sub="bench-user")
+
+    names = ["off", "idle"] + [f"every_{n}" for n in args.sample_every] + ["process_sampling", "process_cprofile"]
+    samples = {name: [] for name in names}
+    sampled = {name: 0 for name in names}
+    async with StubPostgrest(rows=args.rows) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url, max_connections=10, max_keepalive_connections=10)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            await drive(client, token, 200)  # warm-up
+            # Interleave the configurations, rotating their order, so drift in the machine hits all of them alike
+            for turn in range(args.repeat):
+                for name in names[turn % len(names):] + names[:turn % len(names)]:
+                    main.profiling = configure(name, args.interval_ms / 1000)
+                    samples[name].append(await drive(client, token, args.requests))
+                    sampled[name] = max(sampled[name], main.profiling.sampler.samples)
+                    main.profiling.stop()
+        await main.upstream.postgrest.aclose()
+
+    results = {}
+    for name, elapsed in samples.items():
+        elapsed = min(elapsed)
+        results[name] = {
+            "us_per_request": round(elapsed / args.requests * 1e6, 1),
+            "requests_per_second": round(args.requests / elapsed, 1),
+            "stack_samples": sampled[name],
+        }
+    baseline = results["off"]["us_per_request"]
+    for result in results.values():
+        result["overhead_us"] = round(result["us_per_request"] - baseline, 1)
+        result["overhead_pct"] = round((result["us_per_request"] / baseline - 1) * 100, 1)
+    print(json.dumps({"requests": args.requests, "interval_ms": args.interval_ms, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--sample-every", type=int, nargs="+", default=[100, 10, 1])
+    parser.add_argument("--interval-ms", type=float, default=5.0, help="stack sampler interval (PROFILING_INTERVAL_MS)")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,141 @@
+"""Open-loop overload and outage runs against a fault-injecting PostgREST.
+
+Requests arrive at a fixed --rate regardless of how fast they complete, like
+real traffic during a spike. The stub PostgREST has a --db-pool connection pool
+held for --latency-ms per request, so its capacity is db_pool / latency. The
+middleware's own connection pool is opened up to --connections so that without
+protection the excess piles up in PostgREST's queue.
+
+- overload: --rate req/s for --duration seconds, unprotected, with a static
+  concurrency limit, and with the adaptive (AIMD) limit
+- outage: the stub answers every request with 503, without and with the
+  circuit breaker
+
+Reports goodput, status counts, latency percentiles of successful and
+refused requests, the peak number of requests pending in the middleware and
+the peak queue in the stub's database pool.
+
+    python benchmarks/bench_protection.py --rate 400 --duration 3 --db-pool 10 --latency-ms 50
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from loadtest import percentiles
+from protection import CircuitBreaker, ConcurrencyLimiter, UpstreamGuard
+from stub_authentik import StubIssuer
+from stub_postgrest import FaultyPostgrest
+from token_cache import MintedTokenCache, TokenCache
+from upstream import UpstreamClient
+
+
+async def open_loop(client: httpx.AsyncClient, headers: dict, rate: float, duration: float) -> dict:
+    statuses, ok_ms, refused_ms = {}, [], []
+    pending, peak_pending = 0, 0
+
+    async def one():
+        nonlocal pending, peak_pending
+        pending += 1
+        peak_pending = max(peak_pending, pending)
+        started = time.perf_counter()
+        try:
+            response = await client.get("/test", headers=headers)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = "error"
+        finally:
+            pending -= 1
+        elapsed = (time.perf_counter() - started) * 1000
+        statuses[status] = statuses.get(status, 0) + 1
+        (ok_ms if status == 200 else refused_ms).append(elapsed)
+
+    tasks = []
+    started = time.perf_counter()
+    for n in range(int(rate * duration)):
+        delay = started + n / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one()))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return {
+        "goodput_rps": round(len(ok_ms) / elapsed, 1),
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "ok_ms": percentiles(ok_ms),
+        "refused_ms": percentiles(refused_ms),
+        "peak_pending": peak_pending,
+        "elapsed_s": round(elapsed, 2),
+    }
+
+
+def guard(args, mode: str) -> UpstreamGuard:
+    breaker = CircuitBreaker(failure_threshold=0 if mode in ("unprotected", "no_breaker") else 5, reset_timeout=1)
+    if mode == "unprotected":
+        return UpstreamGuard(ConcurrencyLimiter(), breaker, enabled=False)
+    limiter = ConcurrencyLimiter(
+        limit=args.db_pool,
+        max_queue=args.queue,
+        adaptive=mode == "adaptive",
+        min_limit=2,
+        max_limit=args.db_pool * 2,
+        latency_target=args.latency_ms * 2 / 1000,
+    )
+    return UpstreamGuard(limiter, breaker, deadline=args.deadline, queue_timeout=args.queue_timeout)
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    main.token_cache = TokenCache()
+    main.minted_tokens = MintedTokenCache()
+    main.ROLE_MODE = "shared"
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='protection-bench')}"}
+
+    results = {"config": {
+        "rate": args.rate, "duration": args.duration, "db_pool": args.db_pool, "latency_ms": args.latency_ms,
+        "capacity_rps": round(args.db_pool / (args.latency_ms / 1000), 1), "queue": args.queue,
+    }}
+    scenarios = [("overload", mode) for mode in ("unprotected", "static", "adaptive")]
+    scenarios += [("outage", mode) for mode in ("no_breaker", "breaker")]
+    for scenario, mode in scenarios:
+        async with FaultyPostgrest(db_pool=args.db_pool, latency_ms=args.latency_ms, rows=10) as stub:
+            stub.down = scenario == "outage"
+            main.upstream_guard = guard(args, mode)
+            main.POSTGREST_URL = stub.url
+            main.upstream.postgrest = UpstreamClient(
+                "postgrest", stub.url, max_connections=args.connections, max_keepalive_connections=args.connections,
+                pool_timeout=args.deadline, read_timeout=args.deadline,
+            )
+            limits = httpx.Limits(max_connections=None)
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", limits=limits, timeout=60) as client:
+                result = await open_loop(client, headers, args.rate, args.duration)
+            await main.upstream.postgrest.aclose()
+            result["upstream_calls"] = stub.requests
+            result["stub_peak_queue"] = stub.peak_waiting
+            result["guard"] = main.upstream_guard.stats()
+            results.setdefault(scenario, {})[mode] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=400, help="arrivals per second")
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--db-pool", type=int, default=10, help="stub PostgREST database pool size")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="time each request holds a database connection")
+    parser.add_argument("--connections", type=int, default=200, help="middleware connection pool size")
+    parser.add_argument("--queue", type=int, default=50, help="POSTGREST_QUEUE_SIZE for the protected runs")
+    parser.add_argument("--queue-timeout", type=float, default=0.5)
+    parser.add_argument("--deadline", type=float, default=30.0)
+    logging.disable(logging.CRITICAL)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
@@ -0,0 +1,89 @@
+"""Per-request overhead of the pure-ASGI proxy core vs. the FastAPI catch-all route.
+
+Drives main:app in-process with PROXY_CORE=asgi and PROXY_CORE=fastapi,
+against a zero-latency stub PostgREST. Requests are sent one at a time, so the
+latency is the middleware's own work plus one stub round-trip, and the
+difference between the cores is the framework overhead. Cores alternate over
+--rounds to spread out noise. Both anonymous and authenticated GETs (warm
+token and role caches) are measured.
+
+    python benchmarks/bench_proxy_core.py --requests 2000 --rounds 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from loadtest import percentiles
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+from upstream import UpstreamClient
+
+CORES = ("fastapi", "asgi")
+
+
+async def measure(client: httpx.AsyncClient, headers: dict, requests: int) -> list:
+    samples = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = await client.get("/test?select=id,data", headers=headers)
+        samples.append((time.perf_counter() - started) * 1e6)
+        assert response.status_code == 200, response.text
+    return samples
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    main.token_cache = TokenCache()
+    main.minted_tokens = MintedTokenCache()
+    main.role_cache = RoleCache()
+    main.role_cache.mark_known(["core-bench"])
+    auth = {"Authorization": f"Bearer {issuer.issue(sub='core-bench')}"}
+
+    samples = {(core, kind): [] for core in CORES for kind in ("anonymous", "authenticated")}
+    async with StubPostgrest(rows=args.rows) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            for core in CORES:
+                main.PROXY_CORE = core
+                await measure(client, auth, 200)  # warm caches and connections
+            for _ in range(args.rounds):
+                for core in CORES:
+                    main.PROXY_CORE = core
+                    samples[(core, "anonymous")] += await measure(client, {}, args.requests)
+                    samples[(core, "authenticated")] += await measure(client, auth, args.requests)
+        await main.upstream.postgrest.aclose()
+
+    results = {"requests": args.requests * args.rounds, "rows": args.rows}
+    for kind in ("anonymous", "authenticated"):
+        per_core = {core: percentiles(samples[(core, kind)]) for core in CORES}
+        means = {core: sum(samples[(core, kind)]) / len(samples[(core, kind)]) for core in CORES}
+        results[kind] = {
+            **{f"{core}_us": per_core[core] for core in CORES},
+            **{f"{core}_mean_us": round(means[core], 1) for core in CORES},
+            "overhead_saved_us": round(means["fastapi"] - means["asgi"], 1),
+            "speedup": round(means["fastapi"] / means["asgi"], 3),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="requests per core, kind and round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=10)
+    logging.disable(logging.CRITICAL)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
@@ -0,0 +1,86 @@
+"""Onboarding benchmark: N never-seen users, one create_user_role RPC each vs. batched create_user_roles.
+
+Every user sends one authenticated GET through the proxy at the given
+concurrency against a stub PostgREST, so every request provisions a role.
+Reports wall time, provisioning RPC round-trips and batch sizes per mode. The
+stub's per-call latency stands in for the database round-trip; the SQL cost
+of CREATE ROLE itself is the same in both modes and isn't modelled.
+
+    python benchmarks/bench_role_batching.py --users 10000 --concurrency 256
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+from upstream import UpstreamClient
+
+
+async def onboard(client: httpx.AsyncClient, tokens: list, concurrency: int) -> float:
+    remaining = iter(tokens)
+
+    async def worker():
+        for token in remaining:
+            response = await client.get("/test", headers={"Authorization": f"Bearer {token}"})
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def run(args):
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    modes = {
+        "per_user": RoleBatcher(main.create_user_roles, max_batch=1),
+        "batched": RoleBatcher(main.create_user_roles, max_batch=args.batch_size, window=args.window_ms / 1000),
+    }
+
+    results = {"users": args.users, "concurrency": args.concurrency}
+    async with StubPostgrest(latency_ms=args.latency_ms) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url, max_connections=10, max_keepalive_connections=10)
+        for mode in args.modes:
+            # Fresh users per mode so every request provisions
+            tokens = [issuer.issue(sub=f"{mode}-user-{i}") for i in range(args.users)]
+            main.token_cache = TokenCache(max_entries=args.users)
+            main.role_cache = RoleCache(max_entries=args.users)
+            main.role_batcher = modes[mode]
+            stub.paths.clear()
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+                elapsed = await onboard(client, tokens, args.concurrency)
+            results[mode] = {
+                "seconds": round(elapsed, 2),
+                "users_per_second": round(args.users / elapsed, 1),
+                "create_user_role_rpcs": stub.paths.get("/rpc/create_user_role", 0),
+                "create_user_roles_rpcs": stub.paths.get("/rpc/create_user_roles", 0),
+                "batching": main.role_batcher.stats(),
+            }
+        await main.upstream.postgrest.aclose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--window-ms", type=float, default=5.0)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="stub PostgREST latency per call")
+    parser.add_argument("--modes", nargs="+", choices=["per_user", "batched"], default=["per_user", "batched"])
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,74 @@
+"""Load test: create_user_role RPCs per N proxied requests, with and without the role cache.
+
+Authenticated GETs for a fixed set of users are driven through the proxy at the
+given concurrency against a stub PostgREST, which counts /rpc/create_user_role
+calls. With the role cache the count should equal the number of distinct users.
+
+    python benchmarks/bench_roles.py --requests 10000 --users 100 --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+import main
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+from upstream import UpstreamClient
+
+
+async def drive(client: httpx.AsyncClient, tokens: list, total: int, concurrency: int) -> float:
+    remaining = iter(range(total))
+
+    async def worker():
+        for i in remaining:
+            response = await client.get("/test", headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"})
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def run(args):
+    issuer = StubIssuer()
+    main.jwks_manager = issuer.key_set()
+    tokens = [issuer.issue(sub=f"user-{i}") for i in range(args.users)]
+
+    results = {"requests": args.requests, "distinct_users": args.users}
+    async with StubPostgrest(latency_ms=args.latency_ms) as stub:
+        main.POSTGREST_URL = stub.url
+        main.upstream.postgrest = UpstreamClient("postgrest", stub.url, max_connections=10, max_keepalive_connections=10)
+        for mode, role_cache in (("uncached", RoleCache(ttl=0)), ("cached", RoleCache())):
+            main.token_cache = TokenCache()
+            main.role_cache = role_cache
+            stub.paths.clear()
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+                elapsed = await drive(client, tokens, args.requests, args.concurrency)
+            results[mode] = {
+                "create_user_role_rpcs": stub.paths.get("/rpc/create_user_role", 0),
+                "requests_per_second": round(args.requests / elapsed, 1),
+                "role_cache": role_cache.stats(),
+            }
+        await main.upstream.postgrest.aclose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(parser.parse_args()))
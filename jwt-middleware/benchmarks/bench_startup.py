@@ -0,0 +1,96 @@
+"""Time-to-ready and first-request latency of a fresh middleware, with and without warm-up.
+
+Starts main:app under uvicorn once per run, against a stub PostgREST and a stub
+Authentik JWKS endpoint that both add --latency-ms per call. Traffic is let in
+the way a load balancer would: on the first 200 from /health without warm-up,
+from /ready with it. Each run records, from process launch:
+
+- health_ms: when /health first answers (the process is up)
+- ready_ms: when /ready first returns 200
+- first_wave_ms: latencies of a burst of --burst new users' GETs sent as soon as traffic is let in
+- warm_wave_ms: the same burst for --burst other users once the first wave is done
+
+    python benchmarks/bench_startup.py --runs 5 --burst 20 --latency-ms 50 --crypto-execution process
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+from loadtest import percentiles, start_uvicorn
+from stub_authentik import StubIssuer, StubJWKSServer
+from stub_postgrest import StubPostgrest
+
+
+async def timed_get(client: httpx.AsyncClient, url: str, token: str) -> float:
+    started = time.perf_counter()
+    response = await client.get(url, headers={"Authorization": f"Bearer {token}"})
+    response.raise_for_status()
+    return (time.perf_counter() - started) * 1000
+
+
+async def wave(client: httpx.AsyncClient, url: str, tokens: list) -> list:
+    return await asyncio.gather(*(timed_get(client, f"{url}/test", token) for token in tokens))
+
+
+async def start_once(env: dict, gate: str, first_tokens: list, warm_tokens: list) -> dict:
+    launched = time.perf_counter()
+    server, url = await start_uvicorn(env)
+    health = time.perf_counter()
+    try:
+        async with httpx.AsyncClient(timeout=30) as client:
+            while gate == "/ready" and (await client.get(f"{url}/ready")).status_code != 200:
+                await asyncio.sleep(0.01)
+            ready = time.perf_counter()
+            first = await wave(client, url, first_tokens)
+            warm = await wave(client, url, warm_tokens)
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "health_ms": [(health - launched) * 1000],
+        "ready_ms": [(ready - launched) * 1000],
+        "first_wave_ms": first,
+        "warm_wave_ms": warm,
+    }
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    results = {"runs": args.runs, "burst": args.burst, "latency_ms": args.latency_ms, "crypto_execution": args.crypto_execution}
+    async with StubPostgrest(latency_ms=args.latency_ms) as stub, StubJWKSServer([issuer], latency_ms=args.latency_ms) as jwks:
+        for mode, enabled, gate in (("without_warmup", "false", "/health"), ("with_warmup", "true", "/ready")):
+            env = {
+                "POSTGREST_URL": stub.url,
+                "AUTHENTIK_URL": jwks.url,
+                "WARMUP_ENABLED": enabled,
+                "CRYPTO_EXECUTION": args.crypto_execution,
+                "LOG_LEVEL": "WARNING",
+                "ACCESS_LOG": "false",
+            }
+            samples = {}
+            for run_index in range(args.runs):
+                tokens = [issuer.issue(sub=f"startup-{mode}-{run_index}-{n}") for n in range(2 * args.burst)]
+                sample = await start_once(env, gate, tokens[:args.burst], tokens[args.burst:])
+                for key, values in sample.items():
+                    samples.setdefault(key, []).extend(values)
+            results[mode] = {key: percentiles(values) for key, values in samples.items()}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per mode")
+    parser.add_argument("--burst", type=int, default=20, help="concurrent new users in each wave")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="stub PostgREST and JWKS latency per call")
+    parser.add_argument("--crypto-execution", choices=["inline", "thread", "process"], default="inline")
+    logging.disable(logging.CRITICAL)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
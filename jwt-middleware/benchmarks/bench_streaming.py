@@ -0,0 +1,106 @@
+"""Memory benchmark: proxy a large result set and track the middleware's RSS.
+
+Starts a stub PostgREST in this process that streams SIZE_MB of JSON rows, runs
+the middleware under uvicorn in a subprocess, downloads GET /test through it and
+samples the subprocess's RSS while the body is in flight.
+
+    python benchmarks/bench_streaming.py --size-mb 500
+    python benchmarks/bench_streaming.py --size-mb 50 --modes streaming buffered
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+from stub_postgrest import StubPostgrest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+BYTES_PER_ROW = 52  # size of one stub row including the separator
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def start_middleware(stub_url: str, streaming: bool) -> tuple:
+    port = free_port()
+    env = {
+        **os.environ,
+        "POSTGREST_URL": stub_url,
+        "PROXY_STREAMING": "true" if streaming else "false",
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"{url}/health")
+                return process, url
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("middleware did not start")
+
+
+async def measure(stub: StubPostgrest, streaming: bool) -> dict:
+    process, url = await start_middleware(stub.url, streaming)
+    try:
+        baseline = rss_mb(process.pid)
+        peak = baseline
+        received = 0
+        started = time.perf_counter()
+        async with httpx.AsyncClient(timeout=None) as client:
+            async with client.stream("GET", f"{url}/test") as response:
+                async for chunk in response.aiter_raw():
+                    received += len(chunk)
+                    peak = max(peak, rss_mb(process.pid))
+        elapsed = time.perf_counter() - started
+        return {
+            "status": response.status_code,
+            "bytes": received,
+            "seconds": round(elapsed, 2),
+            "mb_per_second": round(received / elapsed / 1e6, 1),
+            "rss_baseline_mb": round(baseline, 1),
+            "rss_peak_mb": round(peak, 1),
+            "rss_growth_mb": round(peak - baseline, 1),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def run(args):
+    rows = int(args.size_mb * 1e6 / BYTES_PER_ROW)
+    results = {"rows": rows}
+    async with StubPostgrest(rows=rows) as stub:
+        for mode in args.modes:
+            results[mode] = await measure(stub, streaming=mode == "streaming")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=500)
+    parser.add_argument("--modes", nargs="+", choices=["streaming", "buffered"], default=["streaming"])
+    asyncio.run(run(parser.parse_args()))
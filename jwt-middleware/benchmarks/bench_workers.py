@@ -0,0 +1,177 @@
+"""Req/s scaling of the production server from 1 to N worker processes.
+
+Launches server.py in production mode with WEB_CONCURRENCY workers and the
+shared cache backend, against a stub PostgREST running in its own process.
+Load comes from several client processes so the load generator isn't the
+bottleneck. Reports req/s, latency percentiles, total RSS of the server's
+process tree and scaling efficiency (req/s per worker relative to 1 worker).
+Scaling is bounded by the cores available: run it on a machine with at least
+as many cores as the largest worker count plus the clients.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --requests 20000 --clients 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+from bench_streaming import free_port, rss_mb
+from loadtest import drive, parse_mix, percentiles, start_uvicorn
+from stub_authentik import StubIssuer, StubJWKSServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def tree_rss_mb(pid: int) -> float:
+    """RSS of a process and all of its descendants"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    total, pending = 0.0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            total += rss_mb(current)
+        except OSError:
+            pass
+        pending.extend(children.get(current, []))
+    return total
+
+
+def client_process(url: str, tokens: list, mix: dict, total: int, concurrency: int, seed: int, barrier, results):
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+            await drive(client, tokens, {"GET": 1}, concurrency * 4, concurrency, 64, seed)  # open connections
+            barrier.wait()
+            return await drive(client, tokens, mix, total, concurrency, 64, seed, keep_samples=True)
+
+    results.put(asyncio.run(run()))
+
+
+def run_clients(url: str, tokens: list, args) -> dict:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.clients + 1)
+    results = context.Queue()
+    share = args.requests // args.clients
+    processes = [
+        context.Process(target=client_process, args=(url, tokens, args.mix, share, args.concurrency, i, barrier, results))
+        for i in range(args.clients)
+    ]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    started = time.perf_counter()
+    collected = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+
+    samples = [sample for result in collected for sample in result["samples"]]
+    errors = {}
+    for result in collected:
+        for status, count in result["errors"].items():
+            errors[status] = errors.get(status, 0) + count
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "requests_per_second": round(len(samples) / elapsed, 1),
+        "latency_ms": percentiles(samples),
+    }
+
+
+async def start_stub(args) -> tuple:
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "stub_postgrest.py", "--port", str(port), "--rows", str(args.rows), "--latency-ms", str(args.latency_ms)],
+        cwd=BENCH_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"{url}/")
+                return process, url
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("stub PostgREST did not start")
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    tokens = [issuer.issue(sub=f"worker-bench-{i}", ttl=3600) for i in range(args.users)]
+    results = {}
+    stub, stub_url = await start_stub(args)
+    try:
+        async with StubJWKSServer([issuer]) as jwks_server:
+            for workers in args.workers:
+                env = {
+                    "POSTGREST_URL": stub_url,
+                    "AUTHENTIK_URL": jwks_server.url,
+                    "CACHE_BACKEND": args.backend,
+                    "LOG_LEVEL": "WARNING",
+                    "ACCESS_LOG": "false",
+                }
+                server, url = await start_uvicorn(env, workers, production=True)
+                try:
+                    # Let every worker finish starting before measuring
+                    await asyncio.sleep(1 + workers * 0.5)
+                    result = await asyncio.get_running_loop().run_in_executor(None, run_clients, url, tokens, args)
+                    result["rss_mb"] = round(tree_rss_mb(server.pid), 1)
+                    results[f"w{workers}"] = result
+                finally:
+                    server.terminate()
+                    server.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    base = results[f"w{args.workers[0]}"]["requests_per_second"] / args.workers[0]
+    for key, result in results.items():
+        workers = int(key[1:])
+        result["scaling_efficiency"] = round(result["requests_per_second"] / (base * workers), 3)
+    return {
+        "config": {
+            "cpus": os.cpu_count(),
+            "clients": args.clients,
+            "concurrency_per_client": args.concurrency,
+            "requests": args.requests,
+            "mix": args.mix,
+            "backend": args.backend,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=20000, help="requests per worker count, split over the clients")
+    parser.add_argument("--clients", type=int, default=4, help="load-generator processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent requests per client process")
+    parser.add_argument("--mix", nargs="+", default=["GET=70", "POST=10", "PATCH=10", "DELETE=10"])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite")
+    args = parser.parse_args()
+    args.mix = parse_mix(args.mix)
+    logging.disable(logging.CRITICAL)
+    print(json.dumps(asyncio.run(run(args)), indent=2))
@@ -0,0 +1,309 @@
+"""Reproducible load test of the proxy against a stub PostgREST and stub Authentik.
+
+Serves RS256 tokens from a stub JWKS issuer and answers the proxied calls with
+a stub PostgREST of configurable latency and payload size. Runs main:app
+in-process (httpx ASGITransport) or under uvicorn in a subprocess, drives a
+weighted GET/POST/PATCH/DELETE mix at each concurrency level and writes a JSON
+report with req/s, latency percentiles and RSS. Given --baseline, the report
+is diffed against an earlier one and the exit status is 1 when req/s or p99
+regress by more than --tolerance.
+
+    python benchmarks/loadtest.py --mode inprocess --concurrency 1 16 64 --output report.json
+    python benchmarks/loadtest.py --mode uvicorn --mix GET=70 POST=10 PATCH=10 DELETE=10 \\
+        --latency-ms 2 --rows 100 --baseline baseline.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import httpx
+
+from bench_streaming import APP_DIR, free_port, rss_mb
+from stub_authentik import StubIssuer, StubJWKSServer
+from stub_postgrest import StubPostgrest
+
+METHODS = ("GET", "POST", "PATCH", "DELETE")
+
+
+def parse_mix(pairs: list) -> dict:
+    mix = {}
+    for pair in pairs:
+        method, _, weight = pair.partition("=")
+        method = method.upper()
+        if method not in METHODS or not weight:
+            raise ValueError(f"Expected METHOD=WEIGHT with METHOD in {METHODS}, got {pair!r}")
+        mix[method] = float(weight)
+    return mix
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    cuts = statistics.quantiles(ordered, n=100, method="inclusive") if len(ordered) > 1 else [ordered[0]] * 99
+    return {
+        "p50": round(cuts[49], 3),
+        "p90": round(cuts[89], 3),
+        "p99": round(cuts[98], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+def request_for(method: str, body_bytes: int) -> dict:
+    """Arguments for one proxied request of the given method"""
+    if method == "GET":
+        return {"url": "/test", "params": {"select": "id,data,user_id"}}
+    if method == "POST":
+        return {"url": "/test", "json": {"data": "x" * body_bytes}}
+    if method == "PATCH":
+        return {"url": "/test", "params": {"id": "eq.1"}, "json": {"data": "y" * body_bytes}}
+    return {"url": "/test", "params": {"id": "eq.1"}}
+
+
+class RSSSampler:
+    """Samples a process's RSS in the background to record its peak"""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.start = self.peak = rss_mb(pid)
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, rss_mb(self.pid))
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+        self.end = rss_mb(self.pid)
+        self.peak = max(self.peak, self.end)
+
+    def stats(self) -> dict:
+        return {"start_mb": round(self.start, 1), "peak_mb": round(self.peak, 1), "end_mb": round(self.end, 1)}
+
+
+async def drive(
+    client: httpx.AsyncClient, tokens: list, mix: dict, total: int, concurrency: int, body_bytes: int, seed: int,
+    keep_samples: bool = False,
+) -> dict:
+    rng = random.Random(seed)
+    methods = rng.choices(list(mix), weights=list(mix.values()), k=total)
+    remaining = iter(enumerate(methods))
+    latencies = {method: [] for method in mix}
+    errors = {}
+
+    async def worker():
+        for i, method in remaining:
+            headers = {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, headers=headers, **request_for(method, body_bytes))
+                await response.aread()
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies[method].append((time.perf_counter() - started) * 1000)
+            if not isinstance(status, int) or status >= 400:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    everything = [sample for samples in latencies.values() for sample in samples]
+    result = {
+        "requests": total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1),
+        "latency_ms": percentiles(everything),
+        "by_method": {
+            method: {"requests": len(samples), "latency_ms": percentiles(samples)}
+            for method, samples in latencies.items() if samples
+        },
+    }
+    if keep_samples:
+        result["samples"] = everything
+    return result
+
+
+async def start_uvicorn(env: dict, workers: int = 1, production: bool = False) -> tuple:
+    """Run main:app under uvicorn in a subprocess and wait until /health answers
+
+    With production set it is launched through server.py in production mode.
+    """
+    port = free_port()
+    if production:
+        command = [sys.executable, "server.py"]
+        env = {
+            "SERVER_MODE": "production", "WEB_CONCURRENCY": str(workers), "HOST": "127.0.0.1",
+            "PORT": str(port), "UVICORN_LOG_LEVEL": "warning", **env,
+        }
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"]
+        if workers > 1:
+            command += ["--workers", str(workers)]
+    process = subprocess.Popen(
+        command, cwd=APP_DIR, env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"{url}/health")
+                return process, url
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("middleware did not start")
+
+
+async def run_levels(client: httpx.AsyncClient, tokens: list, args, pid: int) -> tuple:
+    # Warm-up: one request per user verifies every token and provisions every role
+    await drive(client, tokens, {"GET": 1}, max(len(tokens), 50), min(args.concurrency), args.body_bytes, args.seed)
+    results = {}
+    with RSSSampler(pid) as rss:
+        for concurrency in args.concurrency:
+            results[f"c{concurrency}"] = await drive(
+                client, tokens, args.mix, args.requests, concurrency, args.body_bytes, args.seed + concurrency
+            )
+    return results, rss.stats()
+
+
+async def run_inprocess(args, stub_url: str, jwks_url: str, tokens: list) -> tuple:
+    import main
+    from jwks import JWKSManager
+    from upstream import UpstreamClient
+
+    main.POSTGREST_URL = stub_url
+    main.upstream.postgrest = UpstreamClient.from_env("postgrest", "POSTGREST", stub_url, max_connections=10, max_keepalive_connections=10)
+    main.jwks_manager = JWKSManager(jwks_url, lambda: main.upstream.jwks.client)
+    async with main.lifespan(main.app):
+        limits = httpx.Limits(max_connections=None)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://loadtest", limits=limits) as client:
+            return await run_levels(client, tokens, args, os.getpid())
+
+
+async def run_uvicorn(args, stub_url: str, authentik_url: str, tokens: list) -> tuple:
+    env = {"POSTGREST_URL": stub_url, "AUTHENTIK_URL": authentik_url, "LOG_LEVEL": "WARNING", "ACCESS_LOG": "false"}
+    env.update(pair.split("=", 1) for pair in args.env)
+    process, url = await start_uvicorn(env, args.workers)
+    try:
+        limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+            return await run_levels(client, tokens, args, process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> dict:
+    """Relative change of req/s and p99 per concurrency level; regressions beyond tolerance are flagged"""
+    levels = {}
+    for level, result in report["results"].items():
+        before = baseline.get("results", {}).get(level)
+        if before is None:
+            continue
+        rps = result["requests_per_second"] / before["requests_per_second"] - 1
+        p99 = result["latency_ms"]["p99"] / before["latency_ms"]["p99"] - 1
+        levels[level] = {
+            "requests_per_second_change": round(rps, 4),
+            "p99_change": round(p99, 4),
+            "regression": rps < -tolerance or p99 > tolerance,
+        }
+    # Reports taken with different settings are not comparable; say so rather than guess
+    before = baseline.get("config", {})
+    differences = {
+        key: [before.get(key), value] for key, value in report["config"].items() if before.get(key) != value
+    }
+    return {
+        "tolerance": tolerance,
+        "config_differences": differences,
+        "levels": levels,
+        "regression": any(level["regression"] for level in levels.values()),
+    }
+
+
+async def run(args) -> dict:
+    issuer = StubIssuer()
+    tokens = [issuer.issue(sub=f"loadtest-user-{i}", ttl=3600) for i in range(args.users)]
+    async with StubJWKSServer([issuer]) as jwks_server, StubPostgrest(rows=args.rows, latency_ms=args.latency_ms) as stub:
+        if args.mode == "inprocess":
+            results, rss = await run_inprocess(args, stub.url, f"{jwks_server.url}/application/o/localparts/jwks/", tokens)
+        else:
+            results, rss = await run_uvicorn(args, stub.url, jwks_server.url, tokens)
+    return {
+        "config": {
+            "mode": args.mode,
+            "workers": args.workers if args.mode == "uvicorn" else 1,
+            "mix": args.mix,
+            "requests": args.requests,
+            "users": args.users,
+            "rows": args.rows,
+            "body_bytes": args.body_bytes,
+            "latency_ms": args.latency_ms,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+        "rss": rss,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument("--mix", nargs="+", default=["GET=70", "POST=10", "PATCH=10", "DELETE=10"])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=10, help="rows returned by each stub GET")
+    parser.add_argument("--body-bytes", type=int, default=64, help="size of the data field in POST/PATCH bodies")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="stub PostgREST latency per request")
+    parser.add_argument("--env", nargs="*", default=[], help="extra KEY=VALUE settings for the uvicorn subprocess")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier report to diff against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression, e.g. 0.1 for 10%%")
+    args = parser.parse_args(argv)
+    try:
+        args.mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.disable(logging.CRITICAL)
+    report = asyncio.run(run(args))
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            report["comparison"] = compare(report, json.load(baseline), args.tolerance)
+        regressed = report["comparison"]["regression"]
+
+    rendered = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(rendered + "\n")
+    else:
+        print(rendered)
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Fake Authentik issuer that signs RS256 tokens, plus a stub JWKS endpoint."""
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+from stub_postgrest import StubHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+
+class StubIssuer:
+    def __init__(self, kid: str = "stub-key-1", audience: str = "localparts"):
+        self.kid = kid
+        self.audience = audience
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        self.public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        ).decode()
+
+    def public_jwk(self) -> dict:
+        key = jwk.construct(self.public_pem, algorithm="RS256").to_dict()
+        return {**key, "kid": self.kid, "use": "sig"}
+
+    def jwks(self) -> dict:
+        return {"keys": [self.public_jwk()]}
+
+    def key_set(self):
+        """A JWKSManager preloaded with this issuer's key, for in-process use without HTTP"""
+        from jwks import JWKSManager
+
+        manager = JWKSManager("http://stub-authentik.invalid/jwks/", client=lambda: None)
+        manager.load(self.jwks())
+        return manager
+
+    def issue(self, sub: str = None, email: str = None, ttl: int = 3600, **claims) -> str:
+        sub = sub or str(uuid.uuid4())
+        now = int(time.time())
+        payload = {
+            "sub": sub,
+            "email": email or f"{sub}@example.com",
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + ttl,
+            **claims,
+        }
+        return jwt.encode(payload, self.private_pem, algorithm="RS256", headers={"kid": self.kid})
+
+
+class StubJWKSServer(StubHTTPServer):
+    """Serves the public keys of `issuers` with an ETag and Cache-Control max-age
+
+    Assign a new list to `issuers` to simulate a key rotation.
+    """
+
+    def __init__(self, issuers: list, max_age: int = 300, **kwargs):
+        super().__init__(**kwargs)
+        self.issuers = issuers
+        self.max_age = max_age
+
+    def respond(self, method, target, headers, body):
+        document = json.dumps({"keys": [issuer.public_jwk() for issuer in self.issuers]}).encode()
+        etag = '"%s"' % hashlib.sha256(document).hexdigest()[:16]
+        response_headers = {"ETag": etag, "Cache-Control": f"public, max-age={self.max_age}"}
+        if headers.get("if-none-match") == etag:
+            return 304, response_headers, b""
+        return 200, {**response_headers, "Content-Type": "application/json"}, document
@@ -0,0 +1,289 @@
+"""Minimal keep-alive HTTP/1.1 server that imitates PostgREST for benchmarks.
+
+It speaks just enough HTTP to be driven by httpx: GET returns a JSON array of
+rows, POST/PATCH echo the body back as a representation, DELETE returns 204
+and /rpc/* calls return 204. Latency and payload size are configurable; result
+sets above STREAM_ROWS rows are sent with chunked encoding without ever being
+built in memory. FaultyPostgrest adds a bounded database pool, injected errors
+and stalls for overload tests. TablePostgrest pages through a table of ids with
+id filters, limit and offset.
+
+    python stub_postgrest.py --port 3000 --rows 50 --latency-ms 2
+"""
+import argparse
+import asyncio
+import json
+import random
+from urllib.parse import parse_qsl
+
+STREAM_ROWS = 10000
+CHUNK_ROWS = 1000
+
+
+class StubHTTPServer:
+    """Keep-alive HTTP/1.1 server whose responses come from respond()"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency_ms / 1000.0
+        self.requests = 0
+        self.connections = 0
+        self.paths = {}
+        self._server = None
+        self._handlers = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def respond(self, method: str, target: str, headers: dict, body: bytes):
+        """Return (status, headers, body); body may be bytes or an iterable of chunks"""
+        raise NotImplementedError
+
+    async def handle(self, method: str, target: str, headers: dict, body: bytes):
+        """Wait out the configured latency, then respond()"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(method, target, headers, body)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+                elif headers.get("transfer-encoding", "").lower() == "chunked":
+                    body = await self._read_chunked(reader)
+
+                self.requests += 1
+                path = target.split("?", 1)[0]
+                self.paths[path] = self.paths.get(path, 0) + 1
+                status, extra_headers, payload = await self.handle(method, target, headers, body)
+                chunked = not isinstance(payload, bytes)
+                framing = {"Transfer-Encoding": "chunked"} if chunked else {"Content-Length": str(len(payload))}
+                response_headers = {**framing, **extra_headers}
+                writer.write(
+                    f"HTTP/1.1 {status} STUB\r\n".encode()
+                    + "".join(f"{k}: {v}\r\n" for k, v in response_headers.items()).encode()
+                    + b"\r\n"
+                )
+                if method == "HEAD":
+                    pass
+                elif chunked:
+                    for piece in payload:
+                        writer.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+                        await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    writer.write(payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(handler)
+            writer.close()
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+        while True:
+            size = int((await reader.readline()).strip().split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+
+class StubPostgrest(StubHTTPServer):
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, rows: int = 10, latency_ms: float = 0.0):
+        super().__init__(host, port, latency_ms)
+        self.rows = rows
+        self._payloads = {}
+
+    def payload(self, rows: int) -> bytes:
+        if rows not in self._payloads:
+            self._payloads[rows] = json.dumps(
+                [{"id": i, "data": f"row {i}", "user_id": "stub-user"} for i in range(rows)]
+            ).encode()
+        return self._payloads[rows]
+
+    def payload_chunks(self, rows: int):
+        """Yield a JSON array of rows in fixed-size pieces, reusing one pre-rendered chunk"""
+        rendered = [json.dumps({"id": i, "data": f"row {i}", "user_id": "stub-user"}).encode() for i in range(CHUNK_ROWS)]
+        chunk = b",".join(rendered)
+        yield b"["
+        for i in range(rows // CHUNK_ROWS):
+            yield (b"," if i else b"") + chunk
+        remainder = rows % CHUNK_ROWS
+        if remainder:
+            yield (b"," if rows >= CHUNK_ROWS else b"") + b",".join(rendered[:remainder])
+        yield b"]"
+
+    def respond(self, method: str, target: str, headers: dict, body: bytes):
+        path = target.split("?", 1)[0]
+        if path.startswith("/rpc/"):
+            return 204, {}, b""
+        if method in ("GET", "HEAD"):
+            body = self.payload_chunks(self.rows) if self.rows > STREAM_ROWS else self.payload(self.rows)
+            return 200, {"Content-Type": "application/json", "Content-Range": f"0-{self.rows - 1}/*", "ETag": '"stub"'}, body
+        if method == "POST":
+            data = json.loads(body) if body else {}
+            rows = data if isinstance(data, list) else [data]
+            return 201, {"Content-Type": "application/json"}, json.dumps(rows).encode()
+        if method == "PATCH":
+            return 200, {"Content-Type": "application/json"}, body or b"[]"
+        if method == "DELETE":
+            return 204, {}, b""
+        return 200, {"Content-Type": "application/json"}, b"{}"
+
+
+class FaultyPostgrest(StubPostgrest):
+    """A StubPostgrest that misbehaves the way an overloaded or failing PostgREST does
+
+    Every request holds one of db_pool connections for the latency, so
+    concurrency beyond the pool queues and latency grows with it. A request
+    that can't get a connection within pool_timeout_ms gets a 504, like
+    PostgREST's pool acquisition timeout. error_rate of requests fail with 503
+    and stall_rate hang for stall_ms first. Setting down answers everything
+    with 503 straight away.
+    """
+
+    def __init__(
+        self,
+        db_pool: int = 10,
+        pool_timeout_ms: float = 10000.0,
+        error_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall_ms: float = 30000.0,
+        seed: int = 0,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.pool = asyncio.Semaphore(db_pool)
+        self.pool_timeout = pool_timeout_ms / 1000.0
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall_ms / 1000.0
+        self.down = False
+        self.random = random.Random(seed)
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.faults = {}
+
+    def fault(self, status: int, message: str):
+        self.faults[status] = self.faults.get(status, 0) + 1
+        return status, {"Content-Type": "application/json"}, json.dumps({"message": message}).encode()
+
+    async def handle(self, method: str, target: str, headers: dict, body: bytes):
+        if self.down:
+            return self.fault(503, "Database unavailable")
+        if self.stall_rate and self.random.random() < self.stall_rate:
+            await asyncio.sleep(self.stall)
+        queued = self.pool.locked()
+        self.waiting += queued
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(self.pool.acquire(), self.pool_timeout)
+        except asyncio.TimeoutError:
+            return self.fault(504, "Timed out acquiring connection from connection pool")
+        finally:
+            self.waiting -= queued
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            self.pool.release()
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.fault(503, "Injected failure")
+        return self.respond(method, target, headers, body)
+
+
+class TablePostgrest(StubPostgrest):
+    """A StubPostgrest for a table with ids 1..rows that honours id=gt./id=lt. filters, limit and offset
+
+    Rows are rendered per request, so the table can be far larger than memory.
+    Postgres reads and throws away the rows an offset skips; offset_ns_per_row
+    charges that as latency, so deep offset pages slow down as they do on a
+    real table while keyset pages (id=gt.) stay flat.
+    """
+
+    def __init__(self, offset_ns_per_row: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.offset_cost = offset_ns_per_row / 1e9
+
+    async def handle(self, method: str, target: str, headers: dict, body: bytes):
+        offset = dict(parse_qsl(target.partition("?")[2])).get("offset")
+        if offset and self.offset_cost:
+            await asyncio.sleep(int(offset) * self.offset_cost)
+        return await super().handle(method, target, headers, body)
+
+    def respond(self, method: str, target: str, headers: dict, body: bytes):
+        path, _, query = target.partition("?")
+        if method != "GET" or path.startswith("/rpc/"):
+            return super().respond(method, target, headers, body)
+        after, last, limit, offset = 0, self.rows, None, 0
+        for name, value in parse_qsl(query):
+            operator, _, operand = value.partition(".")
+            if name == "id" and operator == "gt":
+                after = max(after, int(operand))
+            elif name == "id" and operator == "lt":
+                last = min(last, int(operand) - 1)
+            elif name == "limit":
+                limit = int(value)
+            elif name == "offset":
+                offset = int(value)
+        first = after + 1 + offset
+        if limit is not None:
+            last = min(last, first + limit - 1)
+        rows = b",".join([b'{"id":%d,"data":"row %d","user_id":"stub-user"}' % (i, i) for i in range(first, last + 1)])
+        content_range = f"{offset}-{offset + last - first}/*" if last >= first else "*/*"
+        return 200, {"Content-Type": "application/json", "Content-Range": content_range}, b"[" + rows + b"]"
+
+
+async def _serve(args):
+    async with StubPostgrest(args.host, args.port, args.rows, args.latency_ms) as stub:
+        print(f"Stub PostgREST listening on {stub.url}")
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,37 @@
+import logging
+import os
+import sys
+
+import httpx
+import pytest_asyncio
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(HERE, "..", "app"))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmarks"))
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+@pytest_asyncio.fixture
+async def proxy_client(monkeypatch):
+    """Returns an in-process client for the app, pointed at a PostgREST URL when given one
+
+    Clients and the upstream pool are closed when the test ends.
+    """
+    import main
+    from upstream import UpstreamClient
+
+    clients = []
+
+    async def connect(postgrest_url: str = None) -> httpx.AsyncClient:
+        if postgrest_url is not None:
+            monkeypatch.setattr(main, "POSTGREST_URL", postgrest_url)
+            monkeypatch.setattr(main.upstream, "postgrest", UpstreamClient("postgrest", postgrest_url))
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test")
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        await client.aclose()
+    await main.upstream.postgrest.aclose()
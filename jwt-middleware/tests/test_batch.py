@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from batch import BatchError, BatchOperation, plan, run_batch
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+
+
+def ops(*specs) -> list:
+    return [BatchOperation(**spec) for spec in specs]
+
+
+@pytest.mark.asyncio
+async def test_independent_operations_run_concurrently_and_dependents_wait():
+    started, release = [], asyncio.Event()
+
+    async def send(op):
+        started.append(op.path)
+        if op.path == "slow":
+            await release.wait()
+            return {"status": 201, "body": [{"id": 7}]}
+        return {"status": 200, "body": {"echo": op.query, "body": op.body}}
+
+    batch = asyncio.ensure_future(run_batch(ops(
+        {"id": "insert", "method": "POST", "path": "slow"},
+        {"id": "read", "path": "fast"},
+        {"id": "update", "method": "PATCH", "path": "test", "query": "id=eq.${insert.0.id}", "body": {"ref": "${insert.0.id}"}},
+    ), send))
+    await asyncio.sleep(0.01)
+    assert started == ["slow", "fast"]
+
+    release.set()
+    results = await batch
+    assert [r["id"] for r in results] == ["insert", "read", "update"]
+    # Whole-string placeholders keep their JSON type, embedded ones are formatted
+    assert results[2]["body"] == {"echo": "id=eq.7", "body": {"ref": 7}}
+
+
+@pytest.mark.asyncio
+async def test_failed_or_unresolvable_dependencies_skip_the_operation():
+    sent = []
+
+    async def send(op):
+        sent.append(op.id)
+        return {"status": 409 if op.id == "bad" else 201, "body": [{"id": 1}]}
+
+    results = await run_batch(ops(
+        {"id": "bad", "method": "POST", "path": "test"},
+        {"id": "after_bad", "path": "test", "depends_on": ["bad"]},
+        {"id": "good", "method": "POST", "path": "test"},
+        {"id": "missing_field", "path": "test", "query": "id=eq.${good.0.nope}"},
+    ), send)
+
+    assert sorted(sent) == ["bad", "good"]
+    assert [r["status"] for r in results] == [409, 424, 201, 424]
+    assert "bad" in results[1]["error"]
+
+
+def test_invalid_batches_are_rejected():
+    with pytest.raises(BatchError, match="unique"):
+        plan(ops({"id": "a", "path": "x"}, {"id": "a", "path": "y"}))
+    with pytest.raises(BatchError, match="unknown"):
+        plan(ops({"path": "x", "query": "id=eq.${nowhere.0.id}"}))
+    with pytest.raises(BatchError, match="cycle"):
+        plan(ops({"id": "a", "path": "x", "depends_on": ["b"]}, {"id": "b", "path": "${a.0.id}"}))
+    # Unnamed operations are addressed by position
+    assert plan(ops({"path": "x"}, {"path": "y", "depends_on": ["0"]})) == {"0": set(), "1": {"0"}}
+
+
+class RecordingStub(StubPostgrest):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = []
+
+    def respond(self, method, target, headers, body):
+        self.calls.append((method, target, json.loads(body) if body else None))
+        return super().respond(method, target, headers, body)
+
+
+@pytest.mark.asyncio
+async def test_batch_endpoint_authenticates_once_and_chains_an_insert(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "role_batcher", RoleBatcher(main.create_user_roles, max_batch=1))
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+
+    async with RecordingStub(rows=2) as stub:
+        client = await proxy_client(stub.url)
+        response = await client.post("/batch", headers=headers, json={"operations": [
+            {"id": "insert", "method": "POST", "path": "test", "body": {"id": 41, "data": "x", "user_id": "mallory"}},
+            {"path": "test", "query": "select=id", "headers": {"Range": "0-9", "Authorization": "Bearer forged"}},
+            {"method": "PATCH", "path": "test", "query": "id=eq.${insert.0.id}", "body": {"data": "y"}},
+        ]})
+        cycle = await client.post("/batch", headers=headers, json={"operations": [{"id": "a", "path": "${a.0.id}"}]})
+        unauthenticated = await client.post("/batch", json={"operations": []})
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(r["id"], r["status"]) for r in results] == [("insert", 201), ("1", 200), ("2", 200)]
+    assert results[0]["body"] == [{"id": 41, "data": "x", "user_id": "alice"}]
+    assert ("PATCH", "/test?id=eq.41", {"data": "y"}) in stub.calls
+    assert stub.paths["/rpc/create_user_role"] == 1
+    assert main.token_cache.stats()["misses"] == 1
+
+    assert cycle.status_code == 400
+    assert unauthenticated.status_code == 401
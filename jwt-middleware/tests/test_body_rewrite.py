@@ -0,0 +1,58 @@
+import gc
+import json
+
+import pytest
+
+from body_rewrite import gc_paused, is_json_content_type, stamp_user_id
+
+
+def test_stamps_single_object_and_overrides_client_value():
+    body = stamp_user_id(b'{"data": "x", "user_id": "someone-else"}', "alice")
+    assert json.loads(body) == {"data": "x", "user_id": "alice"}
+
+
+def test_stamps_every_row_of_bulk_insert():
+    rows = [{"data": str(i)} for i in range(1000)]
+    body = stamp_user_id(json.dumps(rows).encode(), "alice")
+    assert all(row["user_id"] == "alice" for row in json.loads(body))
+
+
+def test_leaves_empty_and_scalar_bodies_alone():
+    assert stamp_user_id(b"", "alice") == b""
+    assert stamp_user_id(b"42", "alice") == b"42"
+
+
+def test_invalid_json_raises_value_error():
+    with pytest.raises(ValueError):
+        stamp_user_id(b"{not json", "alice")
+
+
+def test_gc_comes_back_only_when_the_outermost_pause_ends():
+    assert gc.isenabled()
+    outer = gc_paused(True)
+    inner = gc_paused(True)
+    outer.__enter__()
+    inner.__enter__()
+    outer.__exit__(None, None, None)  # Overlapping, not nested: the outer pause ends first
+    assert not gc.isenabled()
+    inner.__exit__(None, None, None)
+    assert gc.isenabled()
+
+    gc.disable()
+    try:
+        with gc_paused(True):
+            pass
+        assert not gc.isenabled()  # Left off if it was off before
+    finally:
+        gc.enable()
+
+
+@pytest.mark.parametrize("content_type, expected", [
+    (None, True),
+    ("application/json", True),
+    ("application/json; charset=utf-8", True),
+    ("application/vnd.pgrst.object+json", True),
+    ("text/csv", False),
+])
+def test_is_json_content_type(content_type, expected):
+    assert is_json_content_type(content_type) is expected
@@ -0,0 +1,220 @@
+import asyncio
+import json
+
+import pytest
+import pytest_asyncio
+
+import main
+from collapse import RequestCollapser, SharedResponse, TooLargeToShare
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def responder(status: int = 200, cache_control: str = None):
+    calls = []
+
+    async def send():
+        calls.append(1)
+        headers = [(b"cache-control", cache_control.encode())] if cache_control else []
+        return SharedResponse(status, headers, b"[]")
+
+    return send, calls
+
+
+@pytest.mark.asyncio
+async def test_micro_cache_honours_ttl_and_upstream_cache_control():
+    clock = FakeClock()
+    collapser = RequestCollapser(enabled=True, cache_ttl=5, clock=clock)
+
+    send, calls = responder()
+    await collapser.fetch(("a",), send)
+    await collapser.fetch(("a",), send)
+    await collapser.fetch(("a",), send, no_cache=True)
+    clock.now += 5
+    await collapser.fetch(("a",), send)
+    assert len(calls) == 3
+
+    # max-age shortens the TTL; no-store, no-cache and errors are never kept
+    send, calls = responder(cache_control="max-age=1")
+    await collapser.fetch(("b",), send)
+    clock.now += 1
+    await collapser.fetch(("b",), send)
+    assert len(calls) == 2
+    uncacheable = [responder(cache_control="no-store"), responder(cache_control="private, no-cache"), responder(status=500)]
+    for key, (send, calls) in enumerate(uncacheable):
+        await collapser.fetch(key, send)
+        await collapser.fetch(key, send)
+        assert len(calls) == 2
+    assert collapser.stats()["cache_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_an_oversized_response_left_unclaimed_is_closed():
+    collapser = RequestCollapser(enabled=True)
+    closed = []
+    release = asyncio.Event()
+
+    class Response:
+        async def aclose(self):
+            closed.append(1)
+
+    async def send():
+        await release.wait()
+        raise TooLargeToShare(Response())
+
+    leader = asyncio.ensure_future(collapser.fetch(("k",), send))
+    joined = asyncio.ensure_future(collapser.fetch(("k",), send))
+    await asyncio.sleep(0)
+    leader.cancel()
+    release.set()
+    with pytest.raises(TooLargeToShare) as raised:
+        await joined
+    assert raised.value.response is None
+    await asyncio.sleep(0)
+    assert closed == [1]
+
+
+@pytest_asyncio.fixture
+async def proxy(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "role_batcher", main.RoleBatcher(main.create_user_roles, max_batch=1))
+
+    async with StubPostgrest(rows=3, latency_ms=50) as stub:
+        client = await proxy_client(stub.url)
+        yield issuer, stub, client
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_reads_share_one_upstream_call_per_user(monkeypatch, proxy):
+    issuer, stub, client = proxy
+    monkeypatch.setattr(main, "collapser", RequestCollapser(enabled=True))
+    alice, bob = ({"Authorization": f"Bearer {issuer.issue(sub=sub)}"} for sub in ("alice", "bob"))
+    for headers in (alice, bob):
+        await client.get("/other", headers=headers)  # verify and provision outside the burst
+
+    responses = await asyncio.gather(*(
+        client.get("/test?select=id", headers=alice if i % 2 else bob)
+        for i in range(20)
+    ))
+    assert {r.status_code for r in responses} == {200}
+    assert {r.content for r in responses} == {responses[0].content}
+    assert stub.paths["/test"] == 2  # one per user
+    assert main.collapser.stats()["collapsed"] == 18
+
+    # Writes always go upstream
+    await asyncio.gather(*(client.post("/test", json={"data": "x"}, headers=alice) for _ in range(5)))
+    assert stub.paths["/test"] == 7
+
+
+@pytest.mark.asyncio
+async def test_micro_cached_reads_answer_conditional_requests(monkeypatch, proxy):
+    issuer, stub, client = proxy
+    monkeypatch.setattr(main, "collapser", RequestCollapser(enabled=True, cache_ttl=60))
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+
+    first = await client.get("/test", headers=headers)
+    assert first.headers["etag"] == '"stub"'
+    revalidated = await client.get("/test", headers={**headers, "If-None-Match": '"stub"'})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    changed = await client.get("/test", headers={**headers, "If-None-Match": '"old"'})
+    assert changed.status_code == 200
+    assert changed.content == first.content
+    assert stub.paths["/test"] == 1
+
+    await client.get("/test", headers={**headers, "Cache-Control": "no-cache"})
+    await client.get("/test", headers={"Authorization": f"Bearer {issuer.issue(sub='bob')}"})
+    assert stub.paths["/test"] == 3
+
+
+@pytest.mark.asyncio
+async def test_a_write_drops_the_users_cached_reads_of_the_path(monkeypatch, proxy):
+    issuer, stub, client = proxy
+    monkeypatch.setattr(main, "collapser", RequestCollapser(enabled=True, cache_ttl=60))
+    alice, bob = ({"Authorization": f"Bearer {issuer.issue(sub=sub)}"} for sub in ("alice", "bob"))
+    row = {"id": 1, "data": "before"}
+    reads_held = asyncio.Event()
+    reads_held.set()
+    respond = stub.respond
+
+    async def table(method, target, headers, body):
+        if method == "GET":
+            await reads_held.wait()
+        if method == "PATCH":
+            row.update(json.loads(body))
+        if method in ("GET", "PATCH"):
+            return 200, {"Content-Type": "application/json"}, json.dumps([row]).encode()
+        if method == "DELETE" and row["data"] == "batched":
+            return 409, {"Content-Type": "application/json"}, b"{}"
+        return respond(method, target, headers, body)
+
+    monkeypatch.setattr(stub, "handle", table)
+    read = lambda: client.get("/test?id=eq.1", headers=alice)
+
+    assert (await read()).json() == [{"id": 1, "data": "before"}]
+    await client.get("/test?id=eq.1", headers=bob)
+    await client.get("/other", headers=alice)
+    patched = await client.patch("/test?id=eq.1", json={"data": "after"}, headers=alice)
+    assert patched.status_code == 200
+    assert (await read()).json() == [{"id": 1, "data": "after"}]
+    assert main.collapser.stats()["invalidated"] == 1  # bob's read and alice's other path stay cached
+
+    # A read in flight when the write lands is neither joined nor kept
+    main.collapser.clear()
+    reads_held.clear()
+    reading = asyncio.ensure_future(read())
+    await asyncio.sleep(0.05)
+    await client.patch("/test?id=eq.1", json={"data": "again"}, headers=alice)
+    after_write = asyncio.ensure_future(read())
+    await asyncio.sleep(0.05)
+    reads_held.set()
+    assert (await reading).json() == [{"id": 1, "data": "again"}]
+    assert (await after_write).json() == [{"id": 1, "data": "again"}]
+    assert main.collapser.stats()["collapsed"] == 0
+
+    # Batched writes drop the cache too; failed writes don't
+    await client.post("/batch", json={"operations": [
+        {"method": "PATCH", "path": "/test", "query": "id=eq.1", "body": {"data": "batched"}}
+    ]}, headers=alice)
+    assert (await read()).json() == [{"id": 1, "data": "batched"}]
+    before = main.collapser.stats()
+    assert (await client.delete("/test?id=eq.1", headers=alice)).status_code == 409
+    await read()
+    assert main.collapser.stats()["invalidated"] == before["invalidated"]
+    assert main.collapser.stats()["cache_hits"] == before["cache_hits"] + 1
+
+
+@pytest.mark.asyncio
+async def test_responses_past_the_byte_cap_are_streamed_not_shared(monkeypatch, proxy):
+    issuer, stub, client = proxy
+    monkeypatch.setattr(main, "collapser", RequestCollapser(enabled=True, cache_ttl=60, max_bytes=100_000))
+    headers = {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+    await client.get("/other", headers=headers)
+
+    # Chunked: the cap is passed while buffering; the caller that started the call streams the rest
+    stub.rows = 20000
+    responses = await asyncio.gather(*(client.get("/test", headers=headers) for _ in range(3)))
+    assert [len(response.json()) for response in responses] == [20000] * 3
+    assert stub.paths["/test"] == 3  # the two that joined fetch their own
+    assert main.collapser.stats()["too_large"] == 1
+
+    # With a Content-Length over the cap nothing is buffered, and nothing is cached either way
+    stub.rows = 3
+    main.collapser.max_bytes = 100
+    assert len((await client.get("/test", headers=headers)).json()) == 3
+    assert main.collapser.stats()["too_large"] == 2
+    assert main.collapser.stats()["cached"] == 1  # just /other
@@ -0,0 +1,105 @@
+import gzip
+import json
+
+import pytest
+import pytest_asyncio
+
+import main
+from compression import Compression, parse_accept_encoding
+from conditional import Conditional
+from stub_postgrest import StubPostgrest, TablePostgrest
+
+
+def test_negotiation_follows_client_weights_then_server_order():
+    compression = Compression(encodings=("gzip",))
+    assert parse_accept_encoding("gzip;q=0.5, br, *;q=0") == {"gzip": 0.5, "br": 1.0, "*": 0.0}
+    assert compression.negotiate("gzip, deflate") == "gzip"
+    assert compression.negotiate("br;q=1, gzip;q=0.1") == "gzip"
+    assert compression.negotiate("*") == "gzip"
+    assert compression.negotiate("gzip;q=0") is None
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate(None) is None
+
+
+@pytest_asyncio.fixture
+async def edge(monkeypatch, proxy_client):
+    monkeypatch.setattr(main, "compression", Compression(encodings=("gzip",), min_bytes=1024))
+    monkeypatch.setattr(main, "conditional", Conditional(max_bytes=64 * 1024))
+
+    async def serve(stub):
+        return await proxy_client(stub.url)
+
+    return serve
+
+
+@pytest.mark.asyncio
+async def test_large_json_is_gzipped_and_small_json_is_not(edge):
+    async with TablePostgrest(rows=500) as stub, await edge(stub) as client:
+        large = await client.get("/test?limit=200", headers={"Accept-Encoding": "gzip"})
+        small = await client.get("/test?limit=2", headers={"Accept-Encoding": "gzip"})
+        plain = await client.get("/test?limit=200", headers={"Accept-Encoding": "identity"})
+
+    assert large.headers["content-encoding"] == "gzip"
+    assert large.headers["vary"] == "Accept-Encoding"
+    assert [row["id"] for row in large.json()] == list(range(1, 201))
+    assert main.compression.stats()["bytes_out"] < main.compression.stats()["bytes_in"] / 3
+    assert "content-encoding" not in small.headers and len(small.json()) == 2
+    assert "content-encoding" not in plain.headers and plain.headers["vary"] == "Accept-Encoding"
+    assert plain.json() == large.json()
+    assert main.compression.stats()["compressed"] == {"gzip": 1}
+
+
+@pytest.mark.asyncio
+async def test_streamed_responses_are_compressed_chunk_by_chunk(edge):
+    async with StubPostgrest(rows=20000) as stub, await edge(stub) as client:
+        async with client.stream("GET", "/test", headers={"Accept-Encoding": "gzip"}) as response:
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert len(json.loads(gzip.decompress(raw))) == 20000
+    # Streamed, so not held back for an ETag; the upstream one is passed through, made weak
+    assert response.headers["etag"] == 'W/"stub"'
+
+
+@pytest.mark.asyncio
+async def test_chunked_responses_without_an_etag_are_not_held_back(edge):
+    async with StubPostgrest(rows=3) as stub, await edge(stub) as client:
+        stub.respond = lambda *args: (200, {"Content-Type": "application/json"}, iter([b"[1,", b"2]"]))
+        chunked = await client.get("/test")
+        stub.respond = lambda *args: (200, {"Content-Type": "application/json"}, b"[1,2]")
+        sized = await client.get("/test")
+
+    assert chunked.json() == [1, 2] and "etag" not in chunked.headers
+    assert sized.json() == [1, 2] and sized.headers["etag"].startswith('W/"')
+    assert main.conditional.stats()["streamed"] == 1 and main.conditional.stats()["generated"] == 1
+
+
+@pytest.mark.asyncio
+async def test_unchanged_reads_get_304_with_a_generated_etag(edge):
+    async with TablePostgrest(rows=50) as stub, await edge(stub) as client:
+        first = await client.get("/test?limit=20")
+        etag = first.headers["etag"]
+        again = await client.get("/test?limit=20", headers={"If-None-Match": etag})
+        changed = await client.get("/test?limit=21", headers={"If-None-Match": etag})
+
+    assert etag.startswith('W/"')
+    assert again.status_code == 304
+    assert again.content == b"" and again.headers["etag"] == etag
+    assert "content-type" not in again.headers
+    assert changed.status_code == 200 and len(changed.json()) == 21
+    assert main.conditional.stats()["not_modified"] == 1
+
+
+@pytest.mark.asyncio
+async def test_upstream_etags_are_passed_through_and_honoured(edge):
+    async with StubPostgrest(rows=3) as stub, await edge(stub) as client:
+        response = await client.get("/test", headers={"If-None-Match": '"other", "stub"'})
+        head = await client.head("/test", headers={"If-None-Match": "W/\"stub\""})
+
+    assert response.status_code == 304 and response.headers["etag"] == '"stub"'
+    assert head.status_code == 304
+    assert main.conditional.stats() == {
+        "enabled": True, "max_bytes": 65536, "generated": 0, "passed_through": 2, "not_modified": 2,
+        "too_large": 0, "streamed": 0,
+    }
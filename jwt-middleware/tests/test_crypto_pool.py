@@ -0,0 +1,56 @@
+import pytest
+from jose import JWTError, jwt
+
+import main
+from crypto_pool import CryptoExecutor, CryptoPoolSaturated
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from token_cache import TokenCache
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["inline", "thread", "process"])
+async def test_every_mode_verifies_and_signs(mode):
+    issuer = StubIssuer()
+    key = issuer.key_set().keys[issuer.kid]
+    crypto = CryptoExecutor(mode, workers=2)
+    try:
+        claims = await crypto.verify(issuer.issue(sub="alice"), key, algorithms=["RS256"], audience="localparts")
+        assert claims["sub"] == "alice"
+
+        with pytest.raises(JWTError):
+            await crypto.verify(StubIssuer().issue(), key, algorithms=["RS256"], audience="localparts")
+
+        token = await crypto.sign({"sub": "alice"}, "secret")
+        assert jwt.decode(token, "secret", algorithms=["HS256"]) == {"sub": "alice"}
+    finally:
+        crypto.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_saturated_pool_rejects_immediately():
+    crypto = CryptoExecutor("thread", workers=1, max_pending=0)
+    with pytest.raises(CryptoPoolSaturated):
+        await crypto.sign({"sub": "alice"}, "secret")
+    assert crypto.stats()["rejected"] == 1
+    crypto.shutdown()
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        CryptoExecutor("gpu")
+
+
+@pytest.mark.asyncio
+async def test_proxy_returns_503_with_retry_after_when_saturated(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "crypto", CryptoExecutor("thread", max_pending=0, retry_after=2))
+
+    client = await proxy_client()
+    response = await client.get("/test", headers={"Authorization": f"Bearer {issuer.issue()}"})
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "2"
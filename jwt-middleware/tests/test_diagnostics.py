@@ -0,0 +1,143 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from diagnostics import STEPS, run_passes, summarize
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+
+
+def test_summarize_uses_nearest_rank_percentiles():
+    summary = summarize([float(ms) for ms in range(1, 101)])
+    assert summary == {"count": 100, "mean": 50.5, "p50": 50.0, "p90": 90.0, "p99": 99.0, "max": 100.0}
+    assert summarize([]) == {"count": 0}
+
+
+@pytest.mark.asyncio
+async def test_run_passes_caps_concurrency_and_yields_in_completion_order():
+    in_flight, peak = 0, 0
+
+    async def run_pass(spec):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(spec["delay"])
+        in_flight -= 1
+        return spec
+
+    delays = [0.03, 0.01, 0.02, 0.01, 0.01]
+    finished = [spec["n"] async for spec in run_passes(
+        [{"n": n, "delay": delay} for n, delay in enumerate(delays)], run_pass, concurrency=2
+    )]
+    assert peak == 2
+    assert sorted(finished) == [0, 1, 2, 3, 4]
+    assert finished[0] == 1
+
+
+class CrudStub(StubPostgrest):
+    """Assigns ids to inserted rows so a /runtest pass can update and delete them
+
+    Requests whose method is in fail get a 403, as RLS refusing them would.
+    """
+
+    def __init__(self, fail=(), **kwargs):
+        super().__init__(**kwargs)
+        self.next_id = 0
+        self.inserted = []
+        self.fail = set(fail)
+
+    def respond(self, method, target, headers, body):
+        if method in self.fail and target.startswith("/test"):
+            return 403, {"Content-Type": "application/json"}, b'{"message": "permission denied"}'
+        if method == "POST" and target == "/test":
+            self.next_id += 1
+            row = {**json.loads(body), "id": self.next_id}
+            self.inserted.append(row)
+            return 201, {"Content-Type": "application/json"}, json.dumps([row]).encode()
+        return super().respond(method, target, headers, body)
+
+
+@pytest.fixture
+def authenticated(monkeypatch):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "role_batcher", RoleBatcher(main.create_user_roles, max_batch=1))
+    return {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+
+
+async def post_runtest(proxy_client, headers, fail=(), **params) -> tuple:
+    async with CrudStub(rows=1, fail=fail) as stub:
+        client = await proxy_client(stub.url)
+        response = await client.post("/runtest", headers=headers, params=params)
+    return response, stub
+
+
+@pytest.mark.asyncio
+async def test_runtest_keeps_its_default_passes_and_adds_timings(proxy_client, authenticated):
+    response, stub = await post_runtest(proxy_client, authenticated)
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result["status"] == "success"
+    assert [row["user_id"] for row in stub.inserted] == ["alice", "test_user_123"]
+    assert [p["user_id"] for p in result["passes"]] == ["alice", "test_user_123"]
+    for pass_results in result["passes"]:
+        assert [step["operation"] for step in pass_results["steps"]] == list(STEPS)
+        assert all(step["ms"] >= 0 and "response" in step for step in pass_results["steps"])
+    assert result["passes"][0]["steps"][0]["status"] == 201
+    assert result["jwt_info"] == {"original_user_id": "alice", "original_role": "alice"}
+    assert result["summary"]["passes"] == 2
+    assert result["summary"]["failed"] == 0
+    assert result["summary"]["steps"]["update"]["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_runtest_streams_synthetic_user_passes_as_ndjson(proxy_client, authenticated):
+    response, stub = await post_runtest(
+        proxy_client, authenticated, users=3, iterations=2, concurrency=2, stream="true", responses="false"
+    )
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert [event["event"] for event in events] == ["pass"] * 6 + ["summary"]
+    assert sorted((e["user_id"], e["iteration"]) for e in events[:-1]) == [
+        (f"runtest-user-{i}", n) for i in range(3) for n in range(2)
+    ]
+    assert all("response" not in step for event in events[:-1] for step in event["steps"])
+    assert events[-1]["steps"]["insert"]["count"] == 6
+    assert events[-1]["pass_ms"]["count"] == 6
+    # The caller plus each synthetic user, provisioned once
+    assert stub.paths["/rpc/create_user_role"] == 4
+
+
+@pytest.mark.asyncio
+async def test_runtest_fails_loudly_when_a_step_is_refused(proxy_client, authenticated):
+    response, _ = await post_runtest(proxy_client, authenticated, fail={"PATCH"})
+
+    assert response.status_code == 502
+    result = response.json()
+    assert result["status"] == "failed"
+    assert result["summary"]["failed"] == 2
+    for pass_results in result["passes"]:
+        assert pass_results["status"] == "error" and pass_results["failed_step"] == "update"
+        assert "update failed with 403" in pass_results["error"]
+        assert [step["operation"] for step in pass_results["steps"]] == ["insert", "fetch", "update"]
+
+    streamed, _ = await post_runtest(proxy_client, authenticated, fail={"POST"}, stream="true")
+    summary = json.loads(streamed.text.splitlines()[-1])
+    assert summary["status"] == "failed" and summary["failed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_runtest_rejects_oversized_runs(monkeypatch, proxy_client, authenticated):
+    monkeypatch.setattr(main, "RUNTEST_MAX_PASSES", 10)
+    response, stub = await post_runtest(proxy_client, authenticated, users=5, iterations=3)
+    assert response.status_code == 400
+    assert stub.requests == 0
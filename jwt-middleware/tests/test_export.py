@@ -0,0 +1,118 @@
+import asyncio
+import csv
+import io
+import json
+
+import pytest
+import pytest_asyncio
+
+import main
+from export import CsvEncoder, export_select, keyset_pages, page_params
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import TablePostgrest
+from token_cache import MintedTokenCache, TokenCache
+
+
+class RecordingTable(TablePostgrest):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pages = []
+
+    def respond(self, method, target, headers, body):
+        if method == "GET":
+            self.pages.append(target)
+        return super().respond(method, target, headers, body)
+
+
+@pytest_asyncio.fixture
+async def exporting(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    main.role_cache.mark_known(["alice"])
+    async with RecordingTable(rows=25) as stub:
+        client = await proxy_client(stub.url)
+        yield stub, client, {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+
+
+def test_pages_follow_the_key_and_always_select_it():
+    assert export_select("data, user_id", "id") == "id,data,user_id"
+    assert export_select("*", "id") is None
+    assert page_params([("user_id", "eq.a")], "id,data", "id", "40", 10) == [
+        ("user_id", "eq.a"), ("select", "id,data"), ("id", "gt.40"), ("order", "id.asc"), ("limit", "10"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_next_page_is_fetched_while_the_current_one_is_consumed():
+    fetched = []
+
+    async def fetch_page(after):
+        fetched.append(after)
+        start = int(after)
+        return [{"id": i} for i in range(start + 1, min(start + 3, 7) + 1)]
+
+    pages = keyset_pages(fetch_page, "id", 3, [{"id": 1}, {"id": 2}, {"id": 3}])
+    assert await pages.__anext__() == [{"id": 1}, {"id": 2}, {"id": 3}]
+    await asyncio.sleep(0)
+    assert fetched == ["3"]  # prefetched before the first page was handed back for more
+    assert [page async for page in pages] == [[{"id": 4}, {"id": 5}, {"id": 6}], [{"id": 7}]]
+    assert fetched == ["3", "6"]
+
+
+def test_csv_quotes_values_and_flattens_json():
+    encode = CsvEncoder(["id", "data"])
+    assert encode.header() == b"id,data\n"
+    assert encode([{"id": 1, "data": 'a, "b"'}, {"id": 2, "data": {"k": [1]}}, {"id": 3, "data": None}]) == (
+        b'1,"a, ""b"""\n2,"{""k"":[1]}"\n3,\n'
+    )
+
+
+@pytest.mark.asyncio
+async def test_ndjson_export_walks_the_table_in_keyset_pages(exporting):
+    stub, client, auth = exporting
+    response = await client.get("/export", params={"table": "test", "chunk": "10", "id": "lt.24"}, headers=auth)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.headers["x-export-key"] == "id"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == list(range(1, 24))
+    assert stub.pages == [
+        "/test?id=lt.24&order=id.asc&limit=10",
+        "/test?id=lt.24&id=gt.10&order=id.asc&limit=10",
+        "/test?id=lt.24&id=gt.20&order=id.asc&limit=10",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_csv_export_resumes_from_a_cursor(exporting):
+    stub, client, auth = exporting
+    response = await client.get(
+        "/export", params={"table": "test", "format": "csv", "select": "data", "cursor": "18", "chunk": "5"}, headers=auth
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "text/csv; charset=utf-8"
+    lines = list(csv.reader(io.StringIO(response.text)))
+    assert lines[0] == ["id", "data"]
+    assert lines[1:] == [[str(i), f"row {i}"] for i in range(19, 26)]
+    assert stub.pages[0] == "/test?select=id%2Cdata&id=gt.18&order=id.asc&limit=5"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("params, status", [
+    ({"table": "secrets"}, 404),
+    ({"table": "test", "format": "xml"}, 400),
+    ({"table": "test", "offset": "10"}, 400),
+    ({"table": "test", "chunk": "0"}, 400),
+    ({"table": "test", "select": "id,other(*)"}, 400),
+])
+async def test_invalid_exports_are_rejected_before_reaching_postgrest(exporting, params, status):
+    stub, client, auth = exporting
+    response = await client.get("/export", params=params, headers=auth)
+    assert response.status_code == status
+    assert stub.pages == []
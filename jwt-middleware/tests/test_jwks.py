@@ -0,0 +1,118 @@
+import asyncio
+
+import httpx
+import pytest
+import pytest_asyncio
+
+import main
+from jwks import JWKSManager, UnknownKeyError
+from stub_authentik import StubIssuer, StubJWKSServer
+from token_cache import TokenCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest_asyncio.fixture
+async def jwks_server():
+    async with StubJWKSServer([StubIssuer("kid-a"), StubIssuer("kid-b")], max_age=120) as server:
+        async with httpx.AsyncClient() as client:
+            yield server, client
+
+
+def manager_for(server, client, **kwargs) -> JWKSManager:
+    return JWKSManager(f"{server.url}/jwks/", lambda: client, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_indexes_every_key_by_kid(jwks_server):
+    server, client = jwks_server
+    manager = manager_for(server, client)
+    for issuer in server.issuers:
+        key = await manager.get_key_for_token(issuer.issue())
+        assert key is manager.keys[issuer.kid]
+    assert server.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_known_kids_never_fetch_and_etag_revalidates(jwks_server):
+    server, client = jwks_server
+    clock = FakeClock()
+    manager = manager_for(server, client, clock=clock)
+    await manager.refresh()
+    assert manager.next_refresh == clock.now + 120
+
+    await manager.get_key("kid-a")
+    assert server.requests == 1
+
+    await manager.refresh()
+    assert manager.not_modified == 1
+    assert set(manager.keys) == {"kid-a", "kid-b"}
+
+
+@pytest.mark.asyncio
+async def test_rotation_fetches_unknown_kid_once_for_concurrent_requests(jwks_server):
+    server, client = jwks_server
+    clock = FakeClock()
+    manager = manager_for(server, client, clock=clock, min_refetch_interval=10)
+    await manager.refresh()
+
+    rotated = StubIssuer("kid-c")
+    server.issuers = [rotated]
+    clock.now += 11
+    keys = await asyncio.gather(*(manager.get_key("kid-c") for _ in range(10)))
+
+    assert all(key is manager.keys["kid-c"] for key in keys)
+    assert server.requests == 2
+    with pytest.raises(UnknownKeyError):
+        await manager.get_key("kid-a")
+
+
+@pytest.mark.asyncio
+async def test_unknown_kid_refetch_is_rate_limited(jwks_server):
+    server, client = jwks_server
+    clock = FakeClock()
+    manager = manager_for(server, client, clock=clock, min_refetch_interval=10)
+    await manager.refresh()
+
+    with pytest.raises(UnknownKeyError):
+        await manager.get_key("bogus")
+    assert server.requests == 1
+    assert manager.rate_limited == 1
+
+    clock.now += 11
+    with pytest.raises(UnknownKeyError):
+        await manager.get_key("bogus")
+    assert server.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_background_refresh_picks_up_rotation(jwks_server):
+    server, client = jwks_server
+    server.max_age = 0
+    manager = manager_for(server, client, min_refetch_interval=0.05)
+    await manager.start()
+    try:
+        server.issuers = [StubIssuer("kid-rotated")]
+        for _ in range(50):
+            if "kid-rotated" in manager.keys:
+                break
+            await asyncio.sleep(0.02)
+        assert set(manager.keys) == {"kid-rotated"}
+    finally:
+        await manager.stop()
+
+
+@pytest.mark.asyncio
+async def test_verify_token_uses_key_matching_kid(jwks_server, monkeypatch):
+    server, client = jwks_server
+    monkeypatch.setattr(main, "jwks_manager", manager_for(server, client))
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+
+    entry = await main.verify_token(server.issuers[1].issue(sub="bob"))
+    assert entry.payload["sub"] == "bob"
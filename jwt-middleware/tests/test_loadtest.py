@@ -0,0 +1,47 @@
+import pytest
+
+import main
+from loadtest import compare, drive, parse_mix
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+
+
+@pytest.mark.asyncio
+async def test_drive_proxies_every_method_in_the_mix(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    tokens = [issuer.issue(sub=f"user-{i}") for i in range(3)]
+    mix = parse_mix(["GET=2", "post=1", "PATCH=1", "DELETE=1"])
+
+    async with StubPostgrest(rows=5) as stub:
+        client = await proxy_client(stub.url)
+        result = await drive(client, tokens, mix, total=60, concurrency=4, body_bytes=16, seed=1)
+
+    assert result["errors"] == {}
+    assert set(result["by_method"]) == {"GET", "POST", "PATCH", "DELETE"}
+    assert sum(method["requests"] for method in result["by_method"].values()) == 60
+    assert set(result["latency_ms"]) == {"p50", "p90", "p99", "max"}
+    assert stub.paths["/test"] == 60
+
+
+def test_compare_flags_regressions_and_config_changes():
+    def report(rps, p99, rows=10):
+        return {"config": {"mode": "inprocess", "rows": rows},
+                "results": {"c16": {"requests_per_second": rps, "latency_ms": {"p99": p99}}}}
+
+    assert compare(report(950, 10.5), report(1000, 10), tolerance=0.1)["regression"] is False
+
+    slower = compare(report(800, 10), report(1000, 10), tolerance=0.1)
+    assert slower["regression"] is True
+    assert slower["levels"]["c16"]["requests_per_second_change"] == -0.2
+
+    assert compare(report(1000, 10, rows=100), report(1000, 10), 0.1)["config_differences"] == {"rows": [10, 100]}
+
+
+def test_parse_mix_rejects_unknown_methods():
+    with pytest.raises(ValueError):
+        parse_mix(["TRACE=1"])
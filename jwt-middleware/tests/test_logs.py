@@ -0,0 +1,88 @@
+import json
+import logging
+
+import pytest
+
+import logs
+import main
+from logs import JsonFormatter, access_logger, redact_headers
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.setFormatter(JsonFormatter())
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+@pytest.fixture
+def captured(monkeypatch):
+    capture = Capture()
+    levels = access_logger.level, main.logger.level
+    monkeypatch.setattr(access_logger, "handlers", [capture])
+    monkeypatch.setattr(main.logger, "handlers", [capture])
+    access_logger.setLevel(logging.INFO)
+    main.logger.setLevel(logging.DEBUG)
+    yield capture
+    access_logger.setLevel(levels[0])
+    main.logger.setLevel(levels[1])
+
+
+def test_redact_headers_hides_credentials_and_jwts():
+    headers = redact_headers({
+        "Authorization": "Bearer abc",
+        "Cookie": "session=1",
+        "X-Forwarded-Token": "eyJhbGciOi.eyJzdWIiOi.c2ln",
+        "Accept": "application/json",
+    })
+    assert headers == {
+        "Authorization": "[REDACTED]",
+        "Cookie": "[REDACTED]",
+        "X-Forwarded-Token": "[REDACTED]",
+        "Accept": "application/json",
+    }
+
+
+@pytest.mark.asyncio
+async def test_one_access_line_per_request_without_secrets(captured, monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    main.role_cache.mark_known(["alice"])
+    token = issuer.issue(sub="alice")
+
+    async with StubPostgrest(rows=2) as stub:
+        client = await proxy_client(stub.url)
+        response = await client.get("/test", headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 200
+    access = [json.loads(line) for line in captured.lines if '"jwt_middleware.access"' in line]
+    assert len(access) == 1
+    assert access[0]["method"] == "GET"
+    assert access[0]["path"] == "/test"
+    assert access[0]["status"] == 200
+    assert access[0]["user"] == "alice"
+    assert access[0]["upstream_status"] == 200
+    assert access[0]["duration_ms"] >= 0
+    # Debug details were logged, but never the bearer tokens themselves
+    assert any("Request headers" in line for line in captured.lines)
+    assert not any(token in line or main.POSTGREST_JWT_SECRET in line for line in captured.lines)
+
+
+@pytest.mark.asyncio
+async def test_unsampled_requests_skip_debug_details(captured, monkeypatch, proxy_client):
+    monkeypatch.setattr(logs, "DEBUG_SAMPLE_RATE", 0.0)
+    client = await proxy_client()
+    response = await client.get("/test", headers={"Authorization": "Bearer not-a-jwt"})
+
+    assert response.status_code == 401
+    assert len(captured.lines) == 2  # the token warning and the access line
+    assert not any('"level": "DEBUG"' in line for line in captured.lines)
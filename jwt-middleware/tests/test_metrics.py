@@ -0,0 +1,99 @@
+import re
+
+import httpx
+import pytest
+
+import main
+from metrics import Metrics
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import MintedTokenCache, TokenCache
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*"(?:,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*")*\})? (\S+)$')
+
+
+def parse(text: str) -> dict:
+    """Parse the text exposition format into {(name, labels): value}, checking every line"""
+    samples = {}
+    types = {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            assert kind in ("counter", "gauge", "histogram")
+            assert name not in types, f"duplicate TYPE for {name}"
+            types[name] = kind
+            continue
+        if line.startswith("# HELP "):
+            continue
+        match = SAMPLE.match(line)
+        assert match, f"malformed sample line: {line!r}"
+        name, labels, value = match.groups()
+        family = re.sub(r"_(bucket|sum|count)$", "", name) if name not in types else name
+        assert family in types, f"sample {name} has no TYPE"
+        samples[name, labels or ""] = float(value)
+    return samples
+
+
+async def proxied_requests(monkeypatch, proxy_client, metrics: Metrics) -> httpx.Response:
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "metrics", metrics)
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    token = issuer.issue(sub="alice")
+
+    async with StubPostgrest(rows=2) as stub:
+        client = await proxy_client(stub.url)
+        for _ in range(3):
+            response = await client.get("/test", headers={"Authorization": f"Bearer {token}"})
+            assert response.status_code == 200
+        scrape = await client.get("/metrics")
+    return scrape
+
+
+@pytest.mark.asyncio
+async def test_metrics_exposition_covers_each_stage(monkeypatch, proxy_client):
+    response = await proxied_requests(monkeypatch, proxy_client, main.register_collectors(Metrics()))
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = parse(response.text)
+
+    # Verify and sign run once, the cached token serves the other two requests
+    for stage, count in [("transform_token", 3), ("jwks_key", 1), ("verify", 1), ("sign", 1),
+                         ("role_check", 3), ("create_user_roles", 1), ("postgrest", 3)]:
+        assert samples["jwt_middleware_stage_seconds_count", f'{{stage="{stage}"}}'] == count
+        assert samples["jwt_middleware_stage_seconds_bucket", f'{{stage="{stage}",le="+Inf"}}'] == count
+
+    buckets = [value for (name, labels), value in samples.items()
+               if name == "jwt_middleware_stage_seconds_bucket" and 'stage="postgrest"' in labels]
+    assert buckets == sorted(buckets)
+
+    assert samples["jwt_middleware_upstream_responses_total", '{method="GET",status="200"}'] == 3
+    assert samples["jwt_middleware_requests_total", '{method="GET",status="200"}'] == 3
+    assert samples["jwt_middleware_requests_in_flight", ""] == 1  # the scrape itself
+    assert samples["jwt_middleware_token_cache_hits_total", ""] == 2
+    assert samples["jwt_middleware_token_cache_hit_ratio", ""] == pytest.approx(2 / 3, abs=1e-3)
+    assert samples["jwt_middleware_role_cache_provisions_total", ""] == 1
+    assert samples["jwt_middleware_upstream_requests_total", '{upstream="postgrest"}'] == 4
+    assert ("jwt_middleware_upstream_idle_connections", '{upstream="postgrest"}') in samples
+
+
+@pytest.mark.asyncio
+async def test_disabled_metrics_record_nothing(monkeypatch, proxy_client):
+    metrics = Metrics(enabled=False)
+    response = await proxied_requests(monkeypatch, proxy_client, metrics)
+
+    assert response.status_code == 404
+    assert metrics.stage_seconds.values == {}
+    assert metrics.requests.values == {}
+    assert metrics.upstream_responses.values == {}
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.upstream_responses.inc('we"ird\\', 200)
+    assert 'method="we\\"ird\\\\"' in metrics.render()
+    parse(metrics.render())
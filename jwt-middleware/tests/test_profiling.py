@@ -0,0 +1,132 @@
+import asyncio
+import marshal
+import time
+
+import pytest
+import pytest_asyncio
+
+import main
+from profiling import LoopMonitor, Profiling
+from stub_postgrest import TablePostgrest
+
+TOKEN = {"X-Profiling-Token": "let-me-in"}
+
+
+def spin(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_enabled_without_a_token_stays_off():
+    assert not Profiling(enabled=True).enabled
+    assert Profiling(enabled=True, token="secret").enabled
+
+
+@pytest_asyncio.fixture
+async def client(monkeypatch, proxy_client):
+    monkeypatch.setattr(main, "profiling", Profiling(enabled=True, token="let-me-in", sample_every=2, interval=0.001))
+    async with TablePostgrest(rows=10) as stub:
+        client = await proxy_client(stub.url)
+        yield client
+    main.profiling.stop()
+
+
+@pytest.mark.asyncio
+async def test_endpoints_need_the_token_and_are_hidden_when_off(client, monkeypatch):
+    assert (await client.get("/debug/profiling")).status_code == 401
+    assert (await client.get("/debug/profiling", headers={"X-Profiling-Token": "guess"})).status_code == 401
+    assert (await client.get("/debug/profiling", headers=TOKEN)).json()["enabled"] is True
+
+    monkeypatch.setattr(main, "profiling", Profiling())
+    assert (await client.get("/debug/profiling", headers=TOKEN)).status_code == 404
+    assert (await client.post("/debug/profiling/start", headers=TOKEN)).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_every_nth_request_is_profiled_and_merged(client, monkeypatch):
+    # Every proxied request spends 50 ms on the CPU, so each sampled one is caught many times over
+    forwarded_headers = main.forwarded_headers
+    monkeypatch.setattr(main, "forwarded_headers", lambda items: spin(0.05) or forwarded_headers(items))
+    for _ in range(10):
+        response = await client.get("/test")
+        assert response.status_code == 200
+
+    sampled = (await client.get("/debug/profiling/requests", headers=TOKEN)).json()
+    assert sampled["sampled_requests"] == 5 and len(sampled["requests"]) == 5
+    assert {request["path"] for request in sampled["requests"]} == {"/test"}
+    assert sampled["samples"] >= 5
+    assert "spin" in {entry["function"] for entry in sampled["top"]}
+    # Stacks start at the middleware, not at whatever ran the server
+    assert sampled["top"][0]["function"] == "ProfilingMiddleware.__call__"
+    assert sampled["top"][0]["samples"] == sampled["samples"]
+
+    merged = (await client.get("/debug/profiling/requests/profile", headers=TOKEN)).json()
+    assert merged["profiles"][0]["type"] == "sampled"
+    assert sum(merged["profiles"][0]["weights"]) == pytest.approx(sampled["samples"], rel=0.01)
+    single = await client.get(f"/debug/profiling/requests/profile?id={sampled['requests'][0]['id']}&format=collapsed", headers=TOKEN)
+    assert single.status_code == 200 and single.headers["content-type"].startswith("text/plain")
+    assert (await client.get("/debug/profiling/requests/profile?id=999", headers=TOKEN)).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_whole_process_profiles_are_time_boxed_and_downloadable(client):
+    started = await client.post("/debug/profiling/start?seconds=5&mode=sampling", headers=TOKEN)
+    assert started.status_code == 200 and started.json()["running"] is True
+    assert (await client.post("/debug/profiling/start", headers=TOKEN)).status_code == 409
+    assert (await client.get("/debug/profiling/profile", headers=TOKEN)).status_code == 409
+    spin(0.05)
+    assert (await client.post("/debug/profiling/stop", headers=TOKEN)).json()["running"] is False
+
+    speedscope = (await client.get("/debug/profiling/profile", headers=TOKEN)).json()
+    assert "spin" in {frame["name"] for frame in speedscope["shared"]["frames"]}
+    assert (await client.get("/debug/profiling/profile?format=pstats", headers=TOKEN)).status_code == 400
+
+    await client.post("/debug/profiling/start?seconds=0.05&mode=cprofile", headers=TOKEN)
+    spin(0.01)
+    await asyncio.sleep(0.1)
+    assert main.profiling.process.running is False
+    download = await client.get("/debug/profiling/profile", headers=TOKEN)
+    assert download.headers["content-disposition"] == 'attachment; filename="profile.pstats"'
+    assert any(function == "spin" for _, _, function in marshal.loads(download.content))
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_reports_what_blocked_the_loop():
+    monitor = LoopMonitor(interval=0.01, slow=0.05)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        spin(0.2)
+        await asyncio.sleep(0.05)
+    finally:
+        monitor.stop()
+
+    stats = monitor.stats()
+    assert stats["checks"] > 2 and stats["slow_callbacks"] == 1
+    assert stats["lag_max_ms"] >= 150
+    report = monitor.reports[0]
+    assert report["stack"][-1].endswith(" spin")
+    assert report["coroutine"] == "test_loop_monitor_reports_what_blocked_the_loop"
+
+
+leak = []
+
+
+@pytest.mark.asyncio
+async def test_tracemalloc_diff_shows_what_grew(client):
+    assert (await client.post("/debug/profiling/tracemalloc/snapshot", headers=TOKEN)).status_code == 409
+    await client.post("/debug/profiling/tracemalloc/start?frames=1", headers=TOKEN)
+    try:
+        base = (await client.post("/debug/profiling/tracemalloc/snapshot", headers=TOKEN)).json()
+        leak.extend(bytearray(1024) for _ in range(2000))
+        diff = (await client.get(f"/debug/profiling/tracemalloc/diff?base={base['id']}", headers=TOKEN)).json()
+    finally:
+        stopped = (await client.post("/debug/profiling/tracemalloc/stop", headers=TOKEN)).json()
+        leak.clear()
+
+    grown = diff["top"][0]
+    assert "test_profiling.py" in grown["where"] and grown["size_diff_kb"] > 1500 and grown["count_diff"] >= 2000
+    assert diff["target"] == base["id"] + 1
+    assert stopped == {"tracing": False, "frames": 1, "traced_mb": 0.0, "peak_mb": 0.0, "snapshots": []}
+    assert (await client.get("/debug/profiling/tracemalloc/diff?base=1&group_by=module", headers=TOKEN)).status_code == 400
@@ -0,0 +1,185 @@
+import asyncio
+
+import pytest
+
+import main
+from protection import (
+    CircuitBreaker, CircuitOpen, ConcurrencyLimiter, DeadlineExceeded, UpstreamGuard, UpstreamOverloaded,
+    parse_route_deadlines,
+)
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import FaultyPostgrest
+from token_cache import MintedTokenCache, TokenCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_limiter_queues_in_order_and_rejects_beyond_the_queue():
+    limiter = ConcurrencyLimiter(limit=1, max_queue=2)
+    await limiter.acquire(1)
+    admitted = []
+
+    async def waiter(n):
+        await limiter.acquire(1)
+        admitted.append(n)
+
+    waiters = [asyncio.ensure_future(waiter(n)) for n in range(2)]
+    await asyncio.sleep(0)
+    with pytest.raises(UpstreamOverloaded, match="already queued"):
+        await limiter.acquire(1)
+
+    limiter.release()
+    await asyncio.sleep(0.01)
+    assert admitted == [0]
+    limiter.release()
+    await asyncio.gather(*waiters)
+    assert admitted == [0, 1]
+    assert limiter.stats()["in_flight"] == 1
+
+    with pytest.raises(UpstreamOverloaded, match="within"):
+        await limiter.acquire(0.01)
+    assert limiter.stats()["waiting"] == 0
+    assert limiter.stats()["rejected"] == 1 and limiter.stats()["queue_timeouts"] == 1
+
+
+def test_adaptive_limit_backs_off_once_per_burst_and_grows_back():
+    clock = FakeClock()
+    limiter = ConcurrencyLimiter(limit=8, adaptive=True, min_limit=2, max_limit=10, latency_target=0.1, backoff=0.5, clock=clock)
+    limiter.in_flight = 8
+
+    clock.now = 1.0
+    for _ in range(4):
+        limiter.release(sent=0.5, latency=0.4, ok=True)  # a slow burst, all sent before the first backoff
+    assert limiter.stats()["limit"] == 4
+    limiter.release(sent=2.0, latency=0.01, ok=False)
+    assert limiter.stats()["limit"] == 2
+
+    limiter.in_flight = 100
+    for _ in range(100):
+        limiter.release(sent=3.0, latency=0.01, ok=True)
+    assert limiter.stats()["limit"] == 10
+    assert limiter.stats()["decreases"] == 2
+
+
+def test_breaker_opens_after_consecutive_failures_and_closes_after_a_good_trial():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock)
+    for ok in (False, False, True, False, False):
+        breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == "closed"
+    breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    clock.now = 4
+    with pytest.raises(CircuitOpen) as rejected:
+        breaker.allow()
+    assert rejected.value.retry_after == 6
+
+    clock.now = 10
+    trial = breaker.allow()
+    assert trial is True
+    with pytest.raises(CircuitOpen, match="half-open"):
+        breaker.allow()
+    breaker.record(False, trial)
+    assert breaker.state == "open"
+
+    clock.now = 20
+    breaker.record(True, breaker.allow())
+    assert breaker.stats() == {"state": "closed", "open": False, "consecutive_failures": 0, "opens": 2, "rejected": 2}
+
+
+def test_only_the_trial_decides_a_half_open_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    assert breaker.allow() is False
+    assert breaker.allow() is False  # admitted while closed, finishes late
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    clock.now = 10
+    trial = breaker.allow()
+    breaker.record(True)  # the late request: doesn't close it or free the trial slot
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpen, match="half-open"):
+        breaker.allow()
+    breaker.record(False)  # nor reopen it
+    assert breaker.state == "half_open"
+    breaker.record(True, trial)
+    assert breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_guard_applies_route_deadlines_and_frees_the_slot():
+    guard = UpstreamGuard(
+        ConcurrencyLimiter(limit=1), CircuitBreaker(failure_threshold=1),
+        deadline=5, route_deadlines=parse_route_deadlines("rpc/=0.02, rpc/slow=1"),
+    )
+    assert guard.deadline_for("/rpc/slow_report") == 1
+    assert guard.deadline_for("rpc/create_user_role") == 0.02
+    assert guard.deadline_for("test") == 5
+
+    with pytest.raises(DeadlineExceeded) as exceeded:
+        await guard.send("rpc/anything", lambda: asyncio.sleep(1))
+    assert exceeded.value.status == 504
+    assert guard.limiter.in_flight == 0
+    assert guard.breaker.state == "open"
+
+
+@pytest.fixture
+def authenticated(monkeypatch):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "role_batcher", RoleBatcher(main.create_user_roles, max_batch=1))
+    return {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+
+
+async def proxy_gets(monkeypatch, proxy_client, headers, stub, guard, count, concurrent=True) -> list:
+    monkeypatch.setattr(main, "ROLE_MODE", "shared")  # No provisioning calls to count
+    monkeypatch.setattr(main, "upstream_guard", guard)
+    client = await proxy_client(stub.url)
+    if concurrent:
+        responses = await asyncio.gather(*(client.get("/test", headers=headers) for _ in range(count)))
+    else:
+        responses = [await client.get("/test", headers=headers) for _ in range(count)]
+    return responses
+
+
+@pytest.mark.asyncio
+async def test_overload_is_shed_with_fast_503s_instead_of_queueing_upstream(monkeypatch, proxy_client, authenticated):
+    guard = UpstreamGuard(ConcurrencyLimiter(limit=2, max_queue=4), CircuitBreaker(), queue_timeout=5, retry_after=2)
+    async with FaultyPostgrest(db_pool=2, latency_ms=20) as stub:
+        responses = await proxy_gets(monkeypatch, proxy_client, authenticated, stub, guard, 12)
+
+    statuses = sorted(response.status_code for response in responses)
+    assert statuses == [200] * 6 + [503] * 6
+    assert all(r.headers["retry-after"] == "2" for r in responses if r.status_code == 503)
+    # The limiter kept requests from ever queueing for PostgREST's pool
+    assert stub.peak_waiting == 0
+    assert guard.limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_on_upstream_5xx_and_stops_sending(monkeypatch, proxy_client, authenticated):
+    guard = UpstreamGuard(ConcurrencyLimiter(limit=10), CircuitBreaker(failure_threshold=3, reset_timeout=60))
+    async with FaultyPostgrest() as stub:
+        stub.down = True
+        responses = await proxy_gets(monkeypatch, proxy_client, authenticated, stub, guard, 6, concurrent=False)
+
+    assert [r.status_code for r in responses] == [503] * 6
+    assert [r.headers.get("retry-after") for r in responses[3:]] == ["60"] * 3
+    # Only the failures that tripped the breaker reached PostgREST
+    assert stub.faults == {503: 3}
+    assert guard.breaker.stats()["rejected"] == 3
@@ -0,0 +1,138 @@
+import pytest
+import pytest_asyncio
+
+import main
+from roles import RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+
+
+class RecordingStub(StubPostgrest):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = []
+
+    def respond(self, method, target, headers, body):
+        self.received.append((method, target, headers, body))
+        if target.startswith("/report"):
+            return 200, {"Content-Type": "text/csv", "ETag": 'W/"abc"'}, b"id,data\n1,a\n"
+        return super().respond(method, target, headers, body)
+
+
+@pytest_asyncio.fixture
+async def proxied(monkeypatch, proxy_client):
+    async with RecordingStub(rows=3) as stub:
+        client = await proxy_client(stub.url)
+        yield stub, client
+
+
+@pytest.mark.asyncio
+async def test_streaming_forwards_body_and_headers_unchanged(proxied):
+    stub, client = proxied
+    response = await client.get("/report")
+
+    assert response.status_code == 200
+    assert response.content == b"id,data\n1,a\n"
+    assert response.headers["content-type"] == "text/csv"
+    assert response.headers["etag"] == 'W/"abc"'
+
+
+@pytest.mark.asyncio
+async def test_streaming_keeps_query_string_and_content_range(proxied):
+    stub, client = proxied
+    response = await client.get("/test", params={"id": "gt.0", "select": "id,data"})
+
+    assert len(response.json()) == 3
+    assert response.headers["content-range"] == "0-2/*"
+    assert stub.received[-1][1] == "/test?id=gt.0&select=id%2Cdata"
+
+
+@pytest.mark.asyncio
+async def test_request_body_is_streamed_upstream(proxied):
+    stub, client = proxied
+    body = b'{"data": "changed"}'
+    response = await client.put("/test?id=eq.1", content=body, headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 200
+    method, target, headers, received = stub.received[-1]
+    assert (method, received) == ("PUT", body)
+    assert headers["content-length"] == str(len(body))
+
+
+@pytest.mark.asyncio
+async def test_buffered_mode_still_returns_json(proxied, monkeypatch):
+    stub, client = proxied
+    monkeypatch.setattr(main, "PROXY_STREAMING", False)
+    response = await client.get("/test")
+
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+    assert "content-range" not in response.headers
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("core", ["asgi", "fastapi"])
+async def test_both_cores_forward_head_options_and_patch(proxied, monkeypatch, core):
+    stub, client = proxied
+    monkeypatch.setattr(main, "PROXY_CORE", core)
+    head = await client.head("/test")
+    options = await client.options("/test")
+    patch = await client.patch("/test?id=eq.1", json={"data": "x"})
+
+    assert [r.status_code for r in (head, options, patch)] == [200, 200, 200]
+    assert head.content == b""
+    assert head.headers["content-range"] == "0-2/*"
+    assert patch.json() == {"data": "x"}
+    assert [(method, target) for method, target, _, _ in stub.received] == [
+        ("HEAD", "/test"), ("OPTIONS", "/test"), ("PATCH", "/test?id=eq.1")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_local_paths_are_never_forwarded(proxied):
+    stub, client = proxied
+    assert (await client.get("/health")).json() == {"status": "healthy"}
+    assert (await client.post("/health")).status_code == 404
+    assert stub.received == []
+
+
+@pytest_asyncio.fixture
+async def bearer(monkeypatch):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    return {"Authorization": f"Bearer {issuer.issue(sub='alice')}"}
+
+
+@pytest.mark.asyncio
+async def test_bulk_post_stamps_user_id_on_every_row(proxied, bearer):
+    stub, client = proxied
+    rows = [{"data": "a"}, {"data": "b", "user_id": "mallory"}]
+    response = await client.post("/test", json=rows, headers=bearer)
+
+    assert response.status_code == 201
+    assert [row["user_id"] for row in response.json()] == ["alice", "alice"]
+    method, target, headers, body = stub.received[-1]
+    assert headers["content-length"] == str(len(body))
+
+
+@pytest.mark.asyncio
+async def test_invalid_json_post_is_rejected(proxied, bearer):
+    stub, client = proxied
+    response = await client.post("/test", content=b"{oops", headers={**bearer, "Content-Type": "application/json"})
+
+    assert response.status_code == 400
+    assert all(target != "/test" for _, target, _, _ in stub.received)
+
+
+@pytest.mark.asyncio
+async def test_invalid_token_is_rejected_with_401(proxied, monkeypatch):
+    stub, client = proxied
+    monkeypatch.setattr(main, "jwks_manager", StubIssuer().key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    token = StubIssuer().issue(sub="mallory")
+    response = await client.get("/test", headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 401
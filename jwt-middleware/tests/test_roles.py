@@ -0,0 +1,211 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import main
+from roles import RoleBatcher, RoleCache
+from stub_authentik import StubIssuer
+from stub_postgrest import StubPostgrest
+from token_cache import TokenCache
+from upstream import UpstreamClient
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_concurrent_first_requests_provision_once():
+    cache = RoleCache()
+    calls = []
+
+    async def provision(user_id):
+        calls.append(user_id)
+        await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(cache.ensure("alice", provision) for _ in range(20)))
+    await cache.ensure("alice", provision)
+
+    assert calls == ["alice"]
+    assert cache.stats()["coalesced"] == 19
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_provisioning_is_retried_and_raised_to_all_waiters():
+    cache = RoleCache()
+    attempts = 0
+
+    async def provision(user_id):
+        nonlocal attempts
+        attempts += 1
+        await asyncio.sleep(0)
+        if attempts == 1:
+            raise RuntimeError("rpc failed")
+
+    results = await asyncio.gather(*(cache.ensure("bob", provision) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert not cache.is_known("bob")
+
+    await cache.ensure("bob", provision)
+    assert attempts == 2
+    assert cache.is_known("bob")
+    assert cache.stats()["failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_known_roles_expire_and_can_be_invalidated():
+    clock = FakeClock()
+    cache = RoleCache(ttl=60, clock=clock)
+    cache.mark_known(["alice", "bob"])
+
+    assert cache.invalidate("alice") == 1
+    assert not cache.is_known("alice")
+    assert cache.is_known("bob")
+
+    clock.now += 61
+    assert not cache.is_known("bob")
+
+
+@pytest.mark.asyncio
+async def test_proxy_calls_create_user_role_once_per_user(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "role_batcher", RoleBatcher(main.create_user_roles, max_batch=1))
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "admin-secret")
+    tokens = [issuer.issue(sub=f"user-{i}") for i in range(3)]
+
+    async with StubPostgrest() as stub:
+        client = await proxy_client(stub.url)
+        responses = await asyncio.gather(*(
+            client.get("/test", headers={"Authorization": f"Bearer {tokens[i % 3]}"})
+            for i in range(30)
+        ))
+        assert all(r.status_code == 200 for r in responses)
+
+        invalidated = await client.post("/debug/roles/invalidate", params={"user_id": "user-0"}, headers={"X-Admin-Token": "admin-secret"})
+        assert invalidated.json() == {"invalidated": 1}
+        await client.get("/test", headers={"Authorization": f"Bearer {tokens[0]}"})
+
+        assert stub.paths["/rpc/create_user_role"] == 4
+
+
+@pytest.mark.asyncio
+async def test_invalidate_needs_the_admin_token_and_is_hidden_without_one(monkeypatch, proxy_client):
+    cache = RoleCache()
+    cache.mark_known(["alice"])
+    monkeypatch.setattr(main, "role_cache", cache)
+    client = await proxy_client()
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+    assert (await client.post("/debug/roles/invalidate", headers={"X-Admin-Token": "anything"})).status_code == 404
+
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "admin-secret")
+    assert (await client.post("/debug/roles/invalidate")).status_code == 401
+    assert (await client.post("/debug/roles/invalidate", headers={"X-Admin-Token": "guess"})).status_code == 401
+    assert cache.is_known("alice")
+    allowed = await client.post("/debug/roles/invalidate", headers={"X-Admin-Token": "admin-secret"})
+    assert allowed.json() == {"invalidated": 1} and not cache.is_known("alice")
+
+
+@pytest.mark.asyncio
+async def test_shared_role_mode_mints_fixed_role_and_skips_provisioning(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "ROLE_MODE", "shared")
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    token = issuer.issue(sub="user-0")
+
+    async with StubPostgrest() as stub:
+        client = await proxy_client(stub.url)
+        response = await client.get("/test", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        assert (await client.get("/debug/roles")).json()["mode"] == "shared"
+
+    # RLS reads the sub claim; the role is the same for everyone
+    payload = (await main.verify_token(token)).payload
+    assert (payload["role"], payload["sub"]) == ("authenticated", "user-0")
+    assert not any(path.startswith("/rpc/") for path in stub.paths)
+    assert main.role_cache.stats()["provisions"] == 0
+
+
+@pytest.mark.asyncio
+async def test_batcher_coalesces_users_by_size_and_window():
+    batches = []
+
+    async def provision_many(user_ids):
+        batches.append(sorted(user_ids))
+
+    batcher = RoleBatcher(provision_many, max_batch=3, window=0.01)
+    await asyncio.gather(*(batcher.provision(f"user-{i}") for i in (0, 0, 1, 2, 3, 4)))
+
+    assert batches == [["user-0", "user-1", "user-2"], ["user-3", "user-4"]]
+    assert batcher.stats()["largest_batch"] == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_fails_every_user_in_it():
+    async def provision_many(user_ids):
+        raise RuntimeError("rpc failed")
+
+    batcher = RoleBatcher(provision_many, max_batch=10, window=0)
+    results = await asyncio.gather(*(batcher.provision(f"user-{i}") for i in range(3)), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert batcher.stats()["failed_batches"] == 1
+
+
+class BulkRoleStub(StubPostgrest):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def respond(self, method, target, headers, body):
+        if target == "/rpc/create_user_roles":
+            self.batches.append(json.loads(body)["user_ids"])
+            return 200, {"Content-Type": "application/json"}, json.dumps(self.batches[-1]).encode()
+        return super().respond(method, target, headers, body)
+
+
+@pytest.mark.asyncio
+async def test_proxy_provisions_concurrent_new_users_in_one_batch(monkeypatch, proxy_client):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+    monkeypatch.setattr(main, "role_batcher", RoleBatcher(main.create_user_roles, max_batch=100, window=0.05))
+    tokens = [issuer.issue(sub=f"user-{i}") for i in range(5)]
+
+    async with BulkRoleStub() as stub:
+        client = await proxy_client(stub.url)
+        responses = await asyncio.gather(*(
+            client.get("/test", headers={"Authorization": f"Bearer {tokens[i % 5]}"})
+            for i in range(20)
+        ))
+
+    assert all(r.status_code == 200 for r in responses)
+    assert [sorted(batch) for batch in stub.batches] == [[f"user-{i}" for i in range(5)]]
+    assert "/rpc/create_user_role" not in stub.paths
+
+
+@pytest.mark.asyncio
+async def test_warm_role_cache_loads_provisioned_users(monkeypatch):
+    def handler(request):
+        assert request.url.path == "/rpc/provisioned_users"
+        return httpx.Response(200, json=[{"id": "alice"}, {"id": "bob"}])
+
+    postgrest = UpstreamClient("postgrest")
+    postgrest._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main.upstream, "postgrest", postgrest)
+    monkeypatch.setattr(main, "role_cache", RoleCache())
+
+    await main.warm_role_cache()
+    assert main.role_cache.is_known("alice")
+    assert main.role_cache.is_known("bob")
@@ -0,0 +1,217 @@
+import asyncio
+import fnmatch
+import os
+import sqlite3
+import stat
+import time
+
+import httpx
+import pytest
+
+from jwks import JWKSManager
+from roles import RoleCache
+from shared_cache import RedisCache, SQLiteCache
+from stub_authentik import StubIssuer, StubJWKSServer
+from token_cache import TokenCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeRedis:
+    """The subset of redis.asyncio.Redis used by RedisCache, without expiry"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, px=None):
+        self.data[key] = value
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def scan_iter(self, match):
+        for key in list(self.data):
+            if fnmatch.fnmatch(key, match):
+                yield key
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / "cache.sqlite3")
+
+
+@pytest.mark.asyncio
+async def test_sqlite_entries_are_shared_and_expire(sqlite_path):
+    clock = FakeClock()
+    writer, reader = SQLiteCache(sqlite_path, clock=clock), SQLiteCache(sqlite_path, clock=clock)
+
+    await writer.set("token", "a", b"one", ttl=60)
+    await writer.set("token", "b", b"two", ttl=60)
+    await writer.set("role", "a", b"1", ttl=600)
+    assert await reader.get("token", "a") == b"one"
+    assert await reader.get("role", "b") is None
+
+    clock.now += 61
+    assert await reader.get("token", "a") is None
+    assert await reader.get("role", "a") == b"1"
+
+    assert await reader.delete("role") == 1
+    assert await writer.get("role", "a") is None
+    assert reader.stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_and_its_wal_files_are_private(sqlite_path):
+    umask = os.umask(0o022)
+    try:
+        cache = SQLiteCache(sqlite_path)
+        await cache.set("token", "alice", b"minted", ttl=60)
+        assert await cache.get("token", "alice") == b"minted"
+        modes = {suffix: stat.S_IMODE(os.stat(sqlite_path + suffix).st_mode) for suffix in ("", "-wal", "-shm")}
+        await cache.aclose()
+    finally:
+        os.umask(umask)
+    assert modes == {"": 0o600, "-wal": 0o600, "-shm": 0o600}
+
+
+@pytest.mark.asyncio
+async def test_locked_sqlite_store_degrades_without_blocking_the_loop(sqlite_path):
+    cache = SQLiteCache(sqlite_path, busy_timeout=0.3)
+    await cache.set("role", "alice", b"1", ttl=60)
+    # Another worker holding the write lock
+    holder = sqlite3.connect(sqlite_path, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticking = asyncio.ensure_future(ticker())
+    started = time.perf_counter()
+    try:
+        await cache.set("role", "bob", b"1", ttl=60)
+        assert await cache.delete("role", "alice") == 0
+    finally:
+        ticking.cancel()
+        holder.rollback()
+        holder.close()
+
+    assert time.perf_counter() - started < 2
+    assert ticks >= 20  # The loop kept running while both queries waited out the busy timeout
+    assert cache.stats()["errors"] == 2
+    assert await cache.get("role", "alice") == b"1"
+    await cache.aclose()
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_namespaces_keys():
+    cache = RedisCache(client=FakeRedis())
+    await cache.set("role", "alice", b"1", ttl=60)
+    await cache.set("role", "bob", b"1", ttl=60)
+    await cache.set("token", "alice", b"t", ttl=60)
+
+    assert await cache.get("role", "alice") == b"1"
+    assert await cache.delete("role") == 2
+    assert await cache.get("token", "alice") == b"t"
+
+
+@pytest.mark.asyncio
+async def test_redis_outage_degrades_to_misses_and_skipped_writes():
+    class DownRedis(FakeRedis):
+        async def get(self, key):
+            raise ConnectionError("redis is down")
+
+        async def set(self, key, value, px=None):
+            await self.get(key)
+
+        async def delete(self, *keys):
+            await self.get(keys)
+
+        async def scan_iter(self, match):
+            await self.get(match)
+            yield match
+
+    cache = RedisCache(client=DownRedis())
+    await cache.set("role", "alice", b"1", ttl=60)
+    assert await cache.get("role", "alice") is None
+    assert await cache.delete("role", "alice") == 0
+    assert await cache.delete("role") == 0
+    assert cache.stats()["errors"] == 4
+
+    # /debug/roles/invalidate still drops the local entry instead of failing
+    roles = RoleCache(shared=cache)
+    roles.mark_known(["alice"])
+    await roles.forget("alice")
+    assert not roles.is_known("alice")
+
+
+@pytest.mark.asyncio
+async def test_token_verified_by_one_worker_is_reused_by_another(sqlite_path):
+    first = TokenCache(shared=SQLiteCache(sqlite_path))
+    second = TokenCache(shared=SQLiteCache(sqlite_path))
+    payload = {"sub": "alice", "role": "alice", "exp": first.clock() + 3600}
+
+    await first.store("bearer", {"sub": "alice"}, "minted", payload)
+    entry = await second.fetch("bearer")
+
+    assert entry.token == "minted"
+    assert entry.payload == payload
+    assert second.stats()["shared_hits"] == 1
+    # Promoted to the local tier, so the next lookup doesn't touch the shared cache
+    assert second.get("bearer") is entry
+
+
+@pytest.mark.asyncio
+async def test_role_provisioned_by_one_worker_is_known_to_another(sqlite_path):
+    calls = []
+
+    async def provision(user_id):
+        calls.append(user_id)
+
+    workers = [RoleCache(shared=SQLiteCache(sqlite_path)) for _ in range(4)]
+    for cache in workers:
+        await cache.ensure("alice", provision)
+
+    assert calls == ["alice"]
+    assert sum(cache.stats()["shared_hits"] for cache in workers) == 3
+
+    # forget() clears this worker and the shared cache; other workers keep their entry until it expires
+    assert await workers[0].forget("alice") == 1
+    await workers[0].ensure("alice", provision)
+    assert calls == ["alice", "alice"]
+
+
+@pytest.mark.asyncio
+async def test_jwks_fetched_once_for_every_worker(sqlite_path):
+    async with StubJWKSServer([StubIssuer("kid-a")], max_age=120) as server:
+        async with httpx.AsyncClient() as client:
+            workers = [
+                JWKSManager(f"{server.url}/jwks/", lambda: client, shared=SQLiteCache(sqlite_path), min_refetch_interval=0)
+                for _ in range(3)
+            ]
+            for manager in workers:
+                await manager.refresh()
+                assert set(manager.keys) == {"kid-a"}
+            assert server.requests == 1
+            assert sum(manager.shared_loads for manager in workers) == 2
+
+            # A rotated kid goes to Authentik once, then the other workers pick it up from the shared cache
+            server.issuers = [StubIssuer("kid-b")]
+            await workers[0].get_key("kid-b")
+            await workers[1].get_key("kid-b")
+            assert server.requests == 2
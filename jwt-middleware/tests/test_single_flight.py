@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callers_share_one_call_that_outlives_a_cancelled_caller():
+    errors = []
+    flights = SingleFlight(on_error=lambda key, error: errors.append((key, str(error))))
+    calls = 0
+    release = asyncio.Event()
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return "done"
+
+    first, started = flights.get_or_start("k", call)
+    second, joined = flights.get_or_start("k", call)
+    assert started and not joined and first is second and "k" in flights
+
+    waiter = asyncio.ensure_future(SingleFlight.join(first))
+    other = asyncio.ensure_future(SingleFlight.join(first))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    release.set()
+    assert await other == "done"
+    assert calls == 1 and len(flights) == 0 and errors == []
+
+    async def fail():
+        raise RuntimeError("boom")
+
+    failing, _ = flights.get_or_start("k", fail)
+    results = await asyncio.gather(SingleFlight.join(failing), SingleFlight.join(failing), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert errors == [("k", "boom")]
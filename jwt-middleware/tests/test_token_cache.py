@@ -0,0 +1,198 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from stub_authentik import StubIssuer
+from token_cache import MintedTokenCache, TokenCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def payload(exp: float) -> dict:
+    return {"sub": "user", "role": "user", "exp": exp}
+
+
+def test_entry_expires_at_earlier_of_upstream_and_minted_exp():
+    clock = FakeClock()
+    cache = TokenCache(clock=clock)
+    cache.put("upstream-first", {"exp": clock.now + 60}, "minted", payload(clock.now + 3600))
+    cache.put("minted-first", {"exp": clock.now + 7200}, "minted", payload(clock.now + 3600))
+
+    clock.now += 61
+    assert cache.get("upstream-first") is None
+    assert cache.get("minted-first") is not None
+
+    clock.now += 3600
+    assert cache.get("minted-first") is None
+    assert cache.stats()["expirations"] == 2
+
+
+def test_lru_eviction_by_entry_count():
+    clock = FakeClock()
+    cache = TokenCache(max_entries=2, clock=clock)
+    for token in ("a", "b"):
+        cache.put(token, {}, "minted", payload(clock.now + 60))
+    cache.get("a")
+    cache.put("c", {}, "minted", payload(clock.now + 60))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_cap_evicts_oldest_entries():
+    clock = FakeClock()
+    cache = TokenCache(max_bytes=2000, clock=clock)
+    for i in range(10):
+        cache.put(f"token-{i}", {}, "x" * 300, payload(clock.now + 60))
+
+    assert cache.bytes <= 2000
+    assert len(cache) < 10
+    assert cache.get("token-9") is not None
+    assert cache.get("token-0") is None
+
+
+def test_disabled_cache_never_stores():
+    cache = TokenCache(max_entries=0)
+    assert cache.put("a", {}, "minted", payload(9e12)) is None
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 0
+
+
+@pytest.mark.asyncio
+async def test_verify_token_skips_decode_and_sign_on_repeat(monkeypatch):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    token = issuer.issue(sub="alice")
+
+    first = await main.verify_token(token)
+    assert first.payload["sub"] == "alice"
+    assert first.payload["role"] == "alice"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached tokens must not be re-verified or re-signed")
+
+    monkeypatch.setattr(main.jwt, "decode", fail)
+    monkeypatch.setattr(main.jwt, "encode", fail)
+    assert await main.transform_token(token) == first.token
+    assert main.token_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_invalid_tokens_are_not_cached(monkeypatch):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", StubIssuer().key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+
+    with pytest.raises(HTTPException) as exc:
+        await main.verify_token(issuer.issue(sub="mallory"))
+    assert exc.value.status_code == 401
+    assert len(main.token_cache) == 0
+
+
+class Minter:
+    """Mints numbered tokens valid for ttl seconds, optionally failing"""
+
+    def __init__(self, clock: FakeClock, ttl: float = 3600):
+        self.clock = clock
+        self.ttl = ttl
+        self.calls = 0
+        self.fail = False
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError("signing failed")
+        return f"minted-{self.calls}", {"sub": "alice", "exp": self.clock.now + self.ttl}
+
+
+@pytest.mark.asyncio
+async def test_minted_token_is_reused_then_refreshed_ahead_of_expiry():
+    clock = FakeClock()
+    cache = MintedTokenCache(refresh_ahead=300, min_remaining=5, clock=clock)
+    mint = Minter(clock)
+    key = ("alice", "alice", "alice@example.com")
+
+    tokens = await asyncio.gather(*(cache.get(key, mint) for _ in range(5)))
+    assert {token for token, _ in tokens} == {"minted-1"}
+    assert mint.calls == 1
+
+    clock.now += 3600 - 301
+    assert (await cache.get(key, mint))[0] == "minted-1"
+    assert mint.calls == 1
+
+    # Inside the window: the current token is still served while a new one is minted
+    clock.now += 2
+    assert (await cache.get(key, mint))[0] == "minted-1"
+    assert (await cache.get(key, mint))[0] == "minted-1"
+    await asyncio.sleep(0.01)
+    assert (await cache.get(key, mint))[0] == "minted-2"
+    assert mint.calls == 2
+    assert cache.stats()["refreshes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_minted_token_too_close_to_expiry_is_never_handed_out():
+    clock = FakeClock()
+    cache = MintedTokenCache(refresh_ahead=0, min_remaining=5, clock=clock)
+    mint = Minter(clock, ttl=60)
+    key = ("alice",)
+
+    await cache.get(key, mint)
+    clock.now += 55  # exactly min_remaining left
+    assert (await cache.get(key, mint))[0] == "minted-2"
+    clock.now += 120  # long expired
+    assert (await cache.get(key, mint))[0] == "minted-3"
+    assert cache.stats()["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_refresh_keeps_current_token_until_it_runs_out():
+    clock = FakeClock()
+    cache = MintedTokenCache(refresh_ahead=300, min_remaining=5, clock=clock)
+    mint = Minter(clock)
+    key = ("alice",)
+    await cache.get(key, mint)
+
+    mint.fail = True
+    clock.now += 3600 - 100
+    assert (await cache.get(key, mint))[0] == "minted-1"
+    await asyncio.sleep(0.01)
+    assert cache.stats()["failures"] == 1
+
+    # Each later request retries the refresh; once the token is unusable the error reaches the caller
+    assert (await cache.get(key, mint))[0] == "minted-1"
+    await asyncio.sleep(0.01)
+    clock.now += 100
+    with pytest.raises(RuntimeError):
+        await cache.get(key, mint)
+    mint.fail = False
+    assert (await cache.get(key, mint))[0] == "minted-5"
+
+
+@pytest.mark.asyncio
+async def test_refreshed_authentik_tokens_reuse_the_minted_token(monkeypatch):
+    issuer = StubIssuer()
+    monkeypatch.setattr(main, "jwks_manager", issuer.key_set())
+    monkeypatch.setattr(main, "token_cache", TokenCache())
+    monkeypatch.setattr(main, "minted_tokens", MintedTokenCache())
+
+    first = await main.verify_token(issuer.issue(sub="alice", jti="first"))
+    second = await main.verify_token(issuer.issue(sub="alice", jti="second"))
+    other = await main.verify_token(issuer.issue(sub="bob"))
+
+    assert second.token == first.token
+    assert other.token != first.token
+    assert main.minted_tokens.stats()["mints"] == 2
+    assert main.token_cache.stats()["misses"] == 3
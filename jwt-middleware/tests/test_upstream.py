@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from stub_postgrest import StubPostgrest
+from upstream import UpstreamClient, UpstreamClients
+
+
+@pytest.mark.asyncio
+async def test_pooled_client_reuses_connections():
+    async with StubPostgrest() as stub:
+        upstream = UpstreamClient("postgrest", stub.url, max_connections=4, max_keepalive_connections=4)
+        for _ in range(5):
+            response = await upstream.client.get("/test")
+            assert response.status_code == 200
+
+        stats = upstream.stats()
+        assert stub.connections == 1
+        assert stats["requests_total"] == 5
+        assert stats["connections_opened"] == 1
+        assert stats["reuse_ratio"] == 0.8
+        assert stats["idle_connections"] == 1
+        assert stats["in_flight"] == 0
+
+        await upstream.aclose()
+        assert upstream.stats()["open"] is False
+
+
+@pytest.mark.asyncio
+async def test_requests_queued_for_a_connection_are_counted():
+    async with StubPostgrest() as stub:
+        upstream = UpstreamClient("postgrest", stub.url, max_connections=1, max_keepalive_connections=1)
+        async with upstream.client.stream("GET", "/test") as held:
+            waiting = asyncio.create_task(upstream.client.get("/test"))
+            await asyncio.sleep(0.05)
+            stats = upstream.stats()
+            assert stats["waiting_acquisitions"] == 1
+            assert stats["in_flight"] == 2
+            assert stats["active_connections"] == 1
+            await held.aread()
+
+        assert (await waiting).status_code == 200
+        stats = upstream.stats()
+        assert stats["waiting_acquisitions"] == 0
+        assert stats["in_flight"] == 0
+        await upstream.aclose()
+
+
+def test_from_env_prefers_upstream_specific_settings(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_MAX_CONNECTIONS", "50")
+    monkeypatch.setenv("POSTGREST_MAX_CONNECTIONS", "7")
+    monkeypatch.setenv("POSTGREST_READ_TIMEOUT", "2.5")
+    clients = UpstreamClients.from_env("http://postgrest:3000")
+
+    assert clients.postgrest.limits.max_connections == 7
+    assert clients.postgrest.timeout.read == 2.5
+    assert clients.jwks.limits.max_connections == 50
+
+
+@pytest.mark.asyncio
+async def test_proxy_shares_one_upstream_connection(monkeypatch, proxy_client):
+    async with StubPostgrest() as stub:
+        client = await proxy_client(stub.url)
+        for _ in range(3):
+            response = await client.get("/test")
+            assert response.status_code == 200
+
+        pool = (await client.get("/debug/pool")).json()
+
+        assert stub.connections == 1
+        assert pool["postgrest"]["requests_total"] == 3
@@ -0,0 +1,106 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from crypto_pool import CryptoExecutor
+from jwks import JWKSManager
+from stub_authentik import StubIssuer, StubJWKSServer
+from stub_postgrest import StubPostgrest
+from warmup import Warmup
+
+
+@pytest.mark.asyncio
+async def test_steps_run_concurrently_and_failures_do_not_stop_the_others():
+    warmup = Warmup(timeout=0.05)
+    order = []
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        order.append("slow")
+
+    async def fast():
+        order.append("fast")
+
+    async def broken():
+        raise RuntimeError("boom")
+
+    async def stuck():
+        await asyncio.sleep(1)
+
+    assert not warmup.done
+    await warmup.run({"slow": slow, "fast": fast, "broken": broken, "stuck": stuck})
+
+    assert order == ["fast", "slow"]
+    assert {name: step["status"] for name, step in warmup.steps.items()} == {
+        "slow": "ok", "fast": "ok", "broken": "error", "stuck": "timeout"
+    }
+    assert warmup.done
+    assert warmup.stats()["elapsed_ms"] < 1000
+
+
+@pytest.mark.asyncio
+async def test_jwks_keeps_refreshing_after_its_warmup_step_times_out():
+    warmup = Warmup(timeout=0.05)
+    async with StubJWKSServer([StubIssuer()], latency_ms=200) as jwks_server, httpx.AsyncClient() as client:
+        jwks_manager = JWKSManager(jwks_server.url, lambda: client, min_refetch_interval=0.05)
+        try:
+            await warmup.run({"jwks": jwks_manager.start})
+            assert warmup.steps["jwks"]["status"] == "timeout"
+            assert jwks_manager.stats()["background_refresh"] is True
+            assert not jwks_manager._refresh_task.done()
+
+            # The cancelled first fetch still lands, and the loop goes on from there
+            for _ in range(50):
+                if jwks_manager.ready:
+                    break
+                await asyncio.sleep(0.02)
+            assert set(jwks_manager.keys) == {"stub-key-1"}
+            assert not jwks_manager._refresh_task.done()
+        finally:
+            await jwks_manager.stop()
+
+
+@pytest.mark.asyncio
+async def test_ready_waits_for_warmup_and_warmup_prepares_keys_pool_and_crypto(monkeypatch, proxy_client):
+    monkeypatch.setattr(main, "warmup", Warmup(connections=3))
+    crypto = CryptoExecutor("thread", workers=2)
+    verified = []
+    verify = crypto.verify
+    monkeypatch.setattr(crypto, "verify", lambda token, key, **kwargs: verified.append(key) or verify(token, key, **kwargs))
+    monkeypatch.setattr(main, "crypto", crypto)
+
+    async with StubPostgrest() as stub, StubJWKSServer([StubIssuer()]) as jwks_server:
+        jwks_manager = JWKSManager(jwks_server.url, lambda: main.upstream.jwks.client)
+        monkeypatch.setattr(main, "jwks_manager", jwks_manager)
+        client = await proxy_client(stub.url)
+        before = await client.get("/ready")
+        await main.warmup.run(main.warmup_steps())
+        after = await client.get("/ready")
+        pool = main.upstream.postgrest.stats()
+        await jwks_manager.stop()
+        await main.upstream.jwks.aclose()
+    crypto.shutdown()
+
+    assert before.status_code == 503
+    assert before.json()["checks"] == {"warmup": False, "jwks": False, "postgrest": True}
+    assert after.status_code == 200
+    assert {name: step["status"] for name, step in after.json()["warmup"]["steps"].items()} == {
+        "jwks": "ok", "postgrest_pool": "ok", "crypto": "ok"
+    }
+    assert pool["connections_opened"] == 3
+    # One sign, then a verify per worker against the fetched key
+    assert crypto.stats()["completed"] == 1
+    assert verified == [jwks_manager.keys["stub-key-1"]] * 2
+
+
+@pytest.mark.asyncio
+async def test_ready_reports_an_unreachable_postgrest(monkeypatch, proxy_client):
+    monkeypatch.setattr(main, "jwks_manager", StubIssuer().key_set())
+    monkeypatch.setattr(main, "warmup", Warmup(enabled=False))
+    client = await proxy_client("http://127.0.0.1:9")
+    response = await client.get("/ready")
+
+    assert response.status_code == 503
+    assert response.json()["checks"] == {"warmup": True, "jwks": True, "postgrest": False}